@@ -0,0 +1,77 @@
+import pytest
+
+
+class FakeConnection:
+	def __init__(self):
+		self.commits = 0
+		self.closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.commit()
+
+	def commit(self):
+		self.commits += 1
+
+	def close(self):
+		self.closed = True
+
+	def cursor(self):
+		cur = FakeCursor()
+		cur.connection = self
+		return cur
+
+
+class FakeCursor:
+	def __init__(self, results=None):
+		self.connection = FakeConnection()
+		self.executed = []
+		self._results = results or {}
+		self._rows = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+	@property
+	def statements(self):
+		return [query for query, _ in self.executed]
+
+	def execute(self, query, vars=None):
+		self.executed.append((query, vars))
+
+		# the rows of the first result whose key the query contains
+		self._rows = next((rows for pattern, rows in self._results.items() if pattern in query), [])
+
+	def copy_expert(self, sql, file):
+		self.executed.append((sql, None))
+
+	def mogrify(self, query, vars):
+		if isinstance(vars, dict):
+			return (query % {name: repr(value) for name, value in vars.items()}).encode()
+
+		return (query % tuple(repr(value) for value in vars)).encode()
+
+	def fetchone(self):
+		return self._rows[0] if self._rows else None
+
+	def fetchall(self):
+		return list(self._rows)
+
+	def __iter__(self):
+		return iter(self._rows)
+
+
+@pytest.fixture
+def fake_cursor():
+	return FakeCursor
+
+
+@pytest.fixture
+def fake_connection():
+	return FakeConnection
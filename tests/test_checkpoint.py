@@ -0,0 +1,73 @@
+from weasyl_smallcopy import steps
+from weasyl_smallcopy.checkpoint import ChunkingCursor
+
+
+def _copies(cur):
+	return [(query, vars) for query, vars in cur.executed if query.lstrip().startswith("INSERT INTO smallcopy.")]
+
+
+def _run_step(name, cur, **kwargs):
+	step = next(step for step in steps if step.name == name)
+	step.func(ChunkingCursor(cur, step_name=name, chunk_size=100, **kwargs))
+
+
+def test_chunked_join(fake_cursor):
+	cur = fake_cursor({"pg_index": [("submitid", "integer")], "min(": [(1, 250)]})
+	_run_step("submission", cur)
+	copies = _copies(cur)
+
+	assert [vars for _, vars in copies] == [
+		{"smallcopy_chunk_start": 1, "smallcopy_chunk_end": 101},
+		{"smallcopy_chunk_start": 101, "smallcopy_chunk_end": 201},
+		{"smallcopy_chunk_start": 201, "smallcopy_chunk_end": 301},
+	]
+	assert copies[0][0].endswith(
+		"INNER JOIN smallcopy_keys.submissions USING (submitid) "
+		"WHERE public.submission.submitid >= %(smallcopy_chunk_start)s AND public.submission.submitid < %(smallcopy_chunk_end)s")
+	assert cur.connection.commits == 4
+
+
+def test_chunked_where(fake_cursor):
+	cur = fake_cursor({"pg_index": [("userid", "integer")], "min(": [(1, 50)]})
+	_run_step("favorite", cur)
+	query, _ = _copies(cur)[0]
+
+	# the step's own conditions are kept together behind the range
+	assert "WHERE public.favorite.userid >= %(smallcopy_chunk_start)s AND public.favorite.userid < %(smallcopy_chunk_end)s AND ( profile.config !~ '[hv]' AND (" in query
+	assert query.rstrip().endswith(")")
+
+
+def test_chunked_resume(fake_cursor):
+	cur = fake_cursor({"pg_index": [("mediaid", "integer")], "min(": [(1, 250)]})
+	_run_step("add necessary media entries", cur, statement=1, next_key=201)
+	copies = _copies(cur)
+
+	# media was copied before resuming, and submission_media_links continues from its last range
+	assert "INTO smallcopy.media " not in copies[0][0]
+	assert copies[0][1] == {"smallcopy_chunk_start": 201, "smallcopy_chunk_end": 301}
+
+
+def test_not_chunkable(fake_cursor):
+	cur = fake_cursor({"pg_index": [("id", "integer")], "min(": [(1, 250)]})
+	query = "INSERT INTO smallcopy.ads (id, owner) SELECT id, owner FROM ads WHERE owner LIKE 'a%' ORDER BY id"
+	ChunkingCursor(cur, step_name="ads", chunk_size=100).execute(query)
+
+	assert _copies(cur) == [(query, None)]
+
+
+def test_without_integer_key(fake_cursor):
+	cur = fake_cursor({"pg_index": [("tag", "text")], "min(": [None]})
+	query = "INSERT INTO smallcopy.tags (tag) SELECT tag FROM tags WHERE tag LIKE 'a%'"
+	ChunkingCursor(cur, step_name="tags", chunk_size=100).execute(query)
+
+	assert _copies(cur) == [(query, None)]
+
+
+def test_chunked_escapes_percent(fake_cursor):
+	cur = fake_cursor({"pg_index": [("id", "integer")], "min(": [(1, 50)]})
+	ChunkingCursor(cur, step_name="ads", chunk_size=100).execute("INSERT INTO smallcopy.ads (id, owner) SELECT id, owner FROM ads WHERE owner LIKE 'a%'")
+
+	# the chunk range is passed as parameters, so a literal % has to be escaped
+	assert _copies(cur)[0][0] == (
+		"INSERT INTO smallcopy.ads (id, owner) SELECT id, owner FROM ads "
+		"WHERE public.ads.id >= %(smallcopy_chunk_start)s AND public.ads.id < %(smallcopy_chunk_end)s AND ( owner LIKE 'a%%')")
@@ -0,0 +1,63 @@
+from weasyl_smallcopy import steps
+from weasyl_smallcopy.full_copy import FullCopyCursor, remove_user_joins
+
+USER_COLUMNS = frozenset({
+	("login", "userid"),
+	("authbcrypt", "userid"),
+	("collection", "userid"),
+	("frienduser", "userid"),
+	("watchuser", "userid"),
+	("watchuser", "otherid"),
+})
+
+
+def _run_step(fake_cursor, name):
+	step = next(step for step in steps if step.name == name)
+	cur = fake_cursor()
+	full_copy_cur = FullCopyCursor(cur, user_columns=USER_COLUMNS)
+	step.func(full_copy_cur)
+	return cur.statements, full_copy_cur.removed
+
+
+def test_using(fake_cursor):
+	statements, removed = _run_step(fake_cursor, "authbcrypt")
+
+	assert statements == ["INSERT INTO smallcopy.authbcrypt (userid, hashsum) SELECT userid, '$2a$12$qReI924/8pAsoHu6aRTX2ejyujAZ/9FiOOtrjczBIwf8wqXAJ22N.' FROM authbcrypt"]
+	assert removed == ["authbcrypt.userid"]
+
+
+def test_aliased_joins(fake_cursor):
+	statements, removed = _run_step(fake_cursor, "watchuser")
+
+	assert "smallcopy_keys.users" not in statements[0]
+	assert removed == ["watchuser.userid", "watchuser.otherid"]
+
+
+def test_keeps_other_columns(fake_cursor):
+	statements, removed = _run_step(fake_cursor, "frienduser")
+
+	# otherid isn't known to have a login, so its join stays
+	assert "INNER JOIN smallcopy_keys.users fu" not in statements[0]
+	assert "INNER JOIN smallcopy_keys.users fo ON frienduser.otherid = fo.userid" in statements[0]
+	assert removed == ["frienduser.userid"]
+
+
+def test_keeps_other_joins(fake_cursor):
+	statements, removed = _run_step(fake_cursor, "collection")
+
+	assert statements[0].rstrip().endswith("FROM collection\n\t\t\tINNER JOIN smallcopy_keys.submissions USING (submitid)")
+	assert removed == ["collection.userid"]
+
+
+def test_unknown_table(fake_cursor):
+	statements, removed = _run_step(fake_cursor, "userinfo")
+
+	assert statements[0].endswith("FROM userinfo INNER JOIN smallcopy_keys.users USING (userid)")
+	assert removed == []
+
+
+def test_other_qualifier():
+	query = "INSERT INTO smallcopy.x (userid) SELECT a.userid FROM login a INNER JOIN other b ON a.userid = b.userid INNER JOIN smallcopy_keys.users u ON b.userid = u.userid"
+
+	# the join is on another table's column, which may not have a login
+	assert remove_user_joins(query, USER_COLUMNS) == (query, [])
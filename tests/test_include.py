@@ -0,0 +1,30 @@
+import pytest
+
+from weasyl_smallcopy import read_include, sample_users
+
+
+def test_read_include(tmp_path):
+	path = tmp_path / "users.txt"
+	path.write_text("3\n5 8\n")
+
+	assert read_include("all") == "all"
+	assert read_include([1, 2]) == [1, 2]
+	assert read_include({"file": str(path)}) == [3, 5, 8]
+	assert read_include({"query": "SELECT userid FROM login"}) == {"query": "SELECT userid FROM login"}
+	assert read_include({"sample": 100, "depth": 2, "seed": 1}) == {"sample": 100, "depth": 2, "seed": 1}
+
+	for include in ["some", {"file": str(path), "sample": 100}, {}, {"sample": 100, "size": 2}]:
+		with pytest.raises(ValueError):
+			read_include(include)
+
+
+def test_sample_users(fake_cursor):
+	cur = fake_cursor()
+	sample_users(cur, sample=100, depth=2, seed=7)
+
+	# the sample is ordered by a hash of the seed, which is the same on any connection
+	assert cur.executed[0] == (
+		"INSERT INTO smallcopy_keys.include (userid) SELECT userid FROM login ORDER BY md5(%(seed)s || ':' || userid), userid LIMIT %(sample)s",
+		{"sample": 100, "seed": "7"})
+	assert cur.statements[1::2] == ["ANALYZE smallcopy_keys.include"] * 2
+	assert [vars for _, vars in cur.executed[2::2]] == [{"level": 1, "previous": 0}, {"level": 2, "previous": 1}]
@@ -0,0 +1,65 @@
+from weasyl_smallcopy import refresh_steps
+from weasyl_smallcopy.incremental import drop_foreign_keys, merge
+from weasyl_smallcopy.schema import PostDataObject
+from weasyl_smallcopy.statements import parse_insert_select
+
+FOREIGN_KEY = PostDataObject(
+	"FK CONSTRAINT", "favorite", "favorite_userid_fkey",
+	"\n\nALTER TABLE ONLY favorite\n    ADD CONSTRAINT favorite_userid_fkey FOREIGN KEY (userid) REFERENCES login(userid);\n")
+
+
+def test_drop_foreign_keys(fake_cursor):
+	cur = fake_cursor()
+	drop_foreign_keys(cur, objects=[FOREIGN_KEY])
+
+	# a failed refresh can leave them dropped
+	assert cur.statements == ["ALTER TABLE smallcopy.favorite DROP CONSTRAINT IF EXISTS favorite_userid_fkey"]
+
+
+def test_refresh_keeps_schema():
+	names = [step.name for step in refresh_steps([FOREIGN_KEY])]
+
+	assert "initialize schema" not in names
+	assert names[0] == "drop foreign keys"
+	assert "submission" in names
+	assert names[-2:] == ["add foreign keys", "validate foreign keys on favorite"]
+
+
+def test_merge_changed_rows(fake_cursor):
+	statement = parse_insert_select(
+		"INSERT INTO smallcopy.submission (submitid, userid, title) "
+		"SELECT submitid, userid, title FROM submission INNER JOIN smallcopy_keys.submissions USING (submitid)")
+	cur = fake_cursor({
+		"pg_index": [("submitid",)],
+		"format_type": [("submitid", "integer"), ("userid", "integer"), ("title", "character varying(200)")],
+	})
+	merge(cur, statement, None)
+	result = "(SELECT submitid, userid, title FROM submission INNER JOIN smallcopy_keys.submissions USING (submitid)) AS q (submitid, userid, title)"
+
+	assert cur.statements[2:] == [
+		"CREATE TEMPORARY TABLE smallcopy_selected AS SELECT submitid, md5(ROW(q.submitid::integer, q.userid::integer, q.title::character varying(200))::text) AS row_hash "
+		f"FROM {result}",
+		"ANALYZE smallcopy_selected",
+		"DELETE FROM smallcopy.submission t WHERE NOT EXISTS (SELECT FROM smallcopy_selected s WHERE s.submitid = t.submitid)",
+		"CREATE TEMPORARY TABLE smallcopy_changed AS SELECT submitid FROM smallcopy_selected s "
+		"WHERE NOT EXISTS (SELECT FROM smallcopy.submission t WHERE t.submitid = s.submitid AND md5(ROW(t.submitid, t.userid, t.title)::text) = s.row_hash)",
+		"ANALYZE smallcopy_changed",
+		f"CREATE TEMPORARY TABLE smallcopy_incoming AS SELECT q.* FROM {result} INNER JOIN smallcopy_changed USING (submitid)",
+		"UPDATE smallcopy.submission t SET userid = i.userid, title = i.title FROM smallcopy_incoming i WHERE t.submitid = i.submitid",
+		"INSERT INTO smallcopy.submission (submitid, userid, title) SELECT submitid, userid, title FROM smallcopy_incoming i "
+		"WHERE NOT EXISTS (SELECT FROM smallcopy.submission t WHERE t.submitid = i.submitid)",
+		"DROP TABLE smallcopy_selected, smallcopy_changed, smallcopy_incoming",
+	]
+
+
+def test_merge_without_primary_key(fake_cursor):
+	statement = parse_insert_select(
+		"INSERT INTO smallcopy.searchmapsubmit (targetid, tagid) "
+		"SELECT targetid, tagid FROM searchmapsubmit INNER JOIN smallcopy_keys.submissions ON targetid = submitid")
+	cur = fake_cursor()
+	merge(cur, statement, None)
+
+	assert cur.statements[1].startswith("CREATE TEMPORARY TABLE smallcopy_incoming AS SELECT * FROM ")
+	assert cur.statements[3] == (
+		"DELETE FROM smallcopy.searchmapsubmit t WHERE NOT EXISTS "
+		"(SELECT FROM smallcopy_incoming i WHERE t.targetid IS NOT DISTINCT FROM i.targetid AND t.tagid IS NOT DISTINCT FROM i.tagid)")
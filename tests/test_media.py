@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+import pytest
+
+from weasyl_smallcopy.media import _materialize, _relative_path, _Stats
+
+CONTENT = b"image"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def _write(path, content):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	with open(path, "wb") as f:
+		f.write(content)
+
+
+def _read(path):
+	with open(path, "rb") as f:
+		return f.read()
+
+
+def test_materialize(tmp_path):
+	source_root = str(tmp_path / "source")
+	destination_root = str(tmp_path / "destination")
+	_write(os.path.join(source_root, "b/2.png"), CONTENT)
+	stats = _Stats()
+
+	# the first path that exists in the source is copied, and every path gets the content
+	_materialize(SHA256, ["a/1.png", "b/2.png", "c/3.png"], source_root=source_root, destination_root=destination_root, link=False, stats=stats)
+
+	assert [_read(os.path.join(destination_root, path)) for path in ["a/1.png", "b/2.png", "c/3.png"]] == [CONTENT] * 3
+	assert os.path.samefile(os.path.join(destination_root, "a/1.png"), os.path.join(destination_root, "b/2.png"))
+	assert (stats.copied, stats.copied_bytes, stats.linked, stats.existing, stats.failures) == (1, len(CONTENT), 2, 0, [])
+	assert not os.path.exists(os.path.join(destination_root, "b/2.png.partial"))
+
+
+def test_materialize_existing(tmp_path):
+	destination_root = str(tmp_path / "destination")
+	_write(os.path.join(destination_root, "a/1.png"), CONTENT)
+	stats = _Stats()
+	_materialize(SHA256, ["a/1.png", "b/2.png"], source_root=str(tmp_path / "source"), destination_root=destination_root, link=True, stats=stats)
+
+	assert os.path.samefile(os.path.join(destination_root, "a/1.png"), os.path.join(destination_root, "b/2.png"))
+	assert (stats.copied, stats.linked, stats.existing, stats.failures) == (0, 1, 1, [])
+
+
+def test_materialize_failures(tmp_path):
+	source_root = str(tmp_path / "source")
+	destination_root = str(tmp_path / "destination")
+	_write(os.path.join(source_root, "a/1.png"), b"changed")
+	stats = _Stats()
+
+	_materialize(SHA256, ["a/1.png"], source_root=source_root, destination_root=destination_root, link=False, stats=stats)
+	_materialize(SHA256, ["missing.png"], source_root=source_root, destination_root=destination_root, link=False, stats=stats)
+
+	# a file with the wrong hash isn't left in the destination
+	assert not os.listdir(os.path.join(destination_root, "a"))
+	assert stats.copied == 0 and len(stats.failures) == 2
+	assert "expected " + SHA256 in stats.failures[0]
+
+
+def test_relative_path():
+	assert _relative_path("/static/media/a/1.png") == os.path.join("static", "media", "a", "1.png")
+
+	with pytest.raises(ValueError):
+		_relative_path("/../etc/passwd")
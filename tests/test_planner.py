@@ -0,0 +1,20 @@
+import json
+
+from weasyl_smallcopy.planner import calibrate
+
+
+def test_calibrate_streamed(tmp_path):
+	path = tmp_path / "report.json"
+
+	with open(path, "w") as f:
+		json.dump({"steps": [
+			{"name": "select users", "seconds": 1.0, "statements": [{"sql": "INSERT INTO smallcopy_keys.users (userid) SELECT userid FROM login", "rows": 10}]},
+			{"name": "login", "seconds": 2.0, "statements": [{"sql": "COPY smallcopy.login (userid, login_name) FROM STDIN", "rows": 100}]},
+			{"name": "folder", "seconds": 6.0, "statements": [
+				{"sql": "SELECT userid FROM smallcopy_keys.users ORDER BY userid LIMIT %(limit)s", "rows": 100},
+				{"sql": "INSERT INTO smallcopy.folder (folderid) SELECT folderid FROM folder", "rows": 300},
+			]},
+		]}, f)
+
+	# streamed copies count as copied rows, and selections don't
+	assert calibrate([path]) == {"login": 0.02, "folder": 0.02, None: 0.02}
@@ -0,0 +1,21 @@
+import json
+
+from weasyl_smallcopy.progress import read_baseline
+
+
+def test_read_baseline(tmp_path):
+	path = tmp_path / "report.json"
+
+	with open(path, "w") as f:
+		json.dump({"steps": [
+			{"name": "login", "seconds": 2.0, "relation_bytes": {"login": 8192}, "statements": [
+				{"sql": "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute", "rows": 1},
+				{"sql": "COPY smallcopy.login (userid, login_name) FROM STDIN", "rows": 100},
+				{"sql": "COPY smallcopy.login (userid, login_name) FROM STDIN", "rows": 20},
+			]},
+			{"name": "folder", "seconds": 1.0, "relation_bytes": {}, "statements": [
+				{"sql": "INSERT INTO smallcopy.folder (folderid) SELECT folderid FROM folder", "rows": None},
+			]},
+		]}, f)
+
+	assert read_baseline(path) == {"login": (120, 8192, 2.0), "folder": (0, 0, 1.0)}
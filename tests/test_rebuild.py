@@ -0,0 +1,60 @@
+import pytest
+
+from weasyl_smallcopy import main, rebuild_steps
+from weasyl_smallcopy.schema import PostDataObject
+
+
+def _names(run_steps):
+	return [step.name for step in run_steps]
+
+
+def test_only(fake_cursor):
+	run_steps = rebuild_steps([], only=["favorite"], rebuild_from=[])
+	names = _names(run_steps)
+
+	assert names[:2] == ["drop foreign keys", "truncate tables"]
+	assert {"initialize selection", "select users", "select submissions", "select characters", "select journals", "favorite", "update sequences"} <= set(names)
+	assert "submission" not in names and "initialize schema" not in names
+
+	cur = fake_cursor()
+	run_steps[1].func(cur)
+	assert cur.statements == ["TRUNCATE smallcopy.favorite"]
+
+
+def test_from():
+	names = _names(rebuild_steps([], only=[], rebuild_from=["submission"]))
+
+	assert {"submission", "collection", "comments", "favorite", "searchmapsubmit", "add necessary media entries"} <= set(names)
+	assert "journal" not in names
+
+
+def test_only_without_tables():
+	# nothing to truncate, which would otherwise be an empty TRUNCATE
+	for only in [["update sequences"], ["select users"]]:
+		assert "truncate tables" not in _names(rebuild_steps([], only=only, rebuild_from=[]))
+
+
+def test_unknown_step():
+	with pytest.raises(ValueError):
+		rebuild_steps([], only=["nonexistent"], rebuild_from=[])
+
+
+def test_foreign_keys(fake_cursor):
+	foreign_key = PostDataObject(
+		"FK CONSTRAINT", "favorite", "favorite_userid_fkey",
+		"\n\nALTER TABLE ONLY favorite\n    ADD CONSTRAINT favorite_userid_fkey FOREIGN KEY (userid) REFERENCES login(userid);\n")
+	run_steps = rebuild_steps([foreign_key], only=["favorite"], rebuild_from=[])
+
+	# dropped if they exist, since a failed rerun can leave them dropped
+	cur = fake_cursor()
+	run_steps[0].func(cur)
+	assert cur.statements == ["ALTER TABLE smallcopy.favorite DROP CONSTRAINT IF EXISTS favorite_userid_fkey"]
+	assert _names(run_steps)[-2:] == ["add foreign keys", "validate foreign keys on favorite"]
+
+
+def test_chunk_size(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	(tmp_path / "schema.sql").write_text("SET search_path = public, pg_catalog;\n")
+
+	with pytest.raises(ValueError, match="chunk_size"):
+		main({"database": "dbname=weasyl", "include": [], "maximum_rating": "general", "chunk_size": 1000}, only=["favorite"])
@@ -0,0 +1,45 @@
+import json
+
+from weasyl_smallcopy.report import compare
+
+
+def _plan(node_type, relation, index=None):
+	return {"Plan": {"Node Type": "ModifyTable", "Plans": [{"Node Type": node_type, "Relation Name": relation, "Index Name": index}]}}
+
+
+def _write_report(path, seconds, steps):
+	with open(path, "w") as f:
+		json.dump({"seconds": seconds, "steps": steps}, f)
+
+	return str(path)
+
+
+def test_compare(tmp_path, capsys):
+	old = _write_report(tmp_path / "old.json", 10.0, [
+		{"name": "login", "seconds": 4.0, "statements": [
+			{"sql": "INSERT INTO smallcopy.login SELECT 1", "rows": 100, "plan": _plan("Seq Scan", "login")},
+		]},
+		{"name": "removed", "seconds": 1.0, "statements": []},
+	])
+	new = _write_report(tmp_path / "new.json", 8.0, [
+		{"name": "login", "seconds": 3.0, "statements": [
+			{"sql": "INSERT INTO smallcopy.login SELECT 2", "rows": 120, "plan": _plan("Index Scan", "login", "login_pkey")},
+			{"sql": "ANALYZE smallcopy.login", "rows": None},
+		]},
+		{"name": "added", "seconds": 2.0, "statements": []},
+	])
+	compare(old, new)
+
+	assert capsys.readouterr().out.splitlines() == [
+		"step           old        new  change",
+		"login        4.00s      3.00s    -25%",
+		"  statement 1: SQL changed",
+		"  statement 1: rows 100 → 120",
+		"  statement 1: plan changed",
+		"    old: ModifyTable, Seq Scan on login",
+		"    new: ModifyTable, Index Scan on login using login_pkey",
+		"  statements: 1 → 2",
+		"removed      1.00s          -        ",
+		"added            -      2.00s        ",
+		"total       10.00s      8.00s    -20%",
+	]
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from weasyl_smallcopy import Step
+from weasyl_smallcopy.scheduler import run_in_snapshot, run_parallel, selection_step_names
+
+
+def _step(name, dependencies=(), tables=(), func=None):
+	return Step(name, func or (lambda cur, **config: None), frozenset(dependencies), frozenset(tables), False)
+
+
+def test_run_parallel_order(fake_connection):
+	connections = []
+	started = []
+	finished = []
+	lock = threading.Lock()
+
+	def connect():
+		connections.append(fake_connection())
+		return connections[-1]
+
+	def run(name):
+		def func(cur, *, value):
+			with lock:
+				started.append(name)
+
+			return f"{name} {value}"
+
+		return func
+
+	run_steps = [
+		_step("c", {"a", "b"}, func=run("c")),
+		_step("a", func=run("a")),
+		_step("b", {"a", "not run"}, func=run("b")),
+	]
+	run_parallel(connect, run_steps, {"value": 1}, workers=2, on_finish=lambda name, step_time, result: finished.append(result))
+
+	# dependencies outside the steps are ignored
+	assert started == ["a", "b", "c"]
+	assert finished == ["a 1", "b 1", "c 1"]
+	assert len(connections) == 2 and all(db.closed for db in connections)
+	assert sum(db.commits for db in connections) == 3
+
+
+def test_run_parallel_error(fake_connection):
+	connections = []
+	finished = []
+
+	def connect():
+		connections.append(fake_connection())
+		return connections[-1]
+
+	def fail(cur, **config):
+		raise ValueError("failed")
+
+	run_steps = [_step("a", func=fail), _step("b", {"a"})]
+
+	with pytest.raises(ValueError, match="failed"):
+		run_parallel(connect, run_steps, {}, workers=2, on_finish=lambda name, step_time, result: finished.append(name))
+
+	assert finished == []
+	assert all(db.closed and db.commits == 0 for db in connections)
+
+
+def test_selection_step_names():
+	run_steps = [
+		_step("select users"),
+		_step("select submissions", {"select users"}),
+		_step("login", {"select users"}, {"login"}),
+		_step("submission", {"select submissions", "login"}, {"submission"}),
+		_step("update sequences", {"login", "submission"}),
+	]
+
+	assert selection_step_names(run_steps) == {"select users", "select submissions"}
+
+
+def test_run_in_snapshot(fake_cursor):
+	cur = fake_cursor()
+	result = run_in_snapshot(cur, func=lambda cur, *, value: value, copy_snapshot="00000003-1", value=1)
+
+	assert result == 1
+	assert cur.executed == [
+		("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ", None),
+		("SET TRANSACTION SNAPSHOT %(snapshot)s", {"snapshot": "00000003-1"}),
+	]
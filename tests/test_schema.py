@@ -0,0 +1,86 @@
+import pytest
+
+from weasyl_smallcopy import main
+from weasyl_smallcopy.schema import make_unlogged, public_schema_sql, smallcopy_schema_sql, split_schema
+
+DUMP = """\
+SET statement_timeout = 0;
+
+SET search_path = public, pg_catalog;
+
+--
+-- Name: login; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE login (
+    userid integer NOT NULL,
+    login_name character varying(40) NOT NULL
+);
+
+--
+-- Name: favorite; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE favorite (
+    userid integer NOT NULL,
+    targetid integer NOT NULL
+);
+
+--
+-- Name: login login_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY login
+    ADD CONSTRAINT login_pkey PRIMARY KEY (userid);
+
+--
+-- Name: ind_favorite_userid; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX ind_favorite_userid ON favorite USING btree (userid);
+
+--
+-- Name: favorite favorite_userid_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY favorite
+    ADD CONSTRAINT favorite_userid_fkey FOREIGN KEY (userid) REFERENCES login(userid);
+
+"""
+
+
+
+def test_split_schema():
+	schema = split_schema(DUMP)
+
+	assert schema.sql == DUMP
+	assert "CREATE TABLE login" in schema.pre_data and "CREATE TABLE favorite" in schema.pre_data
+	assert "ADD CONSTRAINT" not in schema.pre_data and "CREATE INDEX" not in schema.pre_data
+	assert [(post_data_object.type, post_data_object.table, post_data_object.name) for post_data_object in schema.post_data] == [
+		("CONSTRAINT", "login", "login_pkey"),
+		("INDEX", "favorite", "ind_favorite_userid"),
+		("FK CONSTRAINT", "favorite", "favorite_userid_fkey"),
+	]
+	assert schema.pre_data + "".join(post_data_object.sql for post_data_object in schema.post_data) == DUMP
+
+
+
+def test_smallcopy_schema_sql():
+	sql = smallcopy_schema_sql(DUMP)
+
+	assert sql.startswith("SET statement_timeout = 0;\n\nSET search_path = smallcopy, public, pg_catalog;\n\nDROP SCHEMA IF EXISTS smallcopy CASCADE;\nCREATE SCHEMA smallcopy;\n\n--\n-- Name: login;")
+	assert smallcopy_schema_sql(sql) == sql
+
+	public_sql = public_schema_sql(sql)
+	assert "smallcopy" not in public_sql
+	assert split_schema(public_sql).post_data == split_schema(DUMP).post_data
+
+
+
+def test_make_unlogged():
+	assert make_unlogged(split_schema(DUMP).pre_data).count("CREATE UNLOGGED TABLE ") == 2
+
+
+def test_schema_template_requires_workers():
+	with pytest.raises(ValueError, match="more than one worker"):
+		main({"database": "dbname=weasyl", "include": [], "maximum_rating": "general", "schema_template": True})
@@ -0,0 +1,48 @@
+import json
+import os
+
+import pytest
+
+from weasyl_smallcopy.service import CopyCache, _parse_request
+
+
+def test_parse_request():
+	assert _parse_request(json.dumps({"include": [5, 3, 5], "maximum_rating": "general"})) == ([3, 5], "general", None)
+	assert _parse_request(json.dumps({"include": "all", "maximum_rating": "explicit", "snapshot": "2026-10-01"})) == ("all", "explicit", "2026-10-01")
+
+	for request in [
+		{"include": [], "maximum_rating": "general"},
+		{"include": ["5"], "maximum_rating": "general"},
+		{"include": [5], "maximum_rating": "adult"},
+		{"include": [5], "maximum_rating": "general", "snapshot": 1},
+	]:
+		with pytest.raises(ValueError):
+			_parse_request(json.dumps(request))
+
+
+def _add_export(cache_directory, name, size, mtime):
+	directory = os.path.join(cache_directory, name)
+	os.makedirs(directory)
+
+	with open(os.path.join(directory, "manifest.json"), "wb") as f:
+		f.write(b"x" * size)
+
+	os.utime(os.path.join(directory, "manifest.json"), (mtime, mtime))
+
+
+def test_evict(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	(tmp_path / "schema.sql").write_text("")
+	cache_directory = str(tmp_path / "cache")
+	cache = CopyCache({"database": "dbname=weasyl"}, cache_directory=cache_directory, budget=250, jobs=1)
+
+	_add_export(cache_directory, "oldest", 100, 1)
+	_add_export(cache_directory, "kept", 100, 2)
+	_add_export(cache_directory, "older", 100, 3)
+	_add_export(cache_directory, "newest", 100, 4)
+	os.makedirs(os.path.join(cache_directory, "building.partial"))
+
+	# the least recently used exports go first, except the one just built
+	cache._evict(keep="kept")
+
+	assert sorted(os.listdir(cache_directory)) == ["building.partial", "kept", "newest"]
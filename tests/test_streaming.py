@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+from weasyl_smallcopy import streaming
+from weasyl_smallcopy.statements import parse_insert_select
+from weasyl_smallcopy.streaming import StreamingCursor, _batch_reference, _Pipe, _selection_reference, source_query
+
+USERS = [("userid", "integer", [1, 2])]
+
+
+def test_pipe():
+	pipe = _Pipe(2)
+	writer = threading.Thread(target=lambda: [pipe.write(b"abc"), pipe.write(memoryview(b"def")), pipe.write(b"g"), pipe.finish()])
+	writer.start()
+
+	assert pipe.read(4) == b"abcd"
+	assert pipe.read() == b"efg"
+	assert pipe.read(1) == b""
+	writer.join()
+
+
+def test_pipe_error():
+	pipe = _Pipe(2)
+	pipe.write(b"abc")
+	pipe.finish(ValueError("source failed"))
+
+	with pytest.raises(ValueError, match="source failed"):
+		pipe.read()
+
+
+def test_pipe_closed():
+	pipe = _Pipe(1)
+	pipe.write(b"abc")
+
+	# a writer blocked on a full pipe is let through, and fails on its next write
+	writer = threading.Thread(target=pipe.write, args=(b"def",))
+	writer.start()
+	pipe.close()
+	writer.join()
+
+	with pytest.raises(BrokenPipeError):
+		pipe.write(b"ghi")
+
+
+def test_source_query():
+	query, params = source_query(
+		"SELECT userid FROM login INNER JOIN smallcopy_keys.users USING (userid) "
+		"INNER JOIN smallcopy_keys.users o ON login.userid = o.userid WHERE login.userid > %(minimum)s",
+		{"minimum": 0},
+		[USERS, [("userid", "integer", [3])]])
+
+	# a selection without an alias is named after its table, and each one has parameters of its own
+	assert query == (
+		"SELECT userid FROM login "
+		"INNER JOIN (SELECT * FROM unnest(%(smallcopy_keys_0_userid)s::integer[]) AS k (userid)) AS users USING (userid) "
+		"INNER JOIN (SELECT * FROM unnest(%(smallcopy_keys_1_userid)s::integer[]) AS k (userid)) o ON login.userid = o.userid WHERE login.userid > %(minimum)s")
+	assert params == {"minimum": 0, "smallcopy_keys_0_userid": [1, 2], "smallcopy_keys_1_userid": [3]}
+
+
+def _batch_reference_of(query, key_columns):
+	statement = parse_insert_select(query)
+	return _batch_reference(statement, list(_selection_reference.finditer(statement.query)), key_columns)
+
+
+def test_batch_reference():
+	key_columns = {"users": [("userid", "integer")], "include": [("userid", "integer"), ("depth", "integer")], "submissions": [("submitid", "integer")]}
+
+	assert _batch_reference_of(
+		"INSERT INTO smallcopy.favorite (userid, submitid) SELECT userid, submitid FROM favorite "
+		"LEFT JOIN smallcopy_keys.submissions USING (submitid) INNER JOIN smallcopy_keys.users USING (userid)", key_columns) == 1
+
+	# rows that would be combined across batches, keys of more than one column, and the selection being filled
+	assert _batch_reference_of(
+		"INSERT INTO smallcopy_keys.tags (tagid) SELECT tagid FROM searchmapsubmit INNER JOIN smallcopy_keys.submissions ON targetid = submitid "
+		"UNION SELECT tagid FROM searchmapchar", key_columns) is None
+	assert _batch_reference_of("INSERT INTO smallcopy_keys.users (userid) SELECT userid FROM smallcopy_keys.include", key_columns) is None
+	assert _batch_reference_of("INSERT INTO smallcopy_keys.users (userid) SELECT userid FROM login INNER JOIN smallcopy_keys.users USING (userid)", key_columns) is None
+
+
+def test_streaming_batches(fake_cursor, monkeypatch):
+	monkeypatch.setattr(streaming, "KEY_BATCH_SIZE", 2)
+	target_cur = fake_cursor({
+		"format_type": [("userid", "integer")],
+		"WHERE userid > ": [(3,)],
+		"ORDER BY userid": [(1,), (2,)],
+	})
+	source_cur = fake_cursor()
+	StreamingCursor(target_cur, source_cur).execute("INSERT INTO smallcopy.login (userid) SELECT userid FROM login INNER JOIN smallcopy_keys.users USING (userid)")
+
+	assert target_cur.statements[1:] == [
+		"SELECT userid FROM smallcopy_keys.users ORDER BY userid LIMIT %(limit)s",
+		"COPY smallcopy.login (userid) FROM STDIN",
+		"SELECT userid FROM smallcopy_keys.users WHERE userid > %(last)s ORDER BY userid LIMIT %(limit)s",
+		"COPY smallcopy.login (userid) FROM STDIN",
+	]
+	assert source_cur.statements == [
+		"COPY (SELECT userid FROM login INNER JOIN (SELECT * FROM unnest([1, 2]::integer[]) AS k (userid)) AS users USING (userid)) TO STDOUT",
+		"COPY (SELECT userid FROM login INNER JOIN (SELECT * FROM unnest([3]::integer[]) AS k (userid)) AS users USING (userid)) TO STDOUT",
+	]
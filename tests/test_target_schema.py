@@ -0,0 +1,66 @@
+from weasyl_smallcopy import steps
+from weasyl_smallcopy.target_schema import SchemaCursor
+
+
+def _step(name):
+	return next(step for step in steps if step.name == name)
+
+
+def test_rewrite_identifiers(fake_cursor):
+	cur = SchemaCursor(fake_cursor(), schema="smallcopy_general")
+
+	assert cur.rewrite("INSERT INTO smallcopy.login SELECT * FROM public.login INNER JOIN smallcopy_keys.users USING (userid)") == (
+		'INSERT INTO "smallcopy_general".login SELECT * FROM public.login INNER JOIN "smallcopy_general_keys".users USING (userid)')
+	assert cur.rewrite("CREATE SCHEMA smallcopy_template") == 'CREATE SCHEMA "smallcopy_general_template"'
+
+
+def test_rewrite_leaves_longer_names(fake_cursor):
+	cur = SchemaCursor(fake_cursor(), schema="copy")
+
+	assert cur.rewrite("SELECT smallcopy_checkpoints FROM smallcopy.smallcopyx") == 'SELECT smallcopy_checkpoints FROM "copy".smallcopyx'
+
+
+def test_rewrite_literals(fake_cursor):
+	cur = SchemaCursor(fake_cursor(), schema="it's")
+
+	# a literal that is the whole name is a plain name, and one that contains it is a qualified name
+	assert cur.rewrite("SELECT 1 WHERE nspname = 'smallcopy_keys'") == "SELECT 1 WHERE nspname = 'it''s_keys'"
+	assert cur.rewrite("SELECT 'smallcopy.login'::regclass") == "SELECT '\"it''s\".login'::regclass"
+
+
+def test_rewrite_escapes_placeholders(fake_cursor):
+	cur = SchemaCursor(fake_cursor(), schema="100%")
+
+	assert cur.rewrite("SELECT * FROM smallcopy.login WHERE userid = %(userid)s", parameters=True) == (
+		'SELECT * FROM "100%%".login WHERE userid = %(userid)s')
+	assert cur.rewrite("SELECT * FROM smallcopy.login") == 'SELECT * FROM "100%".login'
+
+
+def test_rewrite_update_sequences(fake_cursor):
+	recording = fake_cursor()
+	_step("update sequences").func(SchemaCursor(recording, schema="smallcopy_general"))
+	database_sequences, updating_sequences, *set_sequences = recording.statements
+
+	# both sets of sequences are normalized by regclass, so the quoting of the schema name can't make them differ
+	assert database_sequences == (
+		"SELECT (quote_ident('smallcopy_general') || '.' || quote_ident(sequence_name))::regclass::text "
+		"FROM information_schema.sequences WHERE sequence_schema = 'smallcopy_general'")
+	assert updating_sequences == (
+		"SELECT pg_get_serial_sequence('\"smallcopy_general\".' || table_name::text, column_name::text)::regclass::text "
+		"FROM UNNEST (%(sequences)s) AS t (table_name unknown, column_name unknown)")
+	assert set_sequences[0] == (
+		"SELECT setval(pg_get_serial_sequence('\"smallcopy_general\".ads', 'id'), "
+		"COALESCE((SELECT max(id) + 1 FROM \"smallcopy_general\".ads), 1), false)")
+
+
+
+def test_rewrite_steps(fake_cursor):
+	recording = fake_cursor()
+	cur = SchemaCursor(recording, schema="copy")
+
+	for name in ["initialize selection", "check tables", "alembic_version", "favorite"]:
+		_step(name).func(cur)
+
+	assert recording.statements[:2] == ['DROP SCHEMA IF EXISTS "copy_keys" CASCADE', 'CREATE SCHEMA "copy_keys"']
+	assert "SELECT table_name FROM information_schema.tables WHERE table_schema = 'copy'" in recording.statements
+	assert all("smallcopy" not in statement for statement in recording.statements)
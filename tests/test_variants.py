@@ -0,0 +1,11 @@
+from weasyl_smallcopy import copy_maximum_rating, copy_schemas
+
+
+def test_copy_maximum_rating():
+	assert copy_maximum_rating({"maximum_rating": "mature"}) == "mature"
+	assert copy_maximum_rating({"variants": ["general", "explicit", "mature"]}) == "explicit"
+
+
+def test_copy_schemas():
+	assert copy_schemas({"maximum_rating": "mature"}) == ["smallcopy"]
+	assert copy_schemas({"schema_name": "copy", "variants": ["explicit", "general", "mature"]}) == ["copy", "copy_general", "copy_mature"]
@@ -0,0 +1,23 @@
+from weasyl_smallcopy.verify import IMPLICIT_REFERENCES, Reference, _count_orphans, read_references
+
+
+def test_read_references(fake_cursor):
+	cur = fake_cursor({"pg_constraint": [
+		("submission", ["userid"], "login", ["userid"], "submission_userid_fkey", False),
+		("searchmapsubmit", ["targetid"], "submission", ["submitid"], "searchmapsubmit_targetid_fkey", True),
+	]})
+	references = read_references(cur)
+
+	# an unvalidated foreign key is checked by validating it, and a validated one replaces the same implicit reference
+	assert references[0] == Reference("submission", ["userid"], "login", ["userid"], None, "submission_userid_fkey")
+	assert references[1:] == [reference for reference in IMPLICIT_REFERENCES if reference.table != "searchmapsubmit"]
+
+
+def test_count_orphans(fake_cursor):
+	cur = fake_cursor({"count(*)": [(3,)]})
+
+	assert _count_orphans(cur, IMPLICIT_REFERENCES[0]) == 3
+	assert cur.statements == [
+		"SELECT count(*) FROM smallcopy.favorite t "
+		"WHERE t.targetid IS NOT NULL AND t.type = 's' AND NOT EXISTS (SELECT FROM smallcopy.submission r WHERE r.submitid = t.targetid)",
+	]
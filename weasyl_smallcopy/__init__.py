@@ -1,6 +1,35 @@
+import io
 import psycopg2
+import re
 import sys
 import time
+from collections import namedtuple
+from functools import partial
+
+from .checkpoint import has_checkpoints, run_checkpointed
+from .full_copy import read_user_columns, run_full_copy
+from .incremental import (
+	drop_foreign_keys,
+	run_merging,
+	smallcopy_exists,
+)
+from .planner import calibrate, estimate_steps
+from .progress import ProgressMonitor, read_baseline, run_monitored
+from .report import Recorder, record_step
+from .scheduler import export_snapshot, run_in_snapshot, run_parallel, selection_step_names
+from .schema import (
+	add_foreign_keys_not_valid,
+	build_schema_template,
+	execute_post_data,
+	make_unlogged,
+	read_schema,
+	set_tables_logged,
+	use_schema_template,
+	validate_foreign_keys,
+)
+from .streaming import SourcePool, run_streaming
+from .target_schema import DEFAULT_SCHEMA, lock_schemas, run_in_schema, schema_cursor
+from .variants import variant_name, variant_schema, variant_steps
 
 INCLUDE_ALL = "all"
 
@@ -10,6 +39,43 @@ RATING_CODES = {
 	"explicit": 40,
 }
 
+LOAD_MODES = frozenset({
+	"logged",
+	"unlogged",
+	"unlogged_then_logged",
+})
+
+# session settings for loading into unlogged tables, where nothing copied survives a crash anyway
+BULK_LOAD_SETTINGS = {
+	"synchronous_commit": "off",
+	"maintenance_work_mem": "512MB",
+}
+
+# the ids of the rows to copy, collected in advance (by the "select" steps) into indexed tables that the copying steps can join against cheaply
+SELECTION_TABLES = {
+	"users": "userid",
+	"submissions": "submitid",
+	"characters": "charid",
+	"journals": "journalid",
+	"media": "mediaid",
+	"tags": "tagid",
+	"comments": "commentid",
+	"charcomments": "commentid",
+	"journalcomments": "commentid",
+}
+
+# selections built one level of comment threads at a time, with two working tables for the current and next level
+COMMENT_THREAD_SELECTIONS = ["comments", "charcomments", "journalcomments"]
+
+# steps copied in ranges of primary key values when `chunk_size` is set
+CHUNKED_STEPS = frozenset({
+	"add necessary media entries",
+	"comments",
+	"favorite",
+	"searchmapsubmit",
+	"submission",
+})
+
 ignore_tables = [
 	"ads",
 	"api_tokens",
@@ -38,34 +104,43 @@ ignore_tables = [
 	"welcomecount",
 ]
 
+Step = namedtuple("Step", ["name", "func", "dependencies", "tables", "setup"])
+
 _defined_steps = set()
 step_tables = set(ignore_tables)
 steps = []
 
 
-def step(name, *, dependencies=frozenset(), tables=frozenset()):
+def step(name, *, dependencies=frozenset(), tables=frozenset(), setup=False):
 	def wrapper(func):
 		for dependency in dependencies:
 			if dependency not in _defined_steps:
 				raise ValueError(f"Step {name!r} must run after its dependency {dependency!r}")
 
-		steps.append((name, func))
+		steps.append(Step(name, func, frozenset(dependencies), frozenset(tables), setup))
 		_defined_steps.add(name)
 		step_tables.update(tables)
 
 	return wrapper
 
 
-@step("initialize schema")
-def schema_init(cur, **config):
-	with open("schema.sql", "r") as f:
-		schema_init_sql = f.read()
+def schema_init_sql(schema, *, defer_constraints, unlogged):
+	sql = schema.pre_data if defer_constraints else schema.sql
+	return make_unlogged(sql) if unlogged else sql
+
+
+@step("initialize schema", setup=True)
+def schema_init(cur, *, schema, defer_constraints, unlogged, schema_template=False, **config):
+	sql = schema_init_sql(schema, defer_constraints=defer_constraints, unlogged=unlogged)
 
-	cur.execute(schema_init_sql)
+	if schema_template and use_schema_template(cur, sql):
+		return "from template"
+
+	cur.execute(sql)
 	cur.execute("SET search_path = public")
 
 
-@step("check tables")
+@step("check tables", setup=True)
 def check_tables(cur, **config):
 	cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'smallcopy'")
 	database_tables = frozenset(name for name, in cur)
@@ -75,136 +150,360 @@ def check_tables(cur, **config):
 		raise RuntimeError(f"Tables missing step: {missing!r}")
 
 
-@step("alembic_version", tables=["alembic_version"])
-def copy_alembic_version(cur, **config):
-	cur.execute("INSERT INTO smallcopy.alembic_version SELECT * FROM alembic_version")
+@step("initialize selection", setup=True)
+def selection_init(cur, **config):
+	cur.execute("DROP SCHEMA IF EXISTS smallcopy_keys CASCADE")
+	cur.execute("CREATE SCHEMA smallcopy_keys")
+
+	for table, column in SELECTION_TABLES.items():
+		cur.execute(f"CREATE UNLOGGED TABLE smallcopy_keys.{table} ({column} integer NOT NULL)")
+
+	for table in COMMENT_THREAD_SELECTIONS:
+		for level in range(2):
+			cur.execute(f"CREATE UNLOGGED TABLE smallcopy_keys.{table}_level_{level} (commentid integer NOT NULL)")
+
+	# the users to include, before they're checked against login and deduplicated into users
+	cur.execute("CREATE UNLOGGED TABLE smallcopy_keys.include (userid integer NOT NULL, depth integer NOT NULL DEFAULT 0)")
+
+	# the steps (and parts of chunked steps) that have been committed, for resuming
+	cur.execute("CREATE UNLOGGED TABLE smallcopy_keys.checkpoints (step text PRIMARY KEY, statement integer, next_key bigint, finished boolean NOT NULL)")
+
+
+def drop_selection(cur, **config):
+	cur.execute("DROP SCHEMA smallcopy_keys CASCADE")
+
+
+def index_selection(cur, table):
+	cur.execute(f"ALTER TABLE smallcopy_keys.{table} ADD PRIMARY KEY ({SELECTION_TABLES[table]})")
+	cur.execute(f"ANALYZE smallcopy_keys.{table}")
+	cur.execute(f"SELECT count(*) FROM smallcopy_keys.{table}")
+	count, = cur.fetchone()
+	return f"{count} {table}"
+
+
+# Walks comment threads down from `roots` one level at a time, keeping the replies that are `visible` and written by included users, so hidden comments and comments by excluded users are dropped along with their replies. Each comment has one parent, so unlike a recursive UNION, no level needs to be deduplicated against the ones before it.
+def select_comment_threads(cur, table, *, source, roots, visible, params=None):
+	level_rows = []
+	cur.execute(f"INSERT INTO smallcopy_keys.{table}_level_0 (commentid) " + roots, params)
+
+	while cur.rowcount:
+		level_rows.append(cur.rowcount)
+		current = f"smallcopy_keys.{table}_level_{(len(level_rows) - 1) % 2}"
+		following = f"smallcopy_keys.{table}_level_{len(level_rows) % 2}"
+
+		cur.execute(f"INSERT INTO smallcopy_keys.{table} (commentid) SELECT commentid FROM {current}")
+		cur.execute(f"ANALYZE {current}")
+		cur.execute(f"TRUNCATE {following}")
+		cur.execute(f"""
+			INSERT INTO {following} (commentid)
+			SELECT c.commentid
+			FROM {source} c
+				INNER JOIN {current} p ON c.parentid = p.commentid
+				INNER JOIN smallcopy_keys.users u ON c.userid = u.userid
+			WHERE {visible}
+		""")
+
+	summary = index_selection(cur, table)
+	return f"{summary}, depth {len(level_rows)} ({'/'.join(map(str, level_rows))})"
+
+
+# Reads the `include` option into "all", a list of ids, or a selector for `select_users`.
+def read_include(include):
+	if include == INCLUDE_ALL or isinstance(include, list):
+		return include
+
+	if not isinstance(include, dict) or len(include.keys() & {"file", "query", "sample"}) != 1:
+		raise ValueError(f"include must be {INCLUDE_ALL!r}, a list of ids, or one of file, query or sample: {include!r}")
+
+	if "file" in include:
+		with open(include["file"], "r") as f:
+			return [int(userid) for userid in f.read().split()]
+
+	if "sample" in include and not include.keys() <= {"sample", "depth", "seed"}:
+		raise ValueError(f"Unknown sample options: {sorted(include.keys() - {'sample', 'depth', 'seed'})!r}")
 
+	return include
 
-@step("login", tables=["login"])
-def copy_login(cur, *, include, **config):
-	id_filter = "" if include == INCLUDE_ALL else "WHERE userid = ANY (%(include)s)"
 
+# Samples `sample` users and their social graph, `depth` levels deep.
+def sample_users(cur, *, sample, depth=1, seed=0):
+	# hashed rather than using setseed, which only seeds its own connection
 	cur.execute(
-		"INSERT INTO smallcopy.login (userid, login_name, last_login, settings, email) "
-		"SELECT userid, login_name, 0, regexp_replace(settings, '[^d]', ''), login_name || '@weasyl.com' FROM login " + id_filter,
-		{"include": include})
+		"INSERT INTO smallcopy_keys.include (userid) "
+		"SELECT userid FROM login ORDER BY md5(%(seed)s || ':' || userid), userid LIMIT %(sample)s",
+		{"sample": sample, "seed": str(seed)})
+
+	for level in range(1, depth + 1):
+		cur.execute("ANALYZE smallcopy_keys.include")
+		cur.execute("""
+			INSERT INTO smallcopy_keys.include (userid, depth)
+			SELECT DISTINCT n.userid, %(level)s
+			FROM (
+				SELECT otherid AS userid FROM watchuser INNER JOIN smallcopy_keys.include i USING (userid) WHERE i.depth = %(previous)s
+				UNION ALL SELECT watchuser.userid FROM watchuser INNER JOIN smallcopy_keys.include i ON watchuser.otherid = i.userid WHERE i.depth = %(previous)s
+				UNION ALL SELECT otherid FROM frienduser INNER JOIN smallcopy_keys.include i USING (userid) WHERE i.depth = %(previous)s AND position('p' in frienduser.settings) = 0
+				UNION ALL SELECT frienduser.userid FROM frienduser INNER JOIN smallcopy_keys.include i ON frienduser.otherid = i.userid WHERE i.depth = %(previous)s AND position('p' in frienduser.settings) = 0
+			) n
+			WHERE NOT EXISTS (SELECT FROM smallcopy_keys.include e WHERE e.userid = n.userid)
+		""", {"level": level, "previous": level - 1})
+
+
+@step("select users")
+def select_users(cur, *, include, **config):
+	if include == INCLUDE_ALL:
+		cur.execute(
+			"INSERT INTO smallcopy_keys.users (userid) "
+			"SELECT userid FROM login")
 
+		return index_selection(cur, "users")
+
+	if isinstance(include, dict) and "query" in include:
+		included = include["query"]
+	else:
+		if isinstance(include, dict):
+			sample_users(cur, **include)
+		else:
+			# loaded in bulk rather than sent as one array parameter, which the planner can't estimate
+			cur.copy_expert("COPY smallcopy_keys.include (userid) FROM STDIN", io.StringIO("".join(f"{userid}\n" for userid in include)))
+
+		cur.execute("ANALYZE smallcopy_keys.include")
+		included = "SELECT userid FROM smallcopy_keys.include"
 
-@step("authbcrypt", dependencies=["login"], tables=["authbcrypt"])
-def copy_authbcrypt(cur, **config):
 	cur.execute(
-		"INSERT INTO smallcopy.authbcrypt (userid, hashsum) "
-		"SELECT userid, '$2a$12$qReI924/8pAsoHu6aRTX2ejyujAZ/9FiOOtrjczBIwf8wqXAJ22N.' FROM authbcrypt INNER JOIN smallcopy.login USING (userid)")
+		"INSERT INTO smallcopy_keys.users (userid) "
+		"SELECT userid FROM login WHERE userid IN (" + included + ")")
+
+	return index_selection(cur, "users")
 
 
-@step("character", dependencies=["login"], tables=["character"])
-def copy_character(cur, *, max_rating, **config):
+@step("select submissions", dependencies=["select users"])
+def select_submissions(cur, *, max_rating, **config):
 	cur.execute("""
-		INSERT INTO smallcopy.character (charid, userid, unixtime, char_name, age, gender, height, weight, species, content, rating, settings, page_views)
-		SELECT charid, userid, unixtime, char_name, age, gender, height, weight, species, content, rating, character.settings, page_views
+		INSERT INTO smallcopy_keys.submissions (submitid)
+		SELECT submitid
+		FROM submission
+			INNER JOIN smallcopy_keys.users USING (userid)
+		WHERE rating <= %(max_rating)s AND submission.settings !~ '[hf]'
+	""", {"max_rating": max_rating})
+
+	return index_selection(cur, "submissions")
+
+
+@step("select characters", dependencies=["select users"])
+def select_characters(cur, *, max_rating, **config):
+	cur.execute("""
+		INSERT INTO smallcopy_keys.characters (charid)
+		SELECT charid
 		FROM character
-			INNER JOIN smallcopy.login USING (userid)
+			INNER JOIN smallcopy_keys.users USING (userid)
 		WHERE
 			rating <= %(max_rating)s AND
 			character.settings !~ '[hf]'
 	""", {"max_rating": max_rating})
 
+	return index_selection(cur, "characters")
 
-@step("charcomment", dependencies=["character", "login"], tables=["charcomment"])
-def copy_charcomment(cur, **config):
+
+@step("select journals", dependencies=["select users"])
+def select_journals(cur, *, max_rating, **config):
 	cur.execute("""
-		INSERT INTO smallcopy.charcomment (commentid, userid, targetid, parentid, content, unixtime, indent, settings, hidden_by)
+		INSERT INTO smallcopy_keys.journals (journalid)
+		SELECT journalid
+		FROM journal
+			INNER JOIN smallcopy_keys.users USING (userid)
+		WHERE
+			rating <= %(max_rating)s AND
+			journal.settings !~ '[hf]'
+	""", {"max_rating": max_rating})
+
+	return index_selection(cur, "journals")
+
+
+@step("select media", dependencies=["select submissions", "select users"])
+def select_media(cur, **config):
+	cur.execute("""
+		INSERT INTO smallcopy_keys.media (mediaid)
 		WITH RECURSIVE t AS (
-			SELECT commentid, charcomment.userid, targetid, parentid, charcomment.content, charcomment.unixtime, indent, charcomment.settings, hidden_by
+			SELECT mediaid FROM submission_media_links
+				INNER JOIN smallcopy_keys.submissions USING (submitid)
+			UNION SELECT mediaid FROM user_media_links
+				INNER JOIN smallcopy_keys.users USING (userid)
+			UNION SELECT described_with_id FROM media_media_links
+				INNER JOIN t ON describee_id = mediaid
+		)
+			SELECT mediaid FROM t
+	""")
+
+	return index_selection(cur, "media")
+
+
+@step("select tags", dependencies=["select characters", "select journals", "select submissions"])
+def select_tags(cur, **config):
+	cur.execute("""
+		INSERT INTO smallcopy_keys.tags (tagid)
+		SELECT tagid FROM searchmapchar INNER JOIN smallcopy_keys.characters ON targetid = charid
+		UNION SELECT tagid FROM searchmapjournal INNER JOIN smallcopy_keys.journals ON targetid = journalid
+		UNION SELECT tagid FROM searchmapsubmit INNER JOIN smallcopy_keys.submissions ON targetid = submitid
+	""")
+
+	return index_selection(cur, "tags")
+
+
+@step("select comments", dependencies=["select submissions", "select users"])
+def select_comments(cur, **config):
+	return select_comment_threads(
+		cur,
+		"comments",
+		source="comments",
+		roots="""
+			SELECT commentid
+			FROM comments
+				INNER JOIN smallcopy_keys.users co ON comments.userid = co.userid
+				LEFT JOIN smallcopy_keys.submissions ON target_sub = submitid
+				LEFT JOIN smallcopy_keys.users ct ON target_user = ct.userid
+			WHERE
+				(submitid IS NOT NULL OR ct.userid IS NOT NULL) AND
+				parentid IS NULL AND
+				comments.settings !~ '[hs]'
+		""",
+		visible="c.settings !~ '[hs]'",
+	)
+
+
+@step("select charcomments", dependencies=["select characters", "select users"])
+def select_charcomments(cur, **config):
+	return select_comment_threads(
+		cur,
+		"charcomments",
+		source="charcomment",
+		roots="""
+			SELECT commentid
 			FROM charcomment
-				INNER JOIN smallcopy.character ch ON targetid = charid
-				INNER JOIN smallcopy.login ccu ON charcomment.userid = ccu.userid
-				INNER JOIN smallcopy.login chu ON ch.userid = chu.userid
+				INNER JOIN smallcopy_keys.characters ON targetid = charid
+				INNER JOIN smallcopy_keys.users ccu ON charcomment.userid = ccu.userid
 			WHERE
 				parentid = 0 AND
 				charcomment.settings !~ '[hs]'
-			UNION SELECT charcomment.commentid, charcomment.userid, charcomment.targetid, charcomment.parentid, charcomment.content, charcomment.unixtime, charcomment.indent, charcomment.settings, charcomment.hidden_by
-			FROM charcomment
-				INNER JOIN t ON charcomment.parentid = t.commentid
-				INNER JOIN smallcopy.login ccu ON charcomment.userid = ccu.userid
-			WHERE charcomment.settings !~ '[hs]'
-		)
-			SELECT * FROM t
+		""",
+		visible="c.settings !~ '[hs]'",
+	)
+
+
+@step("select journalcomments", dependencies=["select journals", "select users"])
+def select_journalcomments(cur, **config):
+	return select_comment_threads(
+		cur,
+		"journalcomments",
+		source="journalcomment",
+		roots="""
+			SELECT commentid
+			FROM journalcomment
+				INNER JOIN smallcopy_keys.journals ON targetid = journalid
+				INNER JOIN smallcopy_keys.users jcu ON journalcomment.userid = jcu.userid
+			WHERE
+				parentid = 0 AND
+				position('h' in journalcomment.settings) = 0
+		""",
+		visible="position('h' in c.settings) = 0",
+	)
+
+
+@step("alembic_version", tables=["alembic_version"])
+def copy_alembic_version(cur, **config):
+	cur.execute("INSERT INTO smallcopy.alembic_version (version_num) SELECT version_num FROM alembic_version")
+
+
+@step("login", dependencies=["select users"], tables=["login"])
+def copy_login(cur, **config):
+	cur.execute(
+		"INSERT INTO smallcopy.login (userid, login_name, last_login, settings, email) "
+		"SELECT userid, login_name, 0, regexp_replace(settings, '[^d]', ''), login_name || '@weasyl.com' FROM login INNER JOIN smallcopy_keys.users USING (userid)")
+
+
+@step("authbcrypt", dependencies=["login", "select users"], tables=["authbcrypt"])
+def copy_authbcrypt(cur, **config):
+	cur.execute(
+		"INSERT INTO smallcopy.authbcrypt (userid, hashsum) "
+		"SELECT userid, '$2a$12$qReI924/8pAsoHu6aRTX2ejyujAZ/9FiOOtrjczBIwf8wqXAJ22N.' FROM authbcrypt INNER JOIN smallcopy_keys.users USING (userid)")
+
+
+@step("character", dependencies=["login", "select characters"], tables=["character"])
+def copy_character(cur, **config):
+	cur.execute("""
+		INSERT INTO smallcopy.character (charid, userid, unixtime, char_name, age, gender, height, weight, species, content, rating, settings, page_views)
+		SELECT charid, userid, unixtime, char_name, age, gender, height, weight, species, content, rating, character.settings, page_views
+		FROM character
+			INNER JOIN smallcopy_keys.characters USING (charid)
+	""")
+
+
+@step("charcomment", dependencies=["character", "login", "select charcomments"], tables=["charcomment"])
+def copy_charcomment(cur, **config):
+	cur.execute("""
+		INSERT INTO smallcopy.charcomment (commentid, userid, targetid, parentid, content, unixtime, indent, settings, hidden_by)
+		SELECT commentid, userid, targetid, parentid, content, unixtime, indent, settings, hidden_by
+		FROM charcomment
+			INNER JOIN smallcopy_keys.charcomments USING (commentid)
 	""")
 
 
-@step("folder", dependencies=["login"], tables=["folder"])
+@step("folder", dependencies=["login", "select users"], tables=["folder"])
 def copy_folder(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.folder (folderid, parentid, userid, title, settings) "
-		"SELECT folderid, parentid, userid, title, folder.settings FROM folder INNER JOIN smallcopy.login USING (userid)")
+		"SELECT folderid, parentid, userid, title, folder.settings FROM folder INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("submission", dependencies=["login"], tables=["submission"])
-def copy_submission(cur, *, max_rating, **config):
+@step("submission", dependencies=["login", "select submissions"], tables=["submission"])
+def copy_submission(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.submission (submitid, folderid, userid, unixtime, title, content, subtype, rating, settings, page_views, sorttime, fave_count)
 		SELECT submitid, folderid, userid, unixtime, title, content, subtype, rating, submission.settings, page_views, sorttime, fave_count
 		FROM submission
-			INNER JOIN smallcopy.login USING (userid)
-		WHERE rating <= %(max_rating)s AND submission.settings !~ '[hf]'
-	""", {"max_rating": max_rating})
+			INNER JOIN smallcopy_keys.submissions USING (submitid)
+	""")
 
 
-@step("collection", dependencies=["login", "submission"], tables=["collection"])
+@step("collection", dependencies=["login", "select submissions", "select users", "submission"], tables=["collection"])
 def copy_collection(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.collection (userid, submitid, unixtime, settings)
 		SELECT collection.userid, submitid, collection.unixtime, collection.settings
 		FROM collection
-			INNER JOIN smallcopy.submission USING (submitid)
-			INNER JOIN smallcopy.login cu ON collection.userid = cu.userid
+			INNER JOIN smallcopy_keys.submissions USING (submitid)
+			INNER JOIN smallcopy_keys.users cu ON collection.userid = cu.userid
 	""")
 
 
-@step("comments", dependencies=["login", "submission"], tables=["comments"])
+@step("comments", dependencies=["login", "select comments", "submission"], tables=["comments"])
 def copy_comments(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.comments (commentid, userid, target_user, target_sub, parentid, content, unixtime, indent, settings, hidden_by)
-		WITH RECURSIVE t AS (
-			SELECT commentid, comments.userid, target_user, target_sub, parentid, comments.content, comments.unixtime, indent, comments.settings, hidden_by
-			FROM comments
-				INNER JOIN smallcopy.login co ON comments.userid = co.userid
-				LEFT JOIN smallcopy.submission ON target_sub = submitid
-				LEFT JOIN smallcopy.login ct ON target_user = ct.userid
-			WHERE
-				(submitid IS NOT NULL OR ct.userid IS NOT NULL) AND
-				parentid IS NULL AND
-				comments.settings !~ '[hs]'
-			UNION SELECT comments.commentid, comments.userid, comments.target_user, comments.target_sub, comments.parentid, comments.content, comments.unixtime, comments.indent, comments.settings, comments.hidden_by
-			FROM comments
-				INNER JOIN t ON comments.parentid = t.commentid
-				INNER JOIN smallcopy.login co ON comments.userid = co.userid
-			WHERE comments.settings !~ '[hs]'
-		)
-			SELECT * FROM t
+		SELECT commentid, userid, target_user, target_sub, parentid, content, unixtime, indent, settings, hidden_by
+		FROM comments
+			INNER JOIN smallcopy_keys.comments USING (commentid)
 	""")
 
 
-@step("commishclass", dependencies=["login"], tables=["commishclass"])
+@step("commishclass", dependencies=["login", "select users"], tables=["commishclass"])
 def copy_commishclass(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.commishclass (classid, userid, title) "
-		"SELECT classid, userid, title FROM commishclass INNER JOIN smallcopy.login USING (userid)")
+		"SELECT classid, userid, title FROM commishclass INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("commishdesc", dependencies=["login"], tables=["commishdesc"])
+@step("commishdesc", dependencies=["login", "select users"], tables=["commishdesc"])
 def copy_commishdesc(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.commishdesc (userid, content) "
-		"SELECT userid, content FROM commishdesc INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, content FROM commishdesc INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("commishprice", dependencies=["commishclass", "login"], tables=["commishprice"])
+@step("commishprice", dependencies=["commishclass", "login", "select users"], tables=["commishprice"])
 def copy_commishprice(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.commishprice (priceid, classid, userid, title, amount_min, amount_max, settings) "
-		"SELECT priceid, classid, userid, title, amount_min, amount_max, commishprice.settings FROM commishprice INNER JOIN smallcopy.login USING (userid)")
+		"SELECT priceid, classid, userid, title, amount_min, amount_max, commishprice.settings FROM commishprice INNER JOIN smallcopy_keys.users USING (userid)")
 
 
 @step("cron_runs", tables=["cron_runs"])
@@ -212,30 +511,31 @@ def copy_cron_runs(cur, **config):
 	cur.execute("INSERT INTO smallcopy.cron_runs (last_run) SELECT last_run FROM cron_runs")
 
 
-@step("journal", dependencies=["login"], tables=["journal"])
-def copy_journal(cur, *, max_rating, **config):
+@step("journal", dependencies=["login", "select journals"], tables=["journal"])
+def copy_journal(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.journal (journalid, userid, title, content, rating, unixtime, settings, page_views)
 		SELECT journalid, userid, title, content, rating, unixtime, journal.settings, page_views
 		FROM journal
-			INNER JOIN smallcopy.login USING (userid)
-		WHERE
-			rating <= %(max_rating)s AND
-			journal.settings !~ '[hf]'
-	""", {"max_rating": max_rating})
+			INNER JOIN smallcopy_keys.journals USING (journalid)
+	""")
 
 
-@step("favorite", dependencies=["character", "journal", "login", "submission"], tables=["favorite"])
+@step(
+	"favorite",
+	dependencies=["character", "journal", "login", "select characters", "select journals", "select submissions", "select users", "submission"],
+	tables=["favorite"],
+)
 def copy_favorite(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.favorite (userid, targetid, type, unixtime, settings)
 		SELECT favorite.userid, targetid, type, favorite.unixtime, favorite.settings
 		FROM favorite
-			INNER JOIN smallcopy.login fu ON favorite.userid = fu.userid
+			INNER JOIN smallcopy_keys.users fu ON favorite.userid = fu.userid
 			INNER JOIN profile ON favorite.userid = profile.userid
-			LEFT JOIN smallcopy.submission ON favorite.type = 's' AND favorite.targetid = submission.submitid
-			LEFT JOIN smallcopy.character ON favorite.type = 'f' AND favorite.targetid = character.charid
-			LEFT JOIN smallcopy.journal ON favorite.type = 'j' AND favorite.targetid = journal.journalid
+			LEFT JOIN smallcopy_keys.submissions ON favorite.type = 's' AND favorite.targetid = submissions.submitid
+			LEFT JOIN smallcopy_keys.characters ON favorite.type = 'f' AND favorite.targetid = characters.charid
+			LEFT JOIN smallcopy_keys.journals ON favorite.type = 'j' AND favorite.targetid = journals.journalid
 		WHERE profile.config !~ '[hv]' AND (
 			submitid IS NOT NULL OR
 			charid IS NOT NULL OR
@@ -243,51 +543,39 @@ def copy_favorite(cur, **config):
 	""")
 
 
-@step("frienduser", dependencies=["login"], tables=["frienduser"])
+@step("frienduser", dependencies=["login", "select users"], tables=["frienduser"])
 def copy_frienduser(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.frienduser (userid, otherid, settings, unixtime)
 		SELECT frienduser.userid, otherid, frienduser.settings, unixtime
 		FROM frienduser
-			INNER JOIN smallcopy.login fu ON frienduser.userid = fu.userid
-			INNER JOIN smallcopy.login fo ON frienduser.otherid = fo.userid
+			INNER JOIN smallcopy_keys.users fu ON frienduser.userid = fu.userid
+			INNER JOIN smallcopy_keys.users fo ON frienduser.otherid = fo.userid
 		WHERE position('p' in frienduser.settings) = 0
 	""")
 
 
-@step("google_doc_embeds", dependencies=["submission"], tables=["google_doc_embeds"])
+@step("google_doc_embeds", dependencies=["select submissions", "submission"], tables=["google_doc_embeds"])
 def copy_google_doc_embeds(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.google_doc_embeds (submitid, embed_url)
 		SELECT submitid, embed_url
 		FROM google_doc_embeds
-			INNER JOIN smallcopy.submission USING (submitid)
+			INNER JOIN smallcopy_keys.submissions USING (submitid)
 	""")
 
 
-@step("journalcomment", dependencies=["journal", "login"], tables=["journalcomment"])
+@step("journalcomment", dependencies=["journal", "login", "select journalcomments"], tables=["journalcomment"])
 def copy_journalcomment(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.journalcomment (commentid, userid, targetid, parentid, content, unixtime, indent, settings, hidden_by)
-		WITH RECURSIVE t AS (
-			SELECT commentid, journalcomment.userid, targetid, parentid, journalcomment.content, journalcomment.unixtime, indent, journalcomment.settings, hidden_by
-			FROM journalcomment
-				INNER JOIN smallcopy.journal ON targetid = journalid
-				INNER JOIN smallcopy.login jcu ON journalcomment.userid = jcu.userid
-			WHERE
-				parentid = 0 AND
-				position('h' in journalcomment.settings) = 0
-			UNION SELECT journalcomment.commentid, journalcomment.userid, journalcomment.targetid, journalcomment.parentid, journalcomment.content, journalcomment.unixtime, journalcomment.indent, journalcomment.settings, journalcomment.hidden_by
-			FROM journalcomment
-				INNER JOIN t ON journalcomment.parentid = t.commentid
-				INNER JOIN smallcopy.login jcu ON journalcomment.userid = jcu.userid
-			WHERE position('h' in journalcomment.settings) = 0
-		)
-			SELECT * FROM t
+		SELECT commentid, userid, targetid, parentid, content, unixtime, indent, settings, hidden_by
+		FROM journalcomment
+			INNER JOIN smallcopy_keys.journalcomments USING (commentid)
 	""")
 
 
-@step("profile", dependencies=["login"], tables=["profile"])
+@step("profile", dependencies=["login", "select users"], tables=["profile"])
 def copy_profile(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.profile (userid, username, full_name, catchphrase, artist_type, unixtime, profile_text, settings, stream_url, page_views, config, jsonb_settings, stream_time, stream_text)
@@ -297,176 +585,154 @@ def copy_profile(cur, **config):
 			regexp_replace(config, '[ap]|^(?=[^ap]*$)', ('{"",a,p}'::text[])[('x' || md5(username))::bit(8)::integer % 3 + 1]),
 			jsonb_settings, stream_time, stream_text
 		FROM profile
-			INNER JOIN smallcopy.login USING (userid)
+			INNER JOIN smallcopy_keys.users USING (userid)
 	""")
 
 
-@step("searchtag", tables=["searchtag"])
+@step("searchtag", dependencies=["select tags"], tables=["searchtag"])
 def copy_searchtag(cur, **config):
-	cur.execute("""
-		INSERT INTO smallcopy.searchtag (tagid, title)
-		SELECT tagid, title
-		FROM (
-			SELECT tagid FROM searchmapchar INNER JOIN smallcopy.character ON targetid = charid
-			UNION SELECT tagid FROM searchmapjournal INNER JOIN smallcopy.journal ON targetid = journalid
-			UNION SELECT tagid FROM searchmapsubmit INNER JOIN smallcopy.submission ON targetid = submitid
-		) AS t
-			INNER JOIN searchtag USING (tagid)
-	""")
+	cur.execute(
+		"INSERT INTO smallcopy.searchtag (tagid, title) "
+		"SELECT tagid, title FROM searchtag INNER JOIN smallcopy_keys.tags USING (tagid)")
 
 
-@step("searchmapchar", dependencies=["character", "searchtag"], tables=["searchmapchar"])
+@step("searchmapchar", dependencies=["character", "searchtag", "select characters"], tables=["searchmapchar"])
 def copy_searchmapchar(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.searchmapchar (tagid, targetid, settings) "
-		"SELECT tagid, targetid, searchmapchar.settings FROM searchmapchar INNER JOIN smallcopy.character ON targetid = charid")
+		"SELECT tagid, targetid, searchmapchar.settings FROM searchmapchar INNER JOIN smallcopy_keys.characters ON targetid = charid")
 
 
-@step("searchmapjournal", dependencies=["journal", "searchtag"], tables=["searchmapjournal"])
+@step("searchmapjournal", dependencies=["journal", "searchtag", "select journals"], tables=["searchmapjournal"])
 def copy_searchmapjournal(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.searchmapjournal (tagid, targetid, settings) "
-		"SELECT tagid, targetid, searchmapjournal.settings FROM searchmapjournal INNER JOIN smallcopy.journal ON targetid = journalid")
+		"SELECT tagid, targetid, searchmapjournal.settings FROM searchmapjournal INNER JOIN smallcopy_keys.journals ON targetid = journalid")
 
 
-@step("searchmapsubmit", dependencies=["searchtag", "submission"], tables=["searchmapsubmit"])
+@step("searchmapsubmit", dependencies=["searchtag", "select submissions", "submission"], tables=["searchmapsubmit"])
 def copy_searchmapsubmit(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.searchmapsubmit (tagid, targetid, settings) "
-		"SELECT tagid, targetid, searchmapsubmit.settings FROM searchmapsubmit INNER JOIN smallcopy.submission ON targetid = submitid")
+		"SELECT tagid, targetid, searchmapsubmit.settings FROM searchmapsubmit INNER JOIN smallcopy_keys.submissions ON targetid = submitid")
 
 
-@step("submission_tags", dependencies=["searchtag", "submission"], tables=["submission_tags"])
+@step("submission_tags", dependencies=["searchtag", "select submissions", "submission"], tables=["submission_tags"])
 def copy_submission_tags(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.submission_tags (submitid, tags) "
-		"SELECT submitid, tags FROM submission_tags INNER JOIN smallcopy.submission USING (submitid)")
+		"SELECT submitid, tags FROM submission_tags INNER JOIN smallcopy_keys.submissions USING (submitid)")
 
 
-@step("siteupdate", dependencies=["login"], tables=["siteupdate"])
+@step("siteupdate", dependencies=["login", "select users"], tables=["siteupdate"])
 def copy_siteupdate(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.siteupdate (updateid, userid, title, content, unixtime) "
-		"SELECT updateid, userid, title, content, unixtime FROM siteupdate INNER JOIN smallcopy.login USING (userid)")
+		"SELECT updateid, userid, title, content, unixtime FROM siteupdate INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("tag_updates", dependencies=["login", "submission"], tables=["tag_updates"])
+@step("tag_updates", dependencies=["login", "select submissions", "select users", "submission"], tables=["tag_updates"])
 def copy_tag_updates(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.tag_updates (updateid, submitid, userid, added, removed, updated_at) "
-		"SELECT updateid, submitid, tag_updates.userid, added, removed, updated_at FROM tag_updates INNER JOIN smallcopy.submission USING (submitid) INNER JOIN smallcopy.login ON tag_updates.userid = login.userid")
+		"SELECT updateid, submitid, tag_updates.userid, added, removed, updated_at FROM tag_updates INNER JOIN smallcopy_keys.submissions USING (submitid) INNER JOIN smallcopy_keys.users ON tag_updates.userid = users.userid")
 
 
-@step("user_links", dependencies=["login"], tables=["user_links"])
+@step("user_links", dependencies=["login", "select users"], tables=["user_links"])
 def copy_user_links(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.user_links (linkid, userid, link_type, link_value) "
-		"SELECT linkid, userid, link_type, link_value FROM user_links INNER JOIN smallcopy.login USING (userid)")
+		"SELECT linkid, userid, link_type, link_value FROM user_links INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("user_streams", dependencies=["login"], tables=["user_streams"])
+@step("user_streams", dependencies=["login", "select users"], tables=["user_streams"])
 def copy_user_streams(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.user_streams (userid, start_time, end_time) "
-		"SELECT userid, start_time, end_time FROM user_streams INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, start_time, end_time FROM user_streams INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("user_timezones", dependencies=["login"], tables=["user_timezones"])
+@step("user_timezones", dependencies=["login", "select users"], tables=["user_timezones"])
 def copy_user_timezones(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.user_timezones (userid, timezone) "
-		"SELECT userid, timezone FROM user_timezones INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, timezone FROM user_timezones INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("useralias", dependencies=["login"], tables=["useralias"])
+@step("useralias", dependencies=["login", "select users"], tables=["useralias"])
 def copy_useralias(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.useralias (userid, alias_name, settings) "
-		"SELECT userid, alias_name, useralias.settings FROM useralias INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, alias_name, useralias.settings FROM useralias INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("userinfo", dependencies=["login"], tables=["userinfo"])
+@step("userinfo", dependencies=["login", "select users"], tables=["userinfo"])
 def copy_userinfo(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.userinfo (userid, birthday, gender, country) "
-		"SELECT userid, 0, gender, country FROM userinfo INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, 0, gender, country FROM userinfo INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("userpremium", dependencies=["login"], tables=["userpremium"])
+@step("userpremium", dependencies=["login", "select users"], tables=["userpremium"])
 def copy_userpremium(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.userpremium (userid, unixtime, terms) "
-		"SELECT userid, unixtime, terms FROM userpremium INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, unixtime, terms FROM userpremium INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("userstats", dependencies=["login"], tables=["userstats"])
+@step("userstats", dependencies=["login", "select users"], tables=["userstats"])
 def copy_userstats(cur, **config):
 	cur.execute(
 		"INSERT INTO smallcopy.userstats (userid, page_views, submit_views, followers, faved_works, journals, submits, characters, collects, faves) "
-		"SELECT userid, page_views, submit_views, followers, faved_works, journals, submits, characters, collects, faves FROM userstats INNER JOIN smallcopy.login USING (userid)")
+		"SELECT userid, page_views, submit_views, followers, faved_works, journals, submits, characters, collects, faves FROM userstats INNER JOIN smallcopy_keys.users USING (userid)")
 
 
-@step("watchuser", dependencies=["login"], tables=["watchuser"])
+@step("watchuser", dependencies=["login", "select users"], tables=["watchuser"])
 def copy_watchuser(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.watchuser (userid, otherid, settings, unixtime)
 		SELECT watchuser.userid, otherid, watchuser.settings, unixtime
 		FROM watchuser
-			INNER JOIN smallcopy.login u USING (userid)
-			INNER JOIN smallcopy.login o ON otherid = o.userid
+			INNER JOIN smallcopy_keys.users u USING (userid)
+			INNER JOIN smallcopy_keys.users o ON otherid = o.userid
 	""")
 
 
 @step(
 	"add necessary media entries",
-	dependencies=["login", "submission"],
+	dependencies=["login", "select media", "select submissions", "select users", "submission"],
 	tables=["disk_media", "media", "media_media_links", "submission_media_links", "user_media_links"],
 )
 def copy_media(cur, **config):
 	cur.execute("""
 		INSERT INTO smallcopy.media (mediaid, media_type, file_type, attributes, sha256)
-		WITH RECURSIVE t AS (
-			SELECT mediaid FROM submission_media_links
-				INNER JOIN smallcopy.submission USING (submitid)
-			UNION SELECT mediaid FROM user_media_links
-				INNER JOIN smallcopy.login USING (userid)
-			UNION SELECT described_with_id FROM media_media_links
-				INNER JOIN t ON describee_id = mediaid
-		)
-			SELECT mediaid, media_type, file_type, attributes, sha256 FROM t INNER JOIN media USING (mediaid)
+		SELECT mediaid, media_type, file_type, attributes, sha256 FROM media
+			INNER JOIN smallcopy_keys.media USING (mediaid)
 	""")
 
 	cur.execute("""
 		INSERT INTO smallcopy.submission_media_links (linkid, mediaid, submitid, link_type)
 		SELECT linkid, mediaid, submitid, link_type FROM submission_media_links
-			INNER JOIN smallcopy.submission USING (submitid)
+			INNER JOIN smallcopy_keys.submissions USING (submitid)
 	""")
 
 	cur.execute("""
 		INSERT INTO smallcopy.user_media_links (linkid, mediaid, userid, link_type)
 		SELECT linkid, mediaid, userid, link_type FROM user_media_links
-			INNER JOIN smallcopy.login USING (userid)
+			INNER JOIN smallcopy_keys.users USING (userid)
 	""")
 
 	cur.execute("""
 		INSERT INTO smallcopy.disk_media (mediaid, file_path, file_url)
 		SELECT mediaid, file_path, file_url FROM disk_media
-			INNER JOIN smallcopy.media USING (mediaid)
+			INNER JOIN smallcopy_keys.media USING (mediaid)
 	""")
 
 	cur.execute("""
 		INSERT INTO smallcopy.media_media_links (linkid, described_with_id, describee_id, link_type)
-		WITH RECURSIVE t AS (
-			SELECT mediaid FROM submission_media_links
-				INNER JOIN smallcopy.submission USING (submitid)
-			UNION SELECT mediaid FROM user_media_links
-				INNER JOIN smallcopy.login USING (userid)
-			UNION SELECT described_with_id FROM media_media_links
-				INNER JOIN t ON describee_id = mediaid
-		)
-			SELECT linkid, described_with_id, describee_id, link_type
-			FROM media_media_links
-				INNER JOIN t ON describee_id = t.mediaid
+		SELECT linkid, described_with_id, describee_id, link_type
+		FROM media_media_links
+			INNER JOIN smallcopy_keys.media ON describee_id = mediaid
 	""")
 
 
@@ -487,6 +753,7 @@ def copy_media(cur, **config):
 		"siteupdate",
 		"submission",
 		"tag_updates",
+		"user_links",
 	],
 )
 def update_sequences(cur, **config):
@@ -518,11 +785,12 @@ def update_sequences(cur, **config):
 		("welcome", "welcomeid"),
 	]
 
-	cur.execute("SELECT 'smallcopy.' || sequence_name FROM information_schema.sequences WHERE sequence_schema = 'smallcopy'")
+	# compared as regclass names, which are quoted the same way
+	cur.execute("SELECT (quote_ident('smallcopy') || '.' || quote_ident(sequence_name))::regclass::text FROM information_schema.sequences WHERE sequence_schema = 'smallcopy'")
 	database_sequences = frozenset(name for name, in cur)
 
 	cur.execute(
-		"SELECT pg_get_serial_sequence('smallcopy.' || table_name::text, column_name::text) "
+		"SELECT pg_get_serial_sequence('smallcopy.' || table_name::text, column_name::text)::regclass::text "
 		"FROM UNNEST (%(sequences)s) AS t (table_name unknown, column_name unknown)",
 		{'sequences': sequences},
 	)
@@ -538,27 +806,577 @@ def update_sequences(cur, **config):
 			.format(table="smallcopy." + table, column=column))
 
 
-def main(config):
-	max_name_length = max(len(name) for name, func in steps)
-	time_format_string = "\x1b[u\x1b[32m✓\x1b[0m {:%d} \x1b[2m{:6.2f}s\x1b[0m" % (max_name_length,)
+def post_data_steps(post_data, table_steps):
+	data_steps = frozenset(table_steps.values())
+	table_objects = {}
+	foreign_keys = []
+	remaining = []
+
+	for post_data_object in post_data:
+		if post_data_object.table is None:
+			remaining.append(post_data_object)
+		elif post_data_object.type in ("CONSTRAINT", "INDEX"):
+			table_objects.setdefault(post_data_object.table, []).append(post_data_object)
+		elif post_data_object.type == "FK CONSTRAINT":
+			foreign_keys.append(post_data_object)
+		else:
+			remaining.append(post_data_object)
+
+	# indexes and unique constraints on a table are built as soon as the step filling it is done, in parallel with other steps
+	index_steps = []
+
+	for table, objects in table_objects.items():
+		table_name = table.strip('"')
+		table_step = table_steps.get(table_name)
+		index_steps.append(Step(
+			f"indexes on {table_name}",
+			partial(execute_post_data, objects=objects),
+			frozenset() if table_step is None else frozenset({table_step}),
+			frozenset(),
+			False,
+		))
+
+	built = data_steps | {step.name for step in index_steps}
+
+	return index_steps + foreign_key_steps(foreign_keys, built) + [
+		Step("triggers and rules", partial(execute_post_data, objects=remaining), built, frozenset(), False),
+	]
+
+
+# foreign keys are added NOT VALID, then validated per table
+def foreign_key_steps(foreign_keys, dependencies):
+	foreign_key_tables = {}
+
+	for foreign_key in foreign_keys:
+		foreign_key_tables.setdefault(foreign_key.table.strip('"'), []).append(foreign_key)
+
+	return [
+		Step("add foreign keys", partial(add_foreign_keys_not_valid, objects=foreign_keys), frozenset(dependencies), frozenset(), False),
+		*(
+			Step(f"validate foreign keys on {table}", partial(validate_foreign_keys, objects=objects), frozenset({"add foreign keys"}), frozenset(), False)
+			for table, objects in foreign_key_tables.items()
+		),
+	]
+
+
+# The tables on either side of the foreign keys in `post_data`.
+def foreign_key_tables(post_data):
+	tables = set()
+
+	for post_data_object in post_data:
+		if post_data_object.type == "FK CONSTRAINT":
+			referenced = re.search(r"\bREFERENCES\s+(?:ONLY\s+)?([\w.\"]+)\s*\(", post_data_object.sql)
+			tables.add(post_data_object.table.strip('"'))
+
+			if referenced is not None:
+				tables.add(referenced.group(1).split(".")[-1].strip('"'))
+
+	return tables
+
+
+def analyze_tables(cur, *, tables, **config):
+	row_estimates = "SELECT c.relname, c.reltuples FROM pg_class c INNER JOIN pg_namespace n ON c.relnamespace = n.oid WHERE n.nspname = 'smallcopy' AND c.relname = ANY (%(tables)s)"
+	cur.execute(row_estimates, {"tables": tables})
+	before = dict(cur.fetchall())
+
+	for table in tables:
+		cur.execute(f"ANALYZE smallcopy.{table}")
+
+	cur.execute(row_estimates, {"tables": tables})
+	after = dict(cur.fetchall())
+	return ", ".join(f"{table} {max(before.get(table, 0), 0):,.0f} → {after.get(table, 0):,.0f} rows" for table in tables)
+
+
+# Follows each step filling tables that later steps read with an ANALYZE of them.
+def analyze_steps(run_steps, read_tables):
+	for step in run_steps:
+		yield step
+
+		if step.tables & read_tables:
+			yield Step(f"analyze {step.name}", partial(analyze_tables, tables=sorted(step.tables & read_tables)), frozenset({step.name}), frozenset(), False)
+
+
+def truncate_tables(cur, *, tables, **config):
+	cur.execute("TRUNCATE " + ", ".join(f"smallcopy.{table}" for table in tables))
+
+
+# The steps that rerun `only`, `rebuild_from` and their dependents on an existing copy.
+def rebuild_steps(foreign_keys, *, only, rebuild_from):
+	steps_by_name = {step.name: step for step in steps}
+
+	for name in only + rebuild_from:
+		if name not in steps_by_name:
+			raise ValueError(f"Unknown step: {name!r}")
+
+	rebuilt = set(rebuild_from)
+	added = True
+
+	while added:
+		dependents = {step.name for step in steps if step.dependencies & rebuilt} - rebuilt
+		rebuilt |= dependents
+		added = bool(dependents)
+
+	rebuilt |= set(only) | {"update sequences"}
+
+	# selections are dropped after every run, so the ones needed are made again
+	selections = set()
+	pending = [dependency for name in rebuilt for dependency in steps_by_name[name].dependencies]
+
+	while pending:
+		name = pending.pop()
+
+		if name not in selections and not steps_by_name[name].tables:
+			selections.add(name)
+			pending.extend(steps_by_name[name].dependencies)
+
+	tables = sorted(table for name in rebuilt for table in steps_by_name[name].tables)
+
+	return [
+		Step("drop foreign keys", partial(drop_foreign_keys, objects=foreign_keys), frozenset(), frozenset(), True),
+		# selections and update sequences fill no tables
+		*([Step("truncate tables", partial(truncate_tables, tables=tables), frozenset(), frozenset(), True)] if tables else []),
+		*(step for step in steps if step.name == "initialize selection" or step.name in rebuilt | selections),
+		*foreign_key_steps(foreign_keys, frozenset(rebuilt)),
+	]
+
+
+def refresh_steps(foreign_keys):
+	data_steps = frozenset(step.name for step in steps if step.tables)
+
+	return [
+		Step("drop foreign keys", partial(drop_foreign_keys, objects=foreign_keys), frozenset(), frozenset(), True),
+		*(
+			step._replace(func=partial(run_merging, func=step.func)) if step.tables else step
+			for step in steps
+			# the copy is refreshed in place, so its schema isn't dropped and created again
+			if step.name != "initialize schema"
+		),
+		*foreign_key_steps(foreign_keys, data_steps),
+	]
+
+
+def connect(database, settings=None):
+	if isinstance(database, str):
+		db = psycopg2.connect(database)
+	else:
+		db = psycopg2.connect(**database)
+
+	with db, db.cursor() as cur:
+		for name, value in (settings or {}).items():
+			cur.execute("SELECT set_config(%(name)s, %(value)s, false)", {"name": name, "value": value})
+
+	return db
+
+
+def current_wal_location(cur):
+	function = "pg_current_wal_lsn" if cur.connection.server_version >= 100000 else "pg_current_xlog_location"
+	cur.execute(f"SELECT {function}()::text")
+	return cur.fetchone()[0]
+
+
+def wal_bytes_since(cur, location):
+	function = "pg_wal_lsn_diff" if cur.connection.server_version >= 100000 else "pg_xlog_location_diff"
+	function_now = "pg_current_wal_lsn" if cur.connection.server_version >= 100000 else "pg_current_xlog_location"
+	cur.execute(f"SELECT {function}({function_now}(), %(location)s)::bigint", {"location": location})
+	return cur.fetchone()[0]
+
+
+def step_time_format(max_name_length):
+	return "\x1b[32m✓\x1b[0m {:%d} \x1b[2m{:6.2f}s\x1b[0m" % (max_name_length,)
+
+
+def format_size(size):
+	for unit in ["B", "KiB", "MiB", "GiB"]:
+		if abs(size) < 1024:
+			break
+
+		size /= 1024
+	else:
+		unit = "TiB"
+
+	return f"{size:6.1f} {unit}"
+
+
+def print_progress(progress):
+	parts = []
+
+	if progress.rows is not None:
+		rows_per_second = "" if progress.rows_per_second is None else f" ({progress.rows_per_second:,.0f}/s)"
+		parts.append(("~" if progress.rows_estimated else "") + f"{progress.rows:,.0f} rows{rows_per_second}")
+
+	if progress.bytes is not None:
+		bytes_per_second = "" if progress.bytes_per_second is None else f" ({format_size(progress.bytes_per_second).strip()}/s)"
+		parts.append(format_size(progress.bytes).strip() + bytes_per_second)
+
+	if progress.phase is not None:
+		parts.append(progress.phase)
+
+	if progress.eta_seconds is not None:
+		parts.append(f"ETA {progress.eta_seconds:.0f}s")
+
+	parts.append(f"{progress.state}" + ("" if progress.wait_event is None else f", waiting on {progress.wait_event}"))
+	print(f"  {progress.step} at {progress.seconds:.0f}s: " + ", ".join(parts), file=sys.stderr, flush=True)
+
+
+# The rating of the copy that the other variants are made from.
+def copy_maximum_rating(config):
+	variants = config.get("variants", [])
+	return max(variants, key=RATING_CODES.get) if variants else config["maximum_rating"]
+
+
+# The schemas a run builds: the target schema and one for each lower variant.
+def copy_schemas(config):
+	target_schema = config.get("schema_name", DEFAULT_SCHEMA)
+	variants = config.get("variants", [])
+	return [target_schema] + [variant_schema(target_schema, rating) for rating in sorted(set(variants) - {copy_maximum_rating(config)}, key=RATING_CODES.get)]
+
+
+def main(config, *, report=None, explain=False, resume=False, progress=False, progress_baseline=None, progress_log=None, only=(), rebuild_from=()):
+	defer_constraints = config.get("defer_constraints", False)
+	load_mode = config.get("load_mode", "logged")
+
+	if load_mode not in LOAD_MODES:
+		raise ValueError(f"Unknown load mode: {load_mode!r}")
+
+	unlogged = load_mode != "logged"
+	session_settings = BULK_LOAD_SETTINGS if unlogged else {}
+	workers = config.get("workers", 1)
+
+	# with one worker, the template would be built in series with the copy, taking as long as it saves
+	if config.get("schema_template", False) and workers == 1:
+		raise ValueError("schema_template requires more than one worker")
+
+	schema = read_schema()
+	separate_target = "target" in config
+	target_database = config["target"] if separate_target else config["database"]
+
+	chunk_size = config.get("chunk_size")
+	include = read_include(config["include"])
+	target_schema = config.get("schema_name", DEFAULT_SCHEMA)
+	variants = config.get("variants", [])
+
+	if not target_schema:
+		raise ValueError("schema_name can't be empty")
+
+	for rating in variants:
+		if rating not in RATING_CODES:
+			raise ValueError(f"Unknown rating: {rating!r}")
+
+	maximum_rating = copy_maximum_rating(config)
+	other_variants = sorted(set(variants) - {maximum_rating}, key=RATING_CODES.get)
+
+	if separate_target and config.get("incremental", False):
+		raise ValueError("Incremental refresh isn't supported with a separate target")
+
+	if other_variants and (separate_target or config.get("incremental", False)):
+		raise ValueError("Variants aren't supported with a separate target or incremental refresh")
+
+	if chunk_size is not None and (separate_target or config.get("incremental", False)):
+		raise ValueError("Chunked copying isn't supported with a separate target or incremental refresh")
+
+	if resume and chunk_size is None:
+		raise ValueError("Resuming requires chunk_size")
+
+	rebuild = bool(only or rebuild_from)
+
+	# chunks would commit the truncated tables partly refilled
+	if rebuild and (separate_target or config.get("incremental", False) or other_variants or chunk_size is not None):
+		raise ValueError("Rebuilding steps isn't supported with a separate target, incremental refresh, variants or chunk_size")
+
+	db = connect(target_database, session_settings)
+
+	with db, db.cursor() as cur:
+		lock_schemas(cur, copy_schemas(config))
+
+	if resume:
+		with db, db.cursor() as cur:
+			resume = has_checkpoints(schema_cursor(cur, target_schema))
+
+	if config.get("incremental", False) or rebuild:
+		with db, db.cursor() as cur:
+			cur = schema_cursor(cur, target_schema)
+			refresh = smallcopy_exists(cur)
+
+		if rebuild and not refresh:
+			raise ValueError(f"There is no copy in the {target_schema} schema to rebuild steps in")
+	else:
+		refresh = False
+
+	# from schema.sql rather than the copy, which a failed refresh can leave without them
+	foreign_keys = [post_data_object for post_data_object in schema.post_data if post_data_object.type == "FK CONSTRAINT"]
+
+	if rebuild:
+		run_steps = rebuild_steps(foreign_keys, only=list(only), rebuild_from=list(rebuild_from))
+	elif refresh:
+		run_steps = refresh_steps(foreign_keys)
+	elif defer_constraints:
+		run_steps = steps + post_data_steps(schema.post_data, {table: step.name for step in steps for table in step.tables})
+	else:
+		run_steps = list(steps)
+
+	# only the lower variants and foreign key validation read from the copied tables
+	if config.get("analyze", True) and not refresh:
+		read_tables = set()
+
+		if other_variants:
+			read_tables |= {table for step in run_steps for table in step.tables}
+
+		if defer_constraints:
+			read_tables |= foreign_key_tables(schema.post_data)
+
+		run_steps = list(analyze_steps(run_steps, read_tables))
+		analyzed = frozenset(step.name for step in run_steps if step.name.startswith("analyze "))
+		run_steps = [
+			step._replace(dependencies=step.dependencies | analyzed) if step.name == "add foreign keys" else step
+			for step in run_steps
+		]
+
+	copy_steps = list(run_steps)
+	source_steps = frozenset(step.name for step in copy_steps if not step.setup)
+
+	for rating in other_variants:
+		run_steps += variant_steps(copy_steps, rating, RATING_CODES[rating], target_schema=target_schema, source_steps=source_steps, include=INCLUDE_ALL)
+
+	if include == INCLUDE_ALL:
+		source_db = connect(config["database"])
+
+		try:
+			with source_db, source_db.cursor() as cur:
+				user_columns = read_user_columns(cur)
+		finally:
+			source_db.close()
+
+		run_steps = [
+			step if step.setup else step._replace(func=partial(run_full_copy, func=step.func, user_columns=user_columns))
+			for step in run_steps
+		]
+
+	if chunk_size is not None:
+		resume_skipped = {"initialize schema", "initialize selection"}
+		resume_skipped |= {variant_name(name, rating) for name in resume_skipped for rating in other_variants}
+		run_steps = [
+			step if step.setup else step._replace(func=partial(run_checkpointed, func=step.func, step_name=step.name, chunked=step.name in CHUNKED_STEPS, chunk_size=chunk_size))
+			for step in run_steps
+			if not (resume and step.name in resume_skipped)
+		]
+
+	drop_selection_step = Step(
+		"drop selection",
+		drop_selection,
+		frozenset(step.name for step in run_steps if not step.setup),
+		frozenset(),
+		False,
+	)
+	run_steps.append(drop_selection_step)
+
+	for rating in other_variants:
+		run_steps += variant_steps([drop_selection_step], rating, RATING_CODES[rating], target_schema=target_schema, source_steps=frozenset(), include=INCLUDE_ALL)
+
+	if separate_target:
+		run_steps = [
+			step if step.setup else step._replace(func=partial(run_streaming, func=step.func))
+			for step in run_steps
+		]
+
+	if load_mode == "unlogged_then_logged":
+		set_logged_step = Step(
+			"set tables logged",
+			set_tables_logged,
+			frozenset(step.name for step in run_steps if not step.setup),
+			frozenset(),
+			False,
+		)
+		run_steps.append(set_logged_step)
+
+		for rating in other_variants:
+			run_steps += variant_steps([set_logged_step], rating, RATING_CODES[rating], target_schema=target_schema, source_steps=frozenset(), include=INCLUDE_ALL)
+
+	if config.get("schema_template", False) and not refresh:
+		run_steps.append(Step(
+			"build schema template",
+			partial(build_schema_template, sql=schema_init_sql(schema, defer_constraints=defer_constraints, unlogged=unlogged)),
+			frozenset(),
+			frozenset(),
+			False,
+		))
+
+	if report is not None:
+		recorder = Recorder(explain=explain)
+		run_steps = [
+			step._replace(func=partial(record_step, func=step.func, recorder=recorder, step_name=step.name, step_tables=step.tables))
+			for step in run_steps
+		]
+
+	if progress:
+		monitor = ProgressMonitor(
+			lambda: connect(target_database),
+			target_schema=target_schema,
+			baseline={} if progress_baseline is None else read_baseline(progress_baseline),
+			on_progress=print_progress,
+			log_path=progress_log,
+		)
+		run_steps = [
+			step._replace(func=partial(run_monitored, func=step.func, monitor=monitor, step_name=step.name, step_tables=step.tables))
+			for step in run_steps
+		]
+
+	# outermost, so that every wrapper sees the smallcopy schema's statements
+	if target_schema != DEFAULT_SCHEMA:
+		run_steps = [
+			step._replace(func=partial(run_in_schema, func=step.func, target_schema=target_schema))
+			for step in run_steps
+		]
+
+	# the copying steps read from one snapshot, taken once the selections are committed
+	share_snapshot = workers > 1 and not separate_target and chunk_size is None
+
+	if share_snapshot:
+		run_steps = [
+			step._replace(func=partial(run_in_snapshot, func=step.func)) if step.tables and not step.setup else step
+			for step in run_steps
+		]
+
+	max_name_length = max(len(step.name) for step in run_steps)
+	start_format_string = "\x1b[s… {}"
+	time_format_string = "\x1b[u" + step_time_format(max_name_length)
 	overall_start = time.perf_counter()
 	step_config = {
-		"include": config["include"],
-		"max_rating": RATING_CODES[config["maximum_rating"]],
+		"include": include,
+		"max_rating": RATING_CODES[maximum_rating],
+		"schema": schema,
+		"defer_constraints": defer_constraints,
+		"unlogged": unlogged,
+		"schema_template": config.get("schema_template", False),
 	}
 
-	with psycopg2.connect(**config["database"]) as db, db.cursor() as cur:
-		for name, func in steps:
-			print("\x1b[s… " + name, end="", file=sys.stderr, flush=True)
+	if workers > 1 or progress:
+		# concurrent steps and progress lines can't share a rewritten line
+		start_format_string = None
+		time_format_string = step_time_format(max_name_length)
+
+	def step_finished(name, step_time, result):
+		print(time_format_string.format(name, step_time) + ("" if result is None else "  " + result), file=sys.stderr, flush=True)
+
+	wal_bytes = None
+	error = None
+
+	try:
+		if progress:
+			monitor.start()
+
+		if separate_target:
+			step_config["sources"] = SourcePool(lambda: connect(config["database"]), workers)
 
-			step_start = time.perf_counter()
-			func(cur, **step_config)
-			step_time = time.perf_counter() - step_start
+		with db, db.cursor() as cur:
+			wal_start = current_wal_location(cur)
 
-			print(time_format_string.format(name, step_time), file=sys.stderr, flush=True)
+			for step in run_steps:
+				if workers > 1 and not step.setup:
+					continue
 
-	db.close()
+				if start_format_string is not None:
+					print(start_format_string.format(step.name), end="", file=sys.stderr, flush=True)
+
+				step_start = time.perf_counter()
+				result = step.func(cur, **step_config)
+
+				if chunk_size is not None:
+					db.commit()
+
+				step_finished(step.name, time.perf_counter() - step_start, result)
+
+		if workers > 1:
+			parallel_steps = [step for step in run_steps if not step.setup]
+			run_parallel_steps = partial(run_parallel, lambda: connect(target_database, session_settings), step_config=step_config, workers=workers, on_finish=step_finished)
+			snapshot_db = None
+
+			try:
+				if share_snapshot:
+					selection = selection_step_names(parallel_steps)
+					run_parallel_steps([step for step in parallel_steps if step.name in selection])
+					parallel_steps = [step for step in parallel_steps if step.name not in selection]
+					snapshot_db = connect(target_database)
+					step_config["copy_snapshot"] = export_snapshot(snapshot_db)
+
+				run_parallel_steps(parallel_steps)
+			finally:
+				if snapshot_db is not None:
+					snapshot_db.close()
+
+		with db, db.cursor() as cur:
+			wal_bytes = wal_bytes_since(cur, wal_start)
+	except Exception as e:
+		error = f"{type(e).__name__}: {e}"
+		raise
+	finally:
+		if progress:
+			monitor.stop()
+
+		db.close()
+
+		if "sources" in step_config:
+			step_config["sources"].close()
+
+		if report is not None:
+			recorder.write(report, config=config, total_seconds=time.perf_counter() - overall_start, wal_bytes=wal_bytes, error=error)
 
 	overall_time = time.perf_counter() - overall_start
 	print(" " * (max_name_length + 3) + "───────")
 	print(" " * (max_name_length + 3) + "{:6.2f}s".format(overall_time))
+	print(" " * (max_name_length + 3) + format_size(wal_bytes) + " WAL")
+
+
+# Estimates the rows, size and time of each step without copying anything, calibrating times with the reports of earlier runs.
+def plan(config, *, reports):
+	if "target" in config:
+		raise ValueError("Planning isn't supported with a separate target")
+
+	rates = calibrate(reports)
+	db = connect(config["database"])
+	step_config = {
+		"include": read_include(config["include"]),
+		"max_rating": RATING_CODES[copy_maximum_rating(config)],
+		"schema": read_schema(),
+		"defer_constraints": False,
+		"unlogged": False,
+	}
+
+	# a scratch schema of its own, so that planning neither drops nor locks an existing copy
+	plan_schema = config.get("schema_name", DEFAULT_SCHEMA) + "_plan"
+
+	try:
+		with db, db.cursor() as cur:
+			lock_schemas(cur, [plan_schema])
+
+		estimates = estimate_steps(db, steps, step_config, rates=rates, target_schema=plan_schema)
+	finally:
+		db.close()
+
+	max_name_length = max(len(estimate.name) for estimate in estimates)
+	line_format = "{:%d}  {:>12}  {:>10}  {:>9}" % (max_name_length,)
+	print(line_format.format("step", "rows", "size", "time"))
+
+	for estimate in estimates:
+		if estimate.rows is None:
+			print(line_format.format(estimate.name, "", "", "{:.2f}s".format(estimate.seconds)) + ("" if estimate.result is None else "  " + estimate.result))
+			continue
+
+		print(line_format.format(
+			estimate.name,
+			"{:,.0f}".format(estimate.rows),
+			format_size(estimate.size),
+			"?" if estimate.seconds is None else "~{:.2f}s".format(estimate.seconds),
+		))
+
+		for relation, relation_rows in estimate.sequential_scans:
+			print(f"  sequential scan on {relation} ({relation_rows:,.0f} rows)")
+
+	copy_estimates = [estimate for estimate in estimates if estimate.rows is not None]
+	predicted = [estimate.seconds for estimate in copy_estimates if estimate.seconds is not None]
+
+	print(line_format.format(
+		"total",
+		"{:,.0f}".format(sum(estimate.rows for estimate in copy_estimates)),
+		format_size(sum(estimate.size for estimate in copy_estimates)),
+		"?" if len(predicted) < len(copy_estimates) else "~{:.2f}s".format(sum(predicted) + sum(estimate.seconds for estimate in estimates if estimate.rows is None)),
+	))
@@ -1,9 +1,112 @@
+import argparse
 import json
 
-from . import main
+from . import RATING_CODES, copy_schemas, main, plan
+from .archive import export, restore
+from .benchmark import benchmark, generate
+from .media import copy_media_files
+from .report import compare
+from .service import serve
+from .target_schema import DEFAULT_SCHEMA
+from .verify import verify
 
 
-with open("config.json", "r") as f:
-	config = json.load(f)
+def read_config():
+	with open("config.json", "r") as f:
+		return json.load(f)
 
-main(config)
+
+parser = argparse.ArgumentParser(prog="python -m weasyl_smallcopy")
+parser.add_argument("--report", metavar="PATH", help="write a JSON report of each step's statements, row counts, buffer usage and relation sizes")
+parser.add_argument("--explain", action="store_true", help="include each statement's EXPLAIN (ANALYZE, BUFFERS) plan in the report")
+parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports instead of running")
+parser.add_argument("--resume", action="store_true", help="continue an interrupted run with `chunk_size` from its last committed step or chunk")
+parser.add_argument("--progress", nargs="?", const="", metavar="REPORT", help="print the rows, size, speed and state of running steps every few seconds, with ETAs from the report of an earlier run")
+parser.add_argument("--progress-log", metavar="PATH", help="also append each progress sample to a file as a JSON line (implies --progress)")
+parser.add_argument("--verify", action="store_true", help="check the references between the copied rows once the copy is built (see the verify command)")
+parser.add_argument("--only", action="append", default=[], metavar="STEP", help="rerun only this step against the existing copy (can be given more than once)")
+parser.add_argument("--from", dest="rebuild_from", action="append", default=[], metavar="STEP", help="rerun this step and every step that depends on it against the existing copy (can be given more than once)")
+parser.add_argument("--plan", nargs="*", metavar="REPORT", help="estimate each step's rows, size and time without copying, calibrating times with the reports of earlier runs")
+subparsers = parser.add_subparsers(dest="command")
+
+export_parser = subparsers.add_parser("export", help="write the smallcopy schema to an archive directory")
+export_parser.add_argument("directory")
+export_parser.add_argument("-j", "--jobs", type=int, default=4, help="number of tables to export at a time")
+
+restore_parser = subparsers.add_parser("restore", help="load an archive directory into an empty database")
+restore_parser.add_argument("directory")
+restore_parser.add_argument("-j", "--jobs", type=int, default=4, help="number of tables to load at a time")
+restore_parser.add_argument("--database", help="DSN of the database to restore into (default: `database` from config.json)")
+
+verify_parser = subparsers.add_parser("verify", help="check that every reference between copied rows points to a copied row")
+verify_parser.add_argument("-j", "--jobs", type=int, default=4, help="number of references to check at a time")
+
+media_parser = subparsers.add_parser("media", help="copy the files of the copied media from a media root")
+media_parser.add_argument("source", help="media root that `disk_media.file_path` is relative to")
+media_parser.add_argument("destination", help="directory to copy the files into")
+media_parser.add_argument("-j", "--jobs", type=int, default=8, help="number of files to copy at a time")
+media_parser.add_argument("--link", action="store_true", help="hard link files instead of copying them (the directories must be on the same filesystem)")
+
+serve_parser = subparsers.add_parser("serve", help="build copies on request over HTTP, keeping their exports in a cache")
+serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+serve_parser.add_argument("--port", type=int, default=8734, help="port to listen on")
+serve_parser.add_argument("--cache", default="smallcopy-cache", metavar="DIRECTORY", help="directory to keep exports in")
+serve_parser.add_argument("--budget", type=float, default=50, metavar="GIB", help="disk space for exports, past which the least recently requested are removed")
+serve_parser.add_argument("-j", "--jobs", type=int, default=4, help="number of tables to export at a time")
+
+generate_parser = subparsers.add_parser("generate", help="fill an empty database with synthetic data for benchmarking")
+generate_parser.add_argument("--database", required=True, help="DSN of the empty database to fill")
+generate_parser.add_argument("--users", type=int, default=10000, help="number of users to generate (other content scales with it)")
+generate_parser.add_argument("--seed", type=float, default=0, help="random seed, from -1 to 1")
+generate_parser.add_argument("-j", "--jobs", type=int, default=4, help="number of tables to generate at a time")
+
+benchmark_parser = subparsers.add_parser("benchmark", help="time copies of different sizes and maximum ratings")
+benchmark_parser.add_argument("--database", help="DSN of the database to copy from (default: `database` from config.json)")
+benchmark_parser.add_argument("--include-sizes", nargs="+", default=["10", "100", "1000"], metavar="SIZE", help="numbers of users to include, or `all`")
+benchmark_parser.add_argument("--ratings", nargs="+", default=["general", "explicit"], choices=RATING_CODES, help="maximum ratings to copy with")
+benchmark_parser.add_argument("--reports", default="benchmark", metavar="DIRECTORY", help="directory to write each run's report to")
+
+args = parser.parse_args()
+
+if args.command == "export":
+	config = read_config()
+	export(config.get("target", config["database"]), args.directory, jobs=args.jobs, schema=config.get("schema_name", DEFAULT_SCHEMA))
+elif args.command == "restore":
+	restore(args.database or read_config()["database"], args.directory, jobs=args.jobs)
+elif args.command == "verify":
+	config = read_config()
+	verify(config.get("target", config["database"]), jobs=args.jobs, schemas=copy_schemas(config))
+elif args.command == "media":
+	config = read_config()
+	copy_media_files(config.get("target", config["database"]), args.source, args.destination, jobs=args.jobs, link=args.link, schema=config.get("schema_name", DEFAULT_SCHEMA))
+elif args.command == "serve":
+	serve(read_config(), host=args.host, port=args.port, cache_directory=args.cache, budget=args.budget * 1024 ** 3, jobs=args.jobs)
+elif args.command == "generate":
+	generate(args.database, users=args.users, seed=args.seed, jobs=args.jobs)
+elif args.command == "benchmark":
+	config = read_config()
+
+	if args.database is not None:
+		config["database"] = args.database
+
+	benchmark(config, include_sizes=args.include_sizes, ratings=args.ratings, reports=args.reports)
+elif args.plan is not None:
+	plan(read_config(), reports=args.plan)
+elif args.compare:
+	compare(*args.compare)
+else:
+	config = read_config()
+	main(
+		config,
+		report=args.report,
+		explain=args.explain,
+		resume=args.resume,
+		progress=args.progress is not None or args.progress_log is not None,
+		progress_baseline=args.progress or None,
+		progress_log=args.progress_log,
+		only=args.only,
+		rebuild_from=args.rebuild_from,
+	)
+
+	if args.verify:
+		verify(config.get("target", config["database"]), jobs=config.get("workers", 4), schemas=copy_schemas(config))
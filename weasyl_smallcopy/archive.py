@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+import sys
+import time
+from functools import partial
+
+from psycopg2.extensions import quote_ident
+
+from . import Step, connect, post_data_steps, step_time_format
+from .scheduler import run_parallel
+from .schema import public_schema_sql, read_schema, split_schema
+from .target_schema import DEFAULT_SCHEMA, run_in_schema, schema_cursor
+
+ARCHIVE_FORMAT = 1
+COMPRESS_LEVEL = 3
+
+
+def _export_table(cur, *, table, path, snapshot, exported, **config):
+	cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+	cur.execute("SET TRANSACTION SNAPSHOT %(snapshot)s", {"snapshot": snapshot})
+
+	with gzip.open(path, "wb", compresslevel=COMPRESS_LEVEL) as f:
+		cur.copy_expert(f"COPY smallcopy.{quote_ident(table, cur.connection)} TO STDOUT", f)
+
+	exported[table] = cur.rowcount
+
+
+def _restore_table(cur, *, table, columns, path, **config):
+	column_list = ", ".join(quote_ident(column, cur) for column in columns)
+
+	with gzip.open(path, "rb") as f:
+		cur.copy_expert(f"COPY public.{quote_ident(table, cur)} ({column_list}) FROM STDIN", f)
+
+
+def _restore_sequences(cur, *, sequences, **config):
+	for name, (last_value, is_called) in sequences.items():
+		cur.execute(
+			"SELECT setval(%(sequence)s, %(last_value)s, %(is_called)s)",
+			{"sequence": "public." + quote_ident(name, cur), "last_value": last_value, "is_called": is_called})
+
+
+def _print_steps(run_steps):
+	time_format_string = step_time_format(max(len(step.name) for step in run_steps))
+
+	def step_finished(name, step_time, result):
+		print(time_format_string.format(name, step_time), file=sys.stderr, flush=True)
+
+	return step_finished
+
+
+# Writes the smallcopy schema as a directory of per-table COPY files with a manifest, read in parallel under one exported snapshot, with the DDL from schema.sql rewritten for the public schema.
+def export(database, directory, *, jobs, schema=DEFAULT_SCHEMA):
+	start = time.perf_counter()
+	ddl = split_schema(public_schema_sql(read_schema().sql))
+	os.makedirs(os.path.join(directory, "tables"))
+
+	with open(os.path.join(directory, "pre_data.sql"), "w") as f:
+		f.write(ddl.pre_data)
+
+	with open(os.path.join(directory, "post_data.sql"), "w") as f:
+		f.write("SET search_path = public, pg_catalog;\n\n")
+		f.write("".join(post_data_object.sql for post_data_object in ddl.post_data))
+
+	db = connect(database)
+
+	try:
+		db.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+		with db, db.cursor() as cur:
+			cur = schema_cursor(cur, schema)
+			cur.execute("SELECT pg_export_snapshot()")
+			snapshot, = cur.fetchone()
+
+			cur.execute("""
+				SELECT table_name, array_agg(column_name::text ORDER BY ordinal_position)
+				FROM information_schema.tables
+					INNER JOIN information_schema.columns USING (table_schema, table_name)
+				WHERE
+					table_schema = 'smallcopy' AND
+					table_type = 'BASE TABLE'
+				GROUP BY table_name
+				ORDER BY pg_total_relation_size((quote_ident('smallcopy') || '.' || quote_ident(table_name))::regclass) DESC
+			""")
+			tables = cur.fetchall()
+
+			cur.execute("SELECT sequence_name FROM information_schema.sequences WHERE sequence_schema = 'smallcopy'")
+			sequences = {}
+
+			for name, in cur.fetchall():
+				cur.execute(f"SELECT last_value, is_called FROM smallcopy.{quote_ident(name, cur.connection)}")
+				sequences[name] = cur.fetchone()
+
+			exported = {}
+			run_steps = [
+				Step(
+					f"export {table}",
+					partial(run_in_schema, func=_export_table, target_schema=schema, table=table, path=os.path.join(directory, "tables", table + ".copy.gz")),
+					frozenset(),
+					frozenset(),
+					False,
+				)
+				for table, columns in tables
+			]
+
+			run_parallel(
+				lambda: connect(database),
+				run_steps,
+				{"snapshot": snapshot, "exported": exported},
+				workers=jobs,
+				on_finish=_print_steps(run_steps),
+			)
+	finally:
+		db.close()
+
+	manifest = {
+		"format": ARCHIVE_FORMAT,
+		"pre_data": "pre_data.sql",
+		"post_data": "post_data.sql",
+		"tables": [
+			{
+				"name": table,
+				"columns": columns,
+				"file": "tables/" + table + ".copy.gz",
+				"rows": exported[table],
+				"bytes": os.path.getsize(os.path.join(directory, "tables", table + ".copy.gz")),
+			}
+			for table, columns in tables
+		],
+		"sequences": sequences,
+	}
+
+	with open(os.path.join(directory, "manifest.json"), "w") as f:
+		json.dump(manifest, f, indent="\t")
+		f.write("\n")
+
+	print("{:6.2f}s".format(time.perf_counter() - start))
+
+
+# Loads an archive written by `export` into the public schema of an empty database, loading tables in parallel and building indexes and constraints afterwards.
+def restore(database, directory, *, jobs):
+	start = time.perf_counter()
+
+	with open(os.path.join(directory, "manifest.json"), "r") as f:
+		manifest = json.load(f)
+
+	if manifest["format"] != ARCHIVE_FORMAT:
+		raise ValueError(f"Unsupported archive format: {manifest['format']!r}")
+
+	with open(os.path.join(directory, manifest["pre_data"]), "r") as f:
+		pre_data_sql = f.read()
+
+	with open(os.path.join(directory, manifest["post_data"]), "r") as f:
+		post_data = split_schema(f.read()).post_data
+
+	load_steps = [
+		Step(
+			f"load {table['name']}",
+			partial(_restore_table, table=table["name"], columns=table["columns"], path=os.path.join(directory, table["file"])),
+			frozenset(),
+			frozenset(),
+			False,
+		)
+		for table in manifest["tables"]
+	]
+	table_steps = {table["name"]: step.name for table, step in zip(manifest["tables"], load_steps)}
+
+	run_steps = load_steps + post_data_steps(post_data, table_steps) + [
+		Step(
+			"set sequences",
+			partial(_restore_sequences, sequences=manifest["sequences"]),
+			frozenset(table_steps.values()),
+			frozenset(),
+			False,
+		),
+	]
+
+	db = connect(database)
+
+	try:
+		with db, db.cursor() as cur:
+			cur.execute(pre_data_sql)
+	finally:
+		db.close()
+
+	run_parallel(
+		lambda: connect(database),
+		run_steps,
+		{"target_schema": "public"},
+		workers=jobs,
+		on_finish=_print_steps(run_steps),
+	)
+
+	print("{:6.2f}s".format(time.perf_counter() - start))
@@ -0,0 +1,312 @@
+import json
+import os
+import time
+from functools import partial
+
+from . import INCLUDE_ALL, Step, connect, main, post_data_steps
+from .archive import _print_steps
+from .scheduler import run_parallel
+from .schema import public_schema_sql, read_schema, split_schema
+
+# rows generated per user
+SCALE = {
+	"submissions": 4,
+	"characters": 0.5,
+	"journals": 1,
+	"tags": 2,
+	"comments": 3,
+	"charcomments": 0.25,
+	"journalcomments": 0.5,
+	"favorites": 20,
+	"watches": 8,
+	"friends": 2,
+}
+
+# each submission has a chain of media (the submission, its cover, the cover's thumbnail)
+MEDIA_CHAIN_LENGTH = 3
+
+# each level of a comment thread has this many replies per comment in the level above
+COMMENT_REPLIES = 0.6
+COMMENT_DEPTH = 8
+
+UNIXTIME = 1500000000
+
+RATING = "(ARRAY[10, 10, 10, 10, 10, 10, 10, 30, 30, 40])[1 + floor(random() * 10)::integer]"
+
+# about 2% hidden and 3% friends-only
+CONTENT_SETTINGS = "CASE floor(random() * 100)::integer WHEN 0 THEN 'h' WHEN 1 THEN 'h' WHEN 2 THEN 'f' WHEN 3 THEN 'f' WHEN 4 THEN 'f' ELSE '' END"
+
+
+# A random id from 1 to `count`, skewed towards low ids so that a few users have most of the content and a few submissions most of the favorites.
+def _pick(count, skew=3):
+	return f"(1 + floor({max(count, 1)} * power(random(), {skew}))::integer)"
+
+
+def _generate(cur, *, sql, seed, counts, **config):
+	cur.execute("SELECT setseed(%(seed)s)", {"seed": seed})
+
+	for statement in sql:
+		cur.execute(statement.format(**counts))
+
+
+def _generate_comment_threads(cur, *, table, roots, targets, root_parent, count, seed, counts, **config):
+	cur.execute("SELECT setseed(%(seed)s)", {"seed": seed})
+	columns = f"commentid, userid, {targets}, parentid, content, unixtime, indent, settings, hidden_by"
+	cur.execute(f"""
+		INSERT INTO {table} ({columns})
+		SELECT i, {_pick(counts['users'])}, {roots}, {root_parent}, 'Comment ' || i, {UNIXTIME} + i, 0, CASE WHEN random() < 0.02 THEN 'h' ELSE '' END, NULL
+		FROM generate_series(1, {count}) i
+	""")
+
+	level_start = 1
+	level_count = count
+
+	for indent in range(1, COMMENT_DEPTH):
+		reply_count = int(level_count * COMMENT_REPLIES)
+
+		if not reply_count:
+			break
+
+		cur.execute(f"""
+			INSERT INTO {table} ({columns})
+			SELECT
+				{level_start + level_count} + s.i, s.userid, {', '.join('p.' + target for target in targets.split(', '))}, p.commentid,
+				'Reply ' || s.i, p.unixtime + s.i, {indent}, CASE WHEN random() < 0.02 THEN 'h' ELSE '' END, NULL
+			FROM (
+				SELECT i - 1 AS i, {_pick(counts['users'])} AS userid, {level_start} + floor(random() * {level_count})::integer AS parentid
+				FROM generate_series(1, {reply_count}) i
+			) s
+				INNER JOIN {table} p ON p.commentid = s.parentid
+		""")
+
+		level_start += level_count
+		level_count = reply_count
+
+
+def _generation_steps(users):
+	counts = {"users": users}
+
+	for name, per_user in SCALE.items():
+		counts[name] = max(int(users * per_user), 1)
+
+	counts["media"] = counts["submissions"] * MEDIA_CHAIN_LENGTH + users
+	users_pick = _pick(users)
+	uniform_users_pick = _pick(users, 1)
+
+	tables = {
+		"login": [f"""
+			INSERT INTO login (userid, login_name, last_login, settings, email)
+			SELECT i, 'user' || i, 0, CASE WHEN random() < 0.01 THEN 'd' ELSE '' END, 'user' || i || '@example.com'
+			FROM generate_series(1, {{users}}) i
+		"""],
+		"authbcrypt": ["""
+			INSERT INTO authbcrypt (userid, hashsum)
+			SELECT i, '$2a$12$qReI924/8pAsoHu6aRTX2ejyujAZ/9FiOOtrjczBIwf8wqXAJ22N.'
+			FROM generate_series(1, {users}) i
+		"""],
+		"profile": [f"""
+			INSERT INTO profile (userid, username, full_name, catchphrase, artist_type, unixtime, profile_text, settings, stream_url, page_views, config, jsonb_settings, stream_time, stream_text)
+			SELECT
+				i, 'user' || i, 'User ' || i, '', '', {UNIXTIME} + i, 'Profile of user ' || i, '', '', floor(random() * 1000)::integer,
+				(ARRAY['h', 'v', 'hv', '', '', '', '', '', '', ''])[1 + floor(random() * 10)::integer], '{{{{}}}}', NULL, NULL
+			FROM generate_series(1, {{users}}) i
+		"""],
+		"userinfo": ["""
+			INSERT INTO userinfo (userid, birthday, gender, country)
+			SELECT i, 0, '', ''
+			FROM generate_series(1, {users}) i
+		"""],
+		"userstats": ["""
+			INSERT INTO userstats (userid, page_views, submit_views, followers, faved_works, journals, submits, characters, collects, faves)
+			SELECT i, 0, 0, 0, 0, 0, 0, 0, 0, 0
+			FROM generate_series(1, {users}) i
+		"""],
+		"watchuser": [f"""
+			INSERT INTO watchuser (userid, otherid, settings, unixtime)
+			SELECT DISTINCT ON (userid, otherid) userid, otherid, 'cfjst', {UNIXTIME}
+			FROM (SELECT {uniform_users_pick} AS userid, {users_pick} AS otherid FROM generate_series(1, {{watches}})) w
+			WHERE userid <> otherid
+		"""],
+		"frienduser": [f"""
+			INSERT INTO frienduser (userid, otherid, settings, unixtime)
+			SELECT DISTINCT ON (userid, otherid) userid, otherid, CASE WHEN random() < 0.2 THEN 'p' ELSE '' END, {UNIXTIME}
+			FROM (SELECT {uniform_users_pick} AS userid, {uniform_users_pick} AS otherid FROM generate_series(1, {{friends}})) f
+			WHERE userid <> otherid
+		"""],
+		"submission": [f"""
+			INSERT INTO submission (submitid, folderid, userid, unixtime, title, content, subtype, rating, settings, page_views, sorttime, fave_count)
+			SELECT i, NULL, {users_pick}, {UNIXTIME} + i, 'Submission ' || i, repeat('Description. ', 20), 1010, {RATING}, {CONTENT_SETTINGS}, floor(random() * 1000)::integer, {UNIXTIME} + i, 0
+			FROM generate_series(1, {{submissions}}) i
+		"""],
+		"character": [f"""
+			INSERT INTO character (charid, userid, unixtime, char_name, age, gender, height, weight, species, content, rating, settings, page_views)
+			SELECT i, {users_pick}, {UNIXTIME} + i, 'Character ' || i, '', '', '', '', '', repeat('Description. ', 20), {RATING}, {CONTENT_SETTINGS}, 0
+			FROM generate_series(1, {{characters}}) i
+		"""],
+		"journal": [f"""
+			INSERT INTO journal (journalid, userid, title, content, rating, unixtime, settings, page_views)
+			SELECT i, {users_pick}, 'Journal ' || i, repeat('Journal text. ', 50), {RATING}, {UNIXTIME} + i, {CONTENT_SETTINGS}, 0
+			FROM generate_series(1, {{journals}}) i
+		"""],
+		"favorite": [f"""
+			INSERT INTO favorite (userid, targetid, type, unixtime, settings)
+			SELECT DISTINCT ON (userid, targetid, type) userid, targetid, type, {UNIXTIME}, ''
+			FROM (
+				SELECT
+					{uniform_users_pick} AS userid,
+					CASE WHEN r < 0.8 THEN {_pick(counts['submissions'])} WHEN r < 0.9 THEN {_pick(counts['characters'])} ELSE {_pick(counts['journals'])} END AS targetid,
+					CASE WHEN r < 0.8 THEN 's' WHEN r < 0.9 THEN 'f' ELSE 'j' END AS type
+				FROM (SELECT random() AS r FROM generate_series(1, {{favorites}})) r
+			) f
+		"""],
+		"searchtag": ["""
+			INSERT INTO searchtag (tagid, title)
+			SELECT i, 'tag' || i
+			FROM generate_series(1, {tags}) i
+		"""],
+		"searchmapsubmit": [f"""
+			INSERT INTO searchmapsubmit (tagid, targetid, settings)
+			SELECT DISTINCT {_pick(counts['tags'])}, 1 + i % {{submissions}}, ''
+			FROM generate_series(0, {{submissions}} * 4 - 1) i
+		"""],
+		"searchmapchar": [f"""
+			INSERT INTO searchmapchar (tagid, targetid, settings)
+			SELECT DISTINCT {_pick(counts['tags'])}, 1 + i % {{characters}}, ''
+			FROM generate_series(0, {{characters}} * 2 - 1) i
+		"""],
+		"searchmapjournal": [f"""
+			INSERT INTO searchmapjournal (tagid, targetid, settings)
+			SELECT DISTINCT {_pick(counts['tags'])}, 1 + i % {{journals}}, ''
+			FROM generate_series(0, {{journals}} * 2 - 1) i
+		"""],
+		"submission_tags": ["""
+			INSERT INTO submission_tags (submitid, tags)
+			SELECT targetid, array_agg(tagid ORDER BY tagid)
+			FROM searchmapsubmit
+			GROUP BY targetid
+		"""],
+		"media": ["""
+			INSERT INTO media (mediaid, media_type, file_type, attributes, sha256)
+			SELECT i, 'disk', 'png', '{{}}', md5(i::text) || md5((-i)::text)
+			FROM generate_series(1, {media}) i
+		"""],
+		"disk_media": ["""
+			INSERT INTO disk_media (mediaid, file_path, file_url)
+			SELECT i, 'static/media/' || i || '.png', '/static/media/' || i || '.png'
+			FROM generate_series(1, {media}) i
+		"""],
+		"submission_media_links": [f"""
+			INSERT INTO submission_media_links (linkid, mediaid, submitid, link_type)
+			SELECT i, (i - 1) * {MEDIA_CHAIN_LENGTH} + 1, i, 'submission'
+			FROM generate_series(1, {{submissions}}) i
+		"""],
+		"media_media_links": [f"""
+			INSERT INTO media_media_links (linkid, described_with_id, describee_id, link_type)
+			SELECT i + 1, describee_id + 1, describee_id, CASE WHEN describee_id % {MEDIA_CHAIN_LENGTH} = 1 THEN 'cover' ELSE 'thumbnail-generated' END
+			FROM (
+				SELECT i, i / {MEDIA_CHAIN_LENGTH - 1} * {MEDIA_CHAIN_LENGTH} + i % {MEDIA_CHAIN_LENGTH - 1} + 1 AS describee_id
+				FROM generate_series(0, {{submissions}} * {MEDIA_CHAIN_LENGTH - 1} - 1) i
+			) l
+		"""],
+		"user_media_links": [f"""
+			INSERT INTO user_media_links (linkid, mediaid, userid, link_type)
+			SELECT i, {{submissions}} * {MEDIA_CHAIN_LENGTH} + i, i, 'avatar'
+			FROM generate_series(1, {{users}}) i
+		"""],
+	}
+
+	dependencies = {
+		"submission_tags": ["searchmapsubmit"],
+	}
+
+	generation_steps = [
+		Step(
+			f"generate {table}",
+			partial(_generate, sql=sql),
+			frozenset(f"generate {dependency}" for dependency in dependencies.get(table, [])),
+			frozenset({table}),
+			False,
+		)
+		for table, sql in tables.items()
+	]
+
+	comment_threads = [
+		("comments", f"CASE WHEN i % 5 = 0 THEN {users_pick} END, CASE WHEN i % 5 <> 0 THEN {_pick(counts['submissions'])} END", "target_user, target_sub", "NULL", counts["comments"]),
+		("charcomment", _pick(counts["characters"]), "targetid", "0", counts["charcomments"]),
+		("journalcomment", _pick(counts["journals"]), "targetid", "0", counts["journalcomments"]),
+	]
+
+	generation_steps.extend(
+		Step(
+			f"generate {table}",
+			partial(_generate_comment_threads, table=table, roots=roots, targets=targets, root_parent=root_parent, count=count),
+			frozenset(),
+			frozenset({table}),
+			False,
+		)
+		for table, roots, targets, root_parent, count in comment_threads
+	)
+
+	return generation_steps, counts
+
+
+def _analyze(cur, **config):
+	cur.execute("ANALYZE")
+
+
+# Fills the public schema of an empty database with synthetic Weasyl-shaped data for `users` users, using the tables from schema.sql: skewed content and favorite counts per user, a mix of ratings and hidden and friends-only content, comment threads several levels deep, and chains of linked media.
+def generate(database, *, users, seed, jobs):
+	start = time.perf_counter()
+	schema = split_schema(public_schema_sql(read_schema().sql))
+	generation_steps, counts = _generation_steps(users)
+	table_steps = {table: step.name for step in generation_steps for table in step.tables}
+	run_steps = generation_steps + post_data_steps(schema.post_data, table_steps)
+	run_steps.append(Step("analyze", _analyze, frozenset(step.name for step in run_steps), frozenset(), False))
+
+	db = connect(database)
+
+	try:
+		with db, db.cursor() as cur:
+			cur.execute(schema.pre_data)
+	finally:
+		db.close()
+
+	run_parallel(
+		lambda: connect(database),
+		run_steps,
+		{"target_schema": "public", "seed": seed, "counts": counts},
+		workers=jobs,
+		on_finish=_print_steps(run_steps),
+	)
+
+	print("{:6.2f}s".format(time.perf_counter() - start))
+
+
+# Copies from a (generated) database once for each combination of `include` size and maximum rating, writing a report for each run to `reports` and summarizing the total times.
+def benchmark(config, *, include_sizes, ratings, reports):
+	os.makedirs(reports, exist_ok=True)
+	db = connect(config["database"])
+
+	try:
+		with db, db.cursor() as cur:
+			cur.execute("SELECT setseed(0)")
+			cur.execute("SELECT userid FROM login ORDER BY random()")
+			userids = [userid for userid, in cur]
+	finally:
+		db.close()
+
+	runs = []
+
+	for rating in ratings:
+		for size in include_sizes:
+			include = INCLUDE_ALL if size == INCLUDE_ALL else sorted(userids[:int(size)])
+			report = os.path.join(reports, f"{size}-{rating}.json")
+			main({**config, "include": include, "maximum_rating": rating}, report=report)
+
+			with open(report, "r") as f:
+				runs.append((size, rating, json.load(f)["seconds"]))
+
+	print("{:>8}  {:9}  {:>9}".format("include", "rating", "time"))
+
+	for size, rating, seconds in runs:
+		print("{:>8}  {:9}  {:8.2f}s".format(size, rating, seconds))
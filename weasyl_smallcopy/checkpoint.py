@@ -0,0 +1,134 @@
+import re
+
+from .statements import from_table, parse_insert_select
+
+INTEGER_TYPES = frozenset({"smallint", "integer", "bigint"})
+
+_not_chunkable = re.compile(r"\b(?:GROUP BY|ORDER BY|LIMIT|UNION|WITH)\b|\(\s*SELECT\b")
+
+
+def has_checkpoints(cur):
+	cur.execute("SELECT to_regclass('smallcopy_keys.checkpoints') IS NOT NULL")
+
+	if not cur.fetchone()[0]:
+		return False
+
+	cur.execute("SELECT EXISTS (SELECT FROM smallcopy_keys.checkpoints)")
+	return cur.fetchone()[0]
+
+
+def _save_checkpoint(cur, step_name, *, statement, next_key, finished):
+	cur.execute("DELETE FROM smallcopy_keys.checkpoints WHERE step = %(step)s", {"step": step_name})
+	cur.execute(
+		"INSERT INTO smallcopy_keys.checkpoints (step, statement, next_key, finished) "
+		"VALUES (%(step)s, %(statement)s, %(next_key)s, %(finished)s)",
+		{"step": step_name, "statement": statement, "next_key": next_key, "finished": finished})
+
+
+def _chunk_key(cur, table):
+	cur.execute("""
+		SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+		FROM pg_index i
+			INNER JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+		WHERE
+			i.indrelid = %(table)s::regclass AND
+			i.indisprimary
+	""", {"table": "public." + table})
+	key = cur.fetchone()
+
+	if key is None or key[1] not in INTEGER_TYPES:
+		return None
+
+	return key[0]
+
+
+# Copies each row-copying statement of a step in ranges of the first primary key column of the table it reads from, committing each range along with a checkpoint of the statement and key to continue from.
+class ChunkingCursor:
+	def __init__(self, cur, *, step_name, chunk_size, statement=0, next_key=None):
+		self._cur = cur
+		self._step_name = step_name
+		self._chunk_size = chunk_size
+		self._resume_statement = statement
+		self._resume_key = next_key
+		self._statement = 0
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def _chunked_query(self, query, statement):
+		from_match = from_table.search(statement.query)
+
+		# only a single SELECT from a table can take a range condition without changing what it means
+		if from_match is None or _not_chunkable.search(statement.query) or statement.query.count("WHERE") > 1:
+			return None
+
+		table, alias = from_match.groups()
+		key = _chunk_key(self._cur, table)
+
+		if key is None:
+			return None
+
+		# the table can be referenced as public.table even where a selection of the same name is joined
+		condition = f"{alias or 'public.' + table}.{key} >= %(smallcopy_chunk_start)s AND {alias or 'public.' + table}.{key} < %(smallcopy_chunk_end)s"
+
+		if "WHERE" in statement.query:
+			return table, key, re.sub(r"\bWHERE\b(.*)\Z", lambda match: f"WHERE {condition} AND ({match.group(1)})", query, flags=re.DOTALL)
+
+		return table, key, query.rstrip() + f" WHERE {condition}"
+
+	def execute(self, query, vars=None):
+		statement = parse_insert_select(query)
+
+		if statement is None or statement.schema != "smallcopy":
+			self._cur.execute(query, vars)
+			return
+
+		index = self._statement
+		self._statement += 1
+
+		# copied before the run being resumed stopped
+		if index < self._resume_statement:
+			return
+
+		chunked = self._chunked_query(query if vars is not None else query.replace("%", "%%"), statement)
+
+		if chunked is None:
+			self._cur.execute(query, vars)
+		else:
+			table, key, chunked_query = chunked
+			self._cur.execute(f"SELECT min({key}), max({key}) FROM public.{table}")
+			first_key, last_key = self._cur.fetchone()
+
+			if index == self._resume_statement and self._resume_key is not None:
+				first_key = self._resume_key
+
+			if last_key is not None:
+				for chunk_start in range(first_key, last_key + 1, self._chunk_size):
+					chunk_end = chunk_start + self._chunk_size
+					self._cur.execute(chunked_query, {**(vars or {}), "smallcopy_chunk_start": chunk_start, "smallcopy_chunk_end": chunk_end})
+					_save_checkpoint(self._cur, self._step_name, statement=index, next_key=chunk_end, finished=False)
+					self._cur.connection.commit()
+
+		_save_checkpoint(self._cur, self._step_name, statement=index + 1, next_key=None, finished=False)
+		self._cur.connection.commit()
+
+
+# Skips a step that finished before the run being resumed stopped, and records the step as finished in the same transaction as its last rows.
+def run_checkpointed(cur, *, func, step_name, chunked, chunk_size, **config):
+	cur.execute("SELECT statement, next_key, finished FROM smallcopy_keys.checkpoints WHERE step = %(step)s", {"step": step_name})
+	checkpoint = cur.fetchone()
+
+	if checkpoint is not None and checkpoint[2]:
+		return "finished before resuming"
+
+	if chunked:
+		statement, next_key = (0, None) if checkpoint is None else checkpoint[:2]
+		result = func(ChunkingCursor(cur, step_name=step_name, chunk_size=chunk_size, statement=statement, next_key=next_key), **config)
+	else:
+		result = func(cur, **config)
+
+	_save_checkpoint(cur, step_name, statement=None, next_key=None, finished=True)
+	return result
@@ -0,0 +1,86 @@
+import re
+
+from .statements import from_table, parse_insert_select
+
+_users_join = re.compile(r"\s+INNER JOIN smallcopy_keys\.users(?:\s+(?!ON\b|USING\b)(\w+))?\s+(?:USING \(userid\)|ON (?:(\w+)\.)?(\w+) = (\w+)\.userid\b)")
+
+
+# The columns that every row has a login for: NOT NULL columns with a validated foreign key to login, and login's own userid.
+def read_user_columns(cur):
+	cur.execute("""
+		SELECT c.relname, a.attname
+		FROM pg_constraint f
+			INNER JOIN pg_class c ON f.conrelid = c.oid
+			INNER JOIN pg_namespace n ON c.relnamespace = n.oid
+			INNER JOIN pg_attribute a ON a.attrelid = f.conrelid AND a.attnum = f.conkey[1]
+		WHERE
+			n.nspname = 'public' AND
+			f.contype = 'f' AND
+			f.confrelid = 'public.login'::regclass AND
+			f.convalidated AND
+			cardinality(f.conkey) = 1 AND
+			a.attnotnull
+	""")
+
+	return frozenset(cur.fetchall()) | {("login", "userid")}
+
+
+# Removes the joins against the selected users that can't drop any rows, because every user is selected and every row of the joined column has a login.
+def remove_user_joins(query, user_columns):
+	removed = []
+
+	def replace(match):
+		alias, qualifier, column, join_alias = match.groups()
+		from_match = None
+
+		for from_match in from_table.finditer(query, 0, match.start()):
+			pass
+
+		if from_match is None:
+			return match.group()
+
+		table, table_alias = from_match.groups()
+
+		if column is None:
+			column = "userid"
+		elif join_alias != (alias or "users") or qualifier not in (None, table, table_alias):
+			return match.group()
+
+		if (table, column) not in user_columns:
+			return match.group()
+
+		removed.append(f"{table}.{column}")
+		return ""
+
+	return _users_join.sub(replace, query), removed
+
+
+class FullCopyCursor:
+	def __init__(self, cur, *, user_columns):
+		self._cur = cur
+		self._user_columns = user_columns
+		self.removed = []
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def execute(self, query, vars=None):
+		if parse_insert_select(query) is not None:
+			query, removed = remove_user_joins(query, self._user_columns)
+			self.removed.extend(removed)
+
+		self._cur.execute(query, vars)
+
+
+def run_full_copy(cur, *, func, user_columns, **config):
+	full_copy_cur = FullCopyCursor(cur, user_columns=user_columns)
+	result = func(full_copy_cur, **config)
+
+	if not full_copy_cur.removed:
+		return result
+
+	fast_path = f"fast path without user joins on {', '.join(sorted(set(full_copy_cur.removed)))}"
+	return fast_path if result is None else f"{result}, {fast_path}"
@@ -0,0 +1,115 @@
+from .statements import parse_insert_select
+
+
+def smallcopy_exists(cur):
+	cur.execute("SELECT EXISTS (SELECT FROM pg_namespace WHERE nspname = 'smallcopy')")
+	return cur.fetchone()[0]
+
+
+def drop_foreign_keys(cur, *, objects, **config):
+	for foreign_key in objects:
+		cur.execute(f"ALTER TABLE smallcopy.{foreign_key.table} DROP CONSTRAINT IF EXISTS {foreign_key.name}")
+
+
+def _primary_key(cur, table):
+	cur.execute("""
+		SELECT a.attname
+		FROM pg_index i
+			INNER JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY (i.indkey)
+		WHERE
+			i.indrelid = ('smallcopy.' || %(table)s)::regclass AND
+			i.indisprimary
+		ORDER BY array_position(i.indkey::smallint[], a.attnum)
+	""", {"table": table})
+
+	return [name for name, in cur]
+
+
+def _column_types(cur, table):
+	cur.execute("""
+		SELECT attname, format_type(atttypid, atttypmod)
+		FROM pg_attribute
+		WHERE
+			attrelid = ('smallcopy.' || %(table)s)::regclass AND
+			attnum > 0 AND
+			NOT attisdropped
+	""", {"table": table})
+
+	return dict(cur.fetchall())
+
+
+def _merge_rows(cur, statement, params):
+	columns = ", ".join(statement.columns)
+	target = "smallcopy." + statement.table
+	row_matches = " AND ".join(f"t.{column} IS NOT DISTINCT FROM i.{column}" for column in statement.columns)
+
+	cur.execute(f"CREATE TEMPORARY TABLE smallcopy_incoming AS SELECT * FROM ({statement.query}) AS q ({columns})", params)
+	cur.execute("ANALYZE smallcopy_incoming")
+	cur.execute(f"DELETE FROM {target} t WHERE NOT EXISTS (SELECT FROM smallcopy_incoming i WHERE {row_matches})")
+	cur.execute(f"INSERT INTO {target} ({columns}) SELECT {columns} FROM smallcopy_incoming i WHERE NOT EXISTS (SELECT FROM {target} t WHERE {row_matches})")
+	cur.execute("DROP TABLE smallcopy_incoming")
+
+
+# Writes the difference between a step's result and the rows already in the table.
+def merge(cur, statement, params):
+	key = _primary_key(cur, statement.table)
+
+	# tables without a primary key (in the step's columns) are small enough to compare in full
+	if not key or not set(key) <= set(statement.columns):
+		_merge_rows(cur, statement, params)
+		return
+
+	columns = ", ".join(statement.columns)
+	key_columns = ", ".join(key)
+	target = "smallcopy." + statement.table
+	column_types = _column_types(cur, statement.table)
+
+	def key_matches(a, b):
+		return " AND ".join(f"{a}.{column} = {b}.{column}" for column in key)
+
+	# cast to the table's types, so an unchanged row hashes the same on both sides
+	result_hash = "md5(ROW(" + ", ".join(f"q.{column}::{column_types[column]}" for column in statement.columns) + ")::text)"
+	copy_hash = "md5(ROW(" + ", ".join(f"t.{column}" for column in statement.columns) + ")::text)"
+
+	cur.execute(f"CREATE TEMPORARY TABLE smallcopy_selected AS SELECT {key_columns}, {result_hash} AS row_hash FROM ({statement.query}) AS q ({columns})", params)
+	cur.execute("ANALYZE smallcopy_selected")
+	cur.execute(f"DELETE FROM {target} t WHERE NOT EXISTS (SELECT FROM smallcopy_selected s WHERE {key_matches('s', 't')})")
+	cur.execute(
+		f"CREATE TEMPORARY TABLE smallcopy_changed AS SELECT {key_columns} FROM smallcopy_selected s "
+		f"WHERE NOT EXISTS (SELECT FROM {target} t WHERE {key_matches('t', 's')} AND {copy_hash} = s.row_hash)")
+	cur.execute("ANALYZE smallcopy_changed")
+	cur.execute(f"CREATE TEMPORARY TABLE smallcopy_incoming AS SELECT q.* FROM ({statement.query}) AS q ({columns}) INNER JOIN smallcopy_changed USING ({key_columns})", params)
+
+	values = [column for column in statement.columns if column not in key]
+
+	if values:
+		cur.execute(
+			f"UPDATE {target} t SET " + ", ".join(f"{column} = i.{column}" for column in values) + " FROM smallcopy_incoming i "
+			f"WHERE {key_matches('t', 'i')}")
+
+	cur.execute(f"INSERT INTO {target} ({columns}) SELECT {columns} FROM smallcopy_incoming i WHERE NOT EXISTS (SELECT FROM {target} t WHERE {key_matches('t', 'i')})")
+	cur.execute("DROP TABLE smallcopy_selected, smallcopy_changed, smallcopy_incoming")
+
+
+class MergingCursor:
+	def __init__(self, cur):
+		self._cur = cur
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def execute(self, query, vars=None):
+		statement = parse_insert_select(query)
+
+		# selections are rebuilt from scratch on every run
+		if statement is None or statement.schema != "smallcopy":
+			self._cur.execute(query, vars)
+		else:
+			merge(self._cur, statement, vars)
+
+
+def run_merging(cur, *, func, **config):
+	return func(MergingCursor(cur), **config)
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import connect, format_size
+from .target_schema import DEFAULT_SCHEMA, schema_cursor
+
+READ_SIZE = 1 << 20
+
+
+class _Stats:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.copied = 0
+		self.copied_bytes = 0
+		self.linked = 0
+		self.existing = 0
+		self.failures = []
+
+	def add(self, **counts):
+		with self._lock:
+			for name, count in counts.items():
+				setattr(self, name, getattr(self, name) + count)
+
+	def fail(self, message):
+		with self._lock:
+			self.failures.append(message)
+
+
+def _relative_path(file_path):
+	path = os.path.normpath(file_path.lstrip("/"))
+
+	if path.split(os.sep)[0] == "..":
+		raise ValueError(f"Media path outside the media root: {file_path!r}")
+
+	return path
+
+
+def _check_hash(source, file_hash, sha256):
+	# media without a recorded hash can't be checked
+	if sha256 is not None and file_hash.hexdigest() != sha256:
+		raise ValueError(f"{source}: sha256 is {file_hash.hexdigest()}, expected {sha256}")
+
+
+# Writes `source` to `destination` through a temporary file, checking its hash on the way, so that a destination file that exists is always complete.
+def _copy_verified(source, destination, sha256, *, link):
+	os.makedirs(os.path.dirname(destination), exist_ok=True)
+	temporary = destination + ".partial"
+	file_hash = hashlib.sha256()
+
+	if link:
+		with open(source, "rb") as f:
+			for chunk in iter(lambda: f.read(READ_SIZE), b""):
+				file_hash.update(chunk)
+
+		_check_hash(source, file_hash, sha256)
+		os.link(source, destination)
+		return os.path.getsize(destination)
+
+	try:
+		with open(source, "rb") as f, open(temporary, "wb") as out:
+			for chunk in iter(lambda: f.read(READ_SIZE), b""):
+				file_hash.update(chunk)
+				out.write(chunk)
+
+		_check_hash(source, file_hash, sha256)
+		shutil.copystat(source, temporary)
+		os.replace(temporary, destination)
+	except BaseException:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+
+		raise
+
+	return os.path.getsize(destination)
+
+
+# Materializes one file's content at every path that refers to it. The first path that exists in the source is copied (and verified) once, and the others are hard links to it.
+def _materialize(sha256, paths, *, source_root, destination_root, link, stats):
+	destinations = [os.path.join(destination_root, path) for path in paths]
+	existing = [destination for destination in destinations if os.path.exists(destination)]
+
+	if existing:
+		stats.add(existing=len(existing))
+		first = existing[0]
+	else:
+		for path, destination in zip(paths, destinations):
+			source = os.path.join(source_root, path)
+
+			if os.path.exists(source):
+				break
+		else:
+			stats.fail(f"none of {paths!r} exist in {source_root}")
+			return
+
+		try:
+			stats.add(copied=1, copied_bytes=_copy_verified(source, destination, sha256, link=link))
+		except (OSError, ValueError) as e:
+			stats.fail(str(e))
+			return
+
+		first = destination
+
+	for destination in destinations:
+		if not os.path.exists(destination):
+			try:
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+				os.link(first, destination)
+			except OSError as e:
+				stats.fail(str(e))
+			else:
+				stats.add(linked=1)
+
+
+# Copies the files of the media in the smallcopy schema from `source_root` into `destination_root`, once per distinct sha256. Files already in the destination (from an interrupted run) are kept.
+def copy_media_files(database, source_root, destination_root, *, jobs, link, schema=DEFAULT_SCHEMA):
+	start = time.perf_counter()
+	db = connect(database)
+
+	try:
+		with db, db.cursor() as cur:
+			cur = schema_cursor(cur, schema)
+			cur.execute("""
+				SELECT media.sha256, array_agg(DISTINCT disk_media.file_path)
+				FROM smallcopy.disk_media
+					INNER JOIN smallcopy.media USING (mediaid)
+				WHERE media.sha256 IS NOT NULL
+				GROUP BY media.sha256
+				UNION ALL SELECT NULL, ARRAY[disk_media.file_path]
+				FROM smallcopy.disk_media
+					INNER JOIN smallcopy.media USING (mediaid)
+				WHERE media.sha256 IS NULL
+			""")
+			files = [(sha256, [_relative_path(path) for path in paths]) for sha256, paths in cur]
+	finally:
+		db.close()
+
+	stats = _Stats()
+
+	with ThreadPoolExecutor(max_workers=jobs) as executor:
+		for future in [
+			executor.submit(_materialize, sha256, paths, source_root=source_root, destination_root=destination_root, link=link, stats=stats)
+			for sha256, paths in files
+		]:
+			future.result()
+
+	print(f"{len(files)} files: {stats.copied} {'linked' if link else 'copied'} ({format_size(stats.copied_bytes).strip()}), {stats.linked} duplicates linked, {stats.existing} already present", file=sys.stderr)
+
+	for failure in stats.failures:
+		print(failure, file=sys.stderr)
+
+	print("{:6.2f}s".format(time.perf_counter() - start))
+
+	if stats.failures:
+		raise RuntimeError(f"{len(stats.failures)} media files couldn't be copied")
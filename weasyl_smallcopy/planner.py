@@ -0,0 +1,118 @@
+import json
+import time
+from collections import namedtuple
+
+from .statements import copies_rows, parse_insert_select
+from .target_schema import schema_cursor
+
+Estimate = namedtuple("Estimate", ["name", "rows", "size", "seconds", "sequential_scans", "result"])
+
+# sequential scans over tables with at least this many rows are pointed out
+LARGE_TABLE_ROWS = 1000000
+
+
+# Explains the statements that copy rows into the smallcopy schema instead of running them. Everything else, including filling the selections that the copying statements join against, runs as usual.
+class PlanningCursor:
+	def __init__(self, cur):
+		self._cur = cur
+		self.plans = []
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def execute(self, query, vars=None):
+		statement = parse_insert_select(query)
+
+		if statement is None or statement.schema != "smallcopy":
+			self._cur.execute(query, vars)
+			return
+
+		self._cur.execute("EXPLAIN (VERBOSE, FORMAT JSON) " + statement.query, vars)
+		plan, = self._cur.fetchone()[0]
+		self.plans.append(plan["Plan"])
+
+
+def _sequential_scans(node):
+	if node["Node Type"] == "Seq Scan":
+		yield node["Schema"], node["Relation Name"]
+
+	for child in node.get("Plans", []):
+		yield from _sequential_scans(child)
+
+
+# Seconds per copied row for each step, from the reports of earlier runs.
+def calibrate(report_paths):
+	step_totals = {}
+
+	for path in report_paths:
+		with open(path, "r") as f:
+			report = json.load(f)
+
+		for step_report in report["steps"]:
+			rows = sum(statement["rows"] or 0 for statement in step_report["statements"] if copies_rows(statement["sql"]))
+
+			if rows:
+				seconds, total_rows = step_totals.get(step_report["name"], (0, 0))
+				step_totals[step_report["name"]] = (seconds + step_report["seconds"], total_rows + rows)
+
+	rates = {name: seconds / rows for name, (seconds, rows) in step_totals.items()}
+
+	if step_totals:
+		all_seconds, all_rows = map(sum, zip(*step_totals.values()))
+		rates[None] = all_seconds / all_rows
+
+	return rates
+
+
+# Runs `run_steps` against `target_schema` in a transaction that is rolled back afterwards, explaining each copying statement, and estimates the rows, size and (given per-row rates from `calibrate`) time of each step.
+def estimate_steps(db, run_steps, step_config, *, rates, target_schema):
+	table_rows = {}
+	estimates = []
+
+	def reltuples(cur, schema, relation):
+		if (schema, relation) not in table_rows:
+			cur.execute(
+				"SELECT c.reltuples FROM pg_class c INNER JOIN pg_namespace n ON c.relnamespace = n.oid "
+				"WHERE n.nspname = %(schema)s AND c.relname = %(relation)s",
+				{"schema": schema, "relation": relation})
+			table_rows[schema, relation], = cur.fetchone()
+
+		return table_rows[schema, relation]
+
+	try:
+		with db.cursor() as cur:
+			for step in run_steps:
+				# statements are recognized before their schema names are rewritten
+				planning_cur = PlanningCursor(schema_cursor(cur, target_schema))
+				step_start = time.perf_counter()
+				result = step.func(planning_cur, **step_config)
+				step_time = time.perf_counter() - step_start
+
+				if not planning_cur.plans:
+					estimates.append(Estimate(step.name, rows=None, size=None, seconds=step_time, sequential_scans=[], result=result))
+					continue
+
+				rows = sum(plan["Plan Rows"] for plan in planning_cur.plans)
+				rate = rates.get(step.name, rates.get(None))
+				sequential_scans = []
+
+				for plan in planning_cur.plans:
+					for schema, relation in _sequential_scans(plan):
+						if schema != target_schema + "_keys" and reltuples(cur, schema, relation) >= LARGE_TABLE_ROWS:
+							sequential_scans.append((f"{schema}.{relation}", reltuples(cur, schema, relation)))
+
+				estimates.append(Estimate(
+					step.name,
+					rows=rows,
+					size=sum(plan["Plan Rows"] * plan["Plan Width"] for plan in planning_cur.plans),
+					seconds=None if rate is None else rows * rate,
+					sequential_scans=sequential_scans,
+					result=result,
+				))
+	finally:
+		db.rollback()
+
+	return estimates
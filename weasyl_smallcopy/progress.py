@@ -0,0 +1,166 @@
+import datetime
+import json
+import threading
+import time
+from collections import namedtuple
+
+from .statements import copies_rows
+from .target_schema import schema_cursor
+
+PROGRESS_INTERVAL = 10
+
+Progress = namedtuple("Progress", ["step", "seconds", "state", "wait_event", "bytes", "bytes_per_second", "rows", "rows_estimated", "rows_per_second", "eta_seconds", "phase"])
+
+
+# Rows, bytes and seconds of each step in an earlier run's report.
+def read_baseline(path):
+	with open(path, "r") as f:
+		report = json.load(f)
+
+	return {
+		step_report["name"]: (
+			sum(statement["rows"] or 0 for statement in step_report["statements"] if copies_rows(statement["sql"])),
+			sum(step_report["relation_bytes"].values()),
+			step_report["seconds"],
+		)
+		for step_report in report["steps"]
+	}
+
+
+# Reports the progress of running steps from a connection of its own.
+class ProgressMonitor:
+	def __init__(self, connect, *, target_schema, baseline, on_progress, log_path=None, interval=PROGRESS_INTERVAL):
+		self._connect = connect
+		self._target_schema = target_schema
+		self._baseline = baseline
+		self._on_progress = on_progress
+		self._log_path = log_path
+		self._interval = interval
+		self._lock = threading.Lock()
+		self._running = {}
+		self._previous = {}
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+	def step_started(self, name, *, pid, tables):
+		with self._lock:
+			self._running[name] = (pid, sorted(tables), time.perf_counter())
+
+	def step_finished(self, name):
+		with self._lock:
+			del self._running[name]
+			self._previous.pop(name, None)
+
+	def _run(self):
+		db = self._connect()
+
+		try:
+			log = None if self._log_path is None else open(self._log_path, "a")
+
+			try:
+				while not self._stop.wait(self._interval):
+					with self._lock:
+						running = dict(self._running)
+
+					# each poll is its own transaction, since statistics views are read once per transaction
+					with db, db.cursor() as cur:
+						samples = [self._sample(schema_cursor(cur, self._target_schema), name, *step) for name, step in running.items()]
+
+					for progress in samples:
+						self._on_progress(progress)
+
+						if log is not None:
+							log.write(json.dumps({"time": datetime.datetime.now(datetime.timezone.utc).isoformat(), **progress._asdict()}) + "\n")
+							log.flush()
+			finally:
+				if log is not None:
+					log.close()
+		finally:
+			db.close()
+
+	def _sample(self, cur, name, pid, tables, start):
+		now = time.perf_counter()
+		cur.execute("SELECT state, wait_event_type || ':' || wait_event FROM pg_stat_activity WHERE pid = %(pid)s", {"pid": pid})
+		state, wait_event = cur.fetchone() or (None, None)
+
+		relation_bytes = None
+		rows = None
+		phase = None
+
+		if tables:
+			# tables that aren't committed yet aren't visible, and their size is unknown
+			cur.execute(
+				"SELECT sum(pg_total_relation_size(to_regclass('smallcopy.' || quote_ident(t))))::bigint FROM unnest(%(tables)s::text[]) AS t",
+				{"tables": tables})
+			relation_bytes, = cur.fetchone()
+
+		if cur.connection.server_version >= 140000:
+			cur.execute("SELECT tuples_processed FROM pg_stat_progress_copy WHERE pid = %(pid)s", {"pid": pid})
+			copy = cur.fetchone()
+
+			if copy is not None:
+				rows = copy[0]
+
+		if cur.connection.server_version >= 120000:
+			cur.execute("SELECT phase, blocks_done, blocks_total FROM pg_stat_progress_create_index WHERE pid = %(pid)s", {"pid": pid})
+			index = cur.fetchone()
+
+			if index is not None:
+				phase = index[0] if not index[2] else f"{index[0]} ({index[1] / index[2]:.0%})"
+
+		baseline_rows, baseline_bytes, baseline_seconds = self._baseline.get(name, (None, None, None))
+		rows_estimated = rows is None and relation_bytes is not None and bool(baseline_rows) and bool(baseline_bytes)
+
+		if rows_estimated:
+			rows = relation_bytes * baseline_rows / baseline_bytes
+
+		previous = self._previous.get(name)
+		self._previous[name] = (now, relation_bytes, rows)
+		bytes_per_second = None
+		rows_per_second = None
+
+		if previous is not None:
+			previous_time, previous_bytes, previous_rows = previous
+
+			if relation_bytes is not None and previous_bytes is not None:
+				bytes_per_second = (relation_bytes - previous_bytes) / (now - previous_time)
+
+			if rows is not None and previous_rows is not None:
+				rows_per_second = (rows - previous_rows) / (now - previous_time)
+
+		if bytes_per_second is not None and bytes_per_second > 0 and baseline_bytes:
+			eta_seconds = max(baseline_bytes - relation_bytes, 0) / bytes_per_second
+		elif baseline_seconds is not None:
+			eta_seconds = max(baseline_seconds - (now - start), 0)
+		else:
+			eta_seconds = None
+
+		return Progress(
+			name,
+			seconds=now - start,
+			state=state,
+			wait_event=wait_event,
+			bytes=relation_bytes,
+			bytes_per_second=bytes_per_second,
+			rows=rows,
+			rows_estimated=rows_estimated,
+			rows_per_second=rows_per_second,
+			eta_seconds=eta_seconds,
+			phase=phase,
+		)
+
+
+def run_monitored(cur, *, func, monitor, step_name, step_tables, **config):
+	monitor.step_started(step_name, pid=cur.connection.get_backend_pid(), tables=step_tables)
+
+	try:
+		return func(cur, **config)
+	finally:
+		monitor.step_finished(step_name)
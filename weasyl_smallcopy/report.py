@@ -0,0 +1,221 @@
+import datetime
+import json
+import threading
+import time
+
+from .statements import parse_insert_select
+
+REPORT_FORMAT = 1
+
+BUFFER_COUNTERS = [
+	"Shared Hit Blocks",
+	"Shared Read Blocks",
+	"Shared Dirtied Blocks",
+	"Shared Written Blocks",
+	"Temp Read Blocks",
+	"Temp Written Blocks",
+]
+
+
+def _normalize_sql(sql):
+	return " ".join(sql.split())
+
+
+# Records every statement a step executes. INSERT ... SELECT statements are run under EXPLAIN ANALYZE to get their buffer usage (and plans, if requested) from the same execution.
+class RecordingCursor:
+	def __init__(self, cur, *, explain):
+		self._cur = cur
+		self._explain = explain
+		self._rowcount = None
+		self.statements = []
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	@property
+	def rowcount(self):
+		return self._cur.rowcount if self._rowcount is None else self._rowcount
+
+	def _record(self, sql, start, rows, plan=None):
+		record = {
+			"sql": _normalize_sql(sql),
+			"seconds": time.perf_counter() - start,
+			"rows": rows,
+		}
+
+		if plan is not None:
+			top = plan["Plan"]
+			record["buffers"] = {counter: top.get(counter) for counter in BUFFER_COUNTERS}
+
+			if self._explain:
+				record["plan"] = plan
+
+		self.statements.append(record)
+
+	def execute(self, query, vars=None):
+		self._rowcount = None
+		start = time.perf_counter()
+
+		if parse_insert_select(query) is None:
+			self._cur.execute(query, vars)
+			self._record(query, start, self._cur.rowcount if self._cur.rowcount >= 0 else None)
+			return
+
+		timing = "ON" if self._explain else "OFF"
+		self._cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, TIMING {timing}, FORMAT JSON) " + query, vars)
+		plan, = self._cur.fetchone()[0]
+		self._rowcount = sum(
+			child["Actual Rows"] * child["Actual Loops"]
+			for child in plan["Plan"].get("Plans", [])
+			if child.get("Parent Relationship") not in ("InitPlan", "SubPlan")
+		)
+		self._record(query, start, self._rowcount, plan)
+
+	def copy_expert(self, sql, file, *args, **kwargs):
+		self._rowcount = None
+		start = time.perf_counter()
+		self._cur.copy_expert(sql, file, *args, **kwargs)
+		self._record(sql, start, self._cur.rowcount)
+
+
+class Recorder:
+	def __init__(self, *, explain):
+		self.explain = explain
+		self._lock = threading.Lock()
+		self._steps = []
+
+	def add(self, step_report):
+		with self._lock:
+			self._steps.append(step_report)
+
+	def write(self, path, *, config, total_seconds, wal_bytes, error=None):
+		report = {
+			"format": REPORT_FORMAT,
+			"finished": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+			"config": {
+				"include": len(config["include"]) if isinstance(config["include"], list) else config["include"],
+				"maximum_rating": config.get("maximum_rating"),
+				"variants": config.get("variants"),
+				"workers": config.get("workers", 1),
+			},
+			"seconds": total_seconds,
+			"wal_bytes": wal_bytes,
+			"error": error,
+			"steps": self._steps,
+		}
+
+		with open(path, "w") as f:
+			json.dump(report, f, indent="\t")
+			f.write("\n")
+
+
+def record_step(cur, *, func, recorder, step_name, step_tables, **config):
+	recording_cur = RecordingCursor(cur, explain=recorder.explain)
+	start = time.perf_counter()
+	result = func(recording_cur, **config)
+	seconds = time.perf_counter() - start
+	relation_bytes = {}
+
+	for table in sorted(step_tables):
+		cur.execute("SELECT pg_total_relation_size(('smallcopy.' || %(table)s)::regclass)", {"table": table})
+		relation_bytes[table], = cur.fetchone()
+
+	recorder.add({
+		"name": step_name,
+		"seconds": seconds,
+		"result": result,
+		"relation_bytes": relation_bytes,
+		"statements": recording_cur.statements,
+	})
+
+	return result
+
+
+def _plan_shape(plan):
+	node = plan["Plan"] if "Plan" in plan else plan
+	shape = [(node["Node Type"], node.get("Relation Name"), node.get("Index Name"))]
+
+	for child in node.get("Plans", []):
+		shape.extend(_plan_shape(child))
+
+	return shape
+
+
+def _describe_shape(shape):
+	return ", ".join(
+		node_type + ("" if relation is None else " on " + relation) + ("" if index is None else " using " + index)
+		for node_type, relation, index in shape
+	)
+
+
+def _change(old, new):
+	if not old:
+		return ""
+
+	return f"{(new - old) / old:+.0%}"
+
+
+# Prints the differences in timing, row counts and plans between two reports.
+def compare(old_path, new_path):
+	with open(old_path, "r") as f:
+		old = json.load(f)
+
+	with open(new_path, "r") as f:
+		new = json.load(f)
+
+	old_steps = {step["name"]: step for step in old["steps"]}
+	new_steps = {step["name"]: step for step in new["steps"]}
+	max_name_length = max(map(len, old_steps.keys() | new_steps.keys()))
+	line_format = "{:%d}  {:>9}  {:>9}  {:>6}" % (max_name_length,)
+
+	print(line_format.format("step", "old", "new", "change"))
+
+	for name in list(old_steps) + [name for name in new_steps if name not in old_steps]:
+		old_step = old_steps.get(name)
+		new_step = new_steps.get(name)
+
+		if old_step is None or new_step is None:
+			present = old_step or new_step
+			print(line_format.format(
+				name,
+				"-" if old_step is None else "{:.2f}s".format(present["seconds"]),
+				"-" if new_step is None else "{:.2f}s".format(present["seconds"]),
+				"",
+			))
+			continue
+
+		print(line_format.format(
+			name,
+			"{:.2f}s".format(old_step["seconds"]),
+			"{:.2f}s".format(new_step["seconds"]),
+			_change(old_step["seconds"], new_step["seconds"]),
+		))
+
+		for i, (old_statement, new_statement) in enumerate(zip(old_step["statements"], new_step["statements"]), 1):
+			if old_statement["sql"] != new_statement["sql"]:
+				print(f"  statement {i}: SQL changed")
+
+			if old_statement["rows"] != new_statement["rows"]:
+				print(f"  statement {i}: rows {old_statement['rows']} → {new_statement['rows']}")
+
+			if "plan" in old_statement and "plan" in new_statement:
+				old_shape = _plan_shape(old_statement["plan"])
+				new_shape = _plan_shape(new_statement["plan"])
+
+				if old_shape != new_shape:
+					print(f"  statement {i}: plan changed")
+					print(f"    old: {_describe_shape(old_shape)}")
+					print(f"    new: {_describe_shape(new_shape)}")
+
+		if len(old_step["statements"]) != len(new_step["statements"]):
+			print(f"  statements: {len(old_step['statements'])} → {len(new_step['statements'])}")
+
+	print(line_format.format(
+		"total",
+		"{:.2f}s".format(old["seconds"]),
+		"{:.2f}s".format(new["seconds"]),
+		_change(old["seconds"], new["seconds"]),
+	))
@@ -0,0 +1,97 @@
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# each step commits in its own transaction, so its rows are visible to its dependents
+def run_parallel(connect, steps, step_config, *, workers, on_finish):
+	steps_by_name = {step.name: step for step in steps}
+	waiting = {step.name: set(step.dependencies) & steps_by_name.keys() for step in steps}
+	connections = queue.Queue()
+	opened = []
+
+	def run(step):
+		db = connections.get()
+
+		try:
+			with db, db.cursor() as cur:
+				step_start = time.perf_counter()
+				result = step.func(cur, **step_config)
+				return time.perf_counter() - step_start, result
+		finally:
+			connections.put(db)
+
+	try:
+		for _ in range(workers):
+			db = connect()
+			opened.append(db)
+			connections.put(db)
+
+		running = {}
+		error = None
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			while True:
+				if error is None:
+					for name in [name for name, dependencies in waiting.items() if not dependencies]:
+						del waiting[name]
+						running[executor.submit(run, steps_by_name[name])] = name
+
+				if not running:
+					break
+
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+				for future in done:
+					name = running.pop(future)
+
+					try:
+						step_time, result = future.result()
+					except Exception as e:
+						if error is None:
+							error = e
+
+						continue
+
+					on_finish(name, step_time, result)
+
+					for dependencies in waiting.values():
+						dependencies.discard(name)
+
+		if error is not None:
+			raise error
+
+		if waiting:
+			raise RuntimeError(f"Steps with unsatisfiable dependencies: {sorted(waiting)!r}")
+	finally:
+		for db in opened:
+			db.close()
+
+
+# The non-copying steps that the copying steps depend on.
+def selection_step_names(run_steps):
+	steps_by_name = {step.name: step for step in run_steps}
+	selection = set()
+	pending = [dependency for step in run_steps if step.tables for dependency in step.dependencies]
+
+	while pending:
+		name = pending.pop()
+
+		if name in steps_by_name and name not in selection and not steps_by_name[name].tables:
+			selection.add(name)
+			pending.extend(steps_by_name[name].dependencies)
+
+	return selection
+
+
+def export_snapshot(db):
+	with db.cursor() as cur:
+		cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+		cur.execute("SELECT pg_export_snapshot()")
+		return cur.fetchone()[0]
+
+
+def run_in_snapshot(cur, *, func, copy_snapshot, **config):
+	cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+	cur.execute("SET TRANSACTION SNAPSHOT %(snapshot)s", {"snapshot": copy_snapshot})
+	return func(cur, **config)
@@ -0,0 +1,172 @@
+import hashlib
+import re
+from collections import namedtuple
+
+Schema = namedtuple("Schema", ["sql", "pre_data", "post_data"])
+PostDataObject = namedtuple("PostDataObject", ["type", "table", "name", "sql"])
+
+POST_DATA_TYPES = frozenset({
+	"CONSTRAINT",
+	"FK CONSTRAINT",
+	"INDEX",
+	"RULE",
+	"TRIGGER",
+})
+
+TEMPLATE_SCHEMA = "smallcopy_template"
+
+_IDENTIFIER = r'("[^"]+"|[^\s"(]+)'
+
+_post_data_comment = re.compile(r"^COMMENT ON (?:CONSTRAINT|INDEX|RULE|TRIGGER)\s", re.MULTILINE)
+
+_object_header = re.compile(r"^--\n-- Name: [^\n]*; Type: ([^;\n]+); Schema: [^\n]*\n--\n", re.MULTILINE)
+
+_object_targets = {
+	"CONSTRAINT": re.compile(r"ALTER TABLE ONLY\s+" + _IDENTIFIER + r"\s+ADD CONSTRAINT\s+" + _IDENTIFIER),
+	"FK CONSTRAINT": re.compile(r"ALTER TABLE ONLY\s+" + _IDENTIFIER + r"\s+ADD CONSTRAINT\s+" + _IDENTIFIER),
+	"INDEX": re.compile(r"CREATE (?:UNIQUE )?INDEX\s+" + _IDENTIFIER + r"\s+ON\s+(?:ONLY\s+)?" + _IDENTIFIER),
+	"RULE": re.compile(r"CREATE RULE\s+" + _IDENTIFIER + r"\s+AS\s+ON\s+\w+\s+TO\s+" + _IDENTIFIER),
+	"TRIGGER": re.compile(r"CREATE (?:CONSTRAINT )?TRIGGER\s+" + _IDENTIFIER + r"\s.*?\bON\s+" + _IDENTIFIER, re.DOTALL),
+}
+
+
+def _post_data_object(object_type, sql):
+	match = _object_targets[object_type].search(sql)
+
+	if match is None:
+		return PostDataObject(object_type, None, None, sql)
+
+	if object_type in ("CONSTRAINT", "FK CONSTRAINT"):
+		table, name = match.groups()
+	else:
+		name, table = match.groups()
+
+	return PostDataObject(object_type, table, name, sql)
+
+
+# Splits a plain `pg_dump --schema-only` dump on the object headers pg_dump writes, separating the indexes, constraints, triggers and rules that can be built once the data is loaded.
+def split_schema(sql):
+	headers = list(_object_header.finditer(sql))
+	pre_data = [sql[:headers[0].start()] if headers else sql]
+	post_data = []
+
+	for header, next_header in zip(headers, headers[1:] + [None]):
+		chunk = sql[header.start():None if next_header is None else next_header.start()]
+		object_type = header.group(1)
+
+		if object_type in POST_DATA_TYPES:
+			post_data.append(_post_data_object(object_type, chunk))
+		elif object_type == "COMMENT" and _post_data_comment.search(chunk):
+			post_data.append(PostDataObject(object_type, None, None, chunk))
+		else:
+			pre_data.append(chunk)
+
+	return Schema(sql, "".join(pre_data), post_data)
+
+
+# Moves the objects of a `pg_dump --schema=public` dump into a new smallcopy schema. Dumps that have already been rewritten are left as they are.
+def smallcopy_schema_sql(sql):
+	if "CREATE SCHEMA smallcopy;\n" in sql:
+		return sql
+
+	if "SET search_path = public, pg_catalog;" not in sql:
+		raise ValueError("schema.sql doesn't set search_path = public, pg_catalog before its objects")
+
+	header = _object_header.search(sql)
+	start = 0 if header is None else header.start()
+	sql = sql[:start] + "DROP SCHEMA IF EXISTS smallcopy CASCADE;\nCREATE SCHEMA smallcopy;\n\n" + sql[start:]
+	return sql.replace("SET search_path = public, pg_catalog;", "SET search_path = smallcopy, public, pg_catalog;")
+
+
+def read_schema(path="schema.sql"):
+	with open(path, "r") as f:
+		return split_schema(smallcopy_schema_sql(f.read()))
+
+
+def execute_post_data(cur, *, objects, target_schema="smallcopy", **config):
+	cur.execute(f"SET search_path = {target_schema}, public, pg_catalog")
+
+	for post_data_object in objects:
+		cur.execute(post_data_object.sql)
+
+	cur.execute("SET search_path = public")
+
+
+def add_foreign_keys_not_valid(cur, *, objects, target_schema="smallcopy", **config):
+	cur.execute(f"SET search_path = {target_schema}, public, pg_catalog")
+
+	for post_data_object in objects:
+		cur.execute(re.sub(r"(FOREIGN KEY[^;]*);", r"\1 NOT VALID;", post_data_object.sql, count=1))
+
+	cur.execute("SET search_path = public")
+
+
+def validate_foreign_keys(cur, *, objects, target_schema="smallcopy", **config):
+	for post_data_object in objects:
+		cur.execute(f"ALTER TABLE {target_schema}.{post_data_object.table} VALIDATE CONSTRAINT {post_data_object.name}")
+
+
+# Undoes `smallcopy_schema_sql`, for a copy that is restored into the public schema of its own database (as export.patch does for pg_dump's output).
+def public_schema_sql(sql):
+	sql = sql.replace("DROP SCHEMA IF EXISTS smallcopy CASCADE;\nCREATE SCHEMA smallcopy;\n", "")
+	return sql.replace("SET search_path = smallcopy, public, pg_catalog;", "SET search_path = public, pg_catalog;")
+
+
+def _renamed_schema_sql(sql, name):
+	sql = sql.replace("DROP SCHEMA IF EXISTS smallcopy CASCADE;\nCREATE SCHEMA smallcopy;\n", f"DROP SCHEMA IF EXISTS {name} CASCADE;\nCREATE SCHEMA {name};\n")
+	return sql.replace("SET search_path = smallcopy, public, pg_catalog;", f"SET search_path = {name}, public, pg_catalog;")
+
+
+def _template_hash(sql):
+	return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+
+# Replaces the smallcopy schema with the empty template schema left by an earlier run, if that was built from the same SQL. Objects refer to each other by OID, so the renamed schema is the same as one built from scratch.
+def use_schema_template(cur, sql):
+	cur.execute(f"SELECT obj_description(oid, 'pg_namespace') FROM pg_namespace WHERE nspname = '{TEMPLATE_SCHEMA}'")
+	template = cur.fetchone()
+
+	if template is None or template[0] != _template_hash(sql):
+		return False
+
+	cur.execute("DROP SCHEMA IF EXISTS smallcopy CASCADE")
+	cur.execute(f"ALTER SCHEMA {TEMPLATE_SCHEMA} RENAME TO smallcopy")
+	return True
+
+
+# Builds an empty copy of the schema for the next run to use.
+def build_schema_template(cur, *, sql, **config):
+	cur.execute(_renamed_schema_sql(sql, TEMPLATE_SCHEMA))
+	cur.execute(f"COMMENT ON SCHEMA {TEMPLATE_SCHEMA} IS %(hash)s", {"hash": _template_hash(sql)})
+	cur.execute("SET search_path = public")
+
+
+def make_unlogged(sql):
+	return re.sub(r"^CREATE TABLE ", "CREATE UNLOGGED TABLE ", sql, flags=re.MULTILINE)
+
+
+# A logged table can't reference an unlogged one, so tables are switched after every table they reference.
+def set_tables_logged(cur, **config):
+	cur.execute("""
+		SELECT c.oid, c.oid::regclass::text, coalesce(array_agg(f.confrelid) FILTER (WHERE f.confrelid <> c.oid), '{}')
+		FROM pg_class c
+			INNER JOIN pg_namespace n ON c.relnamespace = n.oid
+			LEFT JOIN pg_constraint f ON f.conrelid = c.oid AND f.contype = 'f'
+		WHERE
+			n.nspname = 'smallcopy' AND
+			c.relkind = 'r' AND
+			c.relpersistence = 'u'
+		GROUP BY c.oid
+	""")
+	unlogged = {oid: (name, set(references)) for oid, name, references in cur}
+
+	while unlogged:
+		ready = [oid for oid, (name, references) in unlogged.items() if not references & unlogged.keys()]
+
+		if not ready:
+			names = sorted(name for name, references in unlogged.values())
+			raise RuntimeError(f"Unlogged tables reference each other: {names!r}")
+
+		for oid in ready:
+			name, references = unlogged.pop(oid)
+			cur.execute(f"ALTER TABLE {name} SET LOGGED")
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from . import INCLUDE_ALL, RATING_CODES, connect, main, steps
+from .archive import ARCHIVE_FORMAT, export
+
+# the build schema is named after the start of its key
+SCHEMA_KEY_LENGTH = 16
+
+
+def _directory_size(path):
+	return sum(
+		os.path.getsize(os.path.join(directory, name))
+		for directory, _, names in os.walk(path)
+		for name in names
+	)
+
+
+# Names the source's state for requests that don't name a snapshot.
+def _source_snapshot(database, *, tables):
+	db = connect(database)
+
+	try:
+		with db, db.cursor() as cur:
+			# a replica's statistics don't count the writes it replays
+			cur.execute("SELECT pg_is_in_recovery()")
+
+			if cur.fetchone()[0]:
+				raise ValueError("Requests to a replica source must name a snapshot")
+
+			cur.execute(
+				"SELECT (SELECT system_identifier FROM pg_control_system())::text || ':' || d.oid::text || ':' || "
+				"coalesce((SELECT stats_reset FROM pg_stat_database WHERE datid = d.oid)::text, '') || ':' || "
+				"(SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_all_tables WHERE schemaname = 'public' AND relname = ANY (%(tables)s))::text "
+				"FROM pg_database d WHERE d.datname = current_database()",
+				{"tables": tables})
+			return cur.fetchone()[0]
+	finally:
+		db.close()
+
+
+def _parse_request(body):
+	request = json.loads(body)
+	include = request.get("include")
+	maximum_rating = request.get("maximum_rating")
+	snapshot = request.get("snapshot")
+
+	if include != INCLUDE_ALL and not (isinstance(include, list) and include and all(isinstance(userid, int) for userid in include)):
+		raise ValueError(f"include must be {INCLUDE_ALL!r} or a list of user ids")
+
+	if maximum_rating not in RATING_CODES:
+		raise ValueError(f"Unknown rating: {maximum_rating!r}")
+
+	if snapshot is not None and not isinstance(snapshot, str):
+		raise ValueError("snapshot must be a string")
+
+	return include if include == INCLUDE_ALL else sorted(set(include)), maximum_rating, snapshot
+
+
+# Builds requested copies, keeping their exports within `budget` bytes.
+class CopyCache:
+	def __init__(self, config, *, cache_directory, budget, jobs):
+		self._config = config
+		self._cache_directory = cache_directory
+		self._budget = budget
+		self._jobs = jobs
+		self._tables = sorted({table for step in steps for table in step.tables})
+		self._lock = threading.Lock()
+		self._building = {}
+
+		with open("schema.sql", "rb") as f:
+			self._schema_hash = hashlib.sha256(f.read()).hexdigest()
+
+		os.makedirs(cache_directory, exist_ok=True)
+
+		# exports left incomplete by a service that stopped while building
+		for name in os.listdir(cache_directory):
+			if name.endswith(".partial"):
+				shutil.rmtree(os.path.join(cache_directory, name))
+
+	def _key(self, include, maximum_rating, snapshot):
+		normalized = {
+			"include": include,
+			"maximum_rating": maximum_rating,
+			"snapshot": snapshot,
+			"schema": self._schema_hash,
+			"format": ARCHIVE_FORMAT,
+		}
+		return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def get(self, include, maximum_rating, snapshot=None):
+		if snapshot is None:
+			snapshot = _source_snapshot(self._config["database"], tables=self._tables)
+
+		key = self._key(include, maximum_rating, snapshot)
+		directory = os.path.join(self._cache_directory, key)
+
+		with self._lock:
+			if os.path.exists(directory):
+				# the manifest's modification time orders exports by their last use
+				os.utime(os.path.join(directory, "manifest.json"))
+				return key, directory, True
+
+			future = self._building.get(key)
+			building = future is None
+
+			if building:
+				future = self._building[key] = Future()
+
+		# identical requests wait for the build that's already running
+		if not building:
+			return key, future.result(), False
+
+		try:
+			self._build(key, directory, include=include, maximum_rating=maximum_rating)
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		else:
+			future.set_result(directory)
+		finally:
+			with self._lock:
+				del self._building[key]
+
+		self._evict(keep=key)
+		return key, directory, False
+
+	def _build(self, key, directory, *, include, maximum_rating):
+		schema_name = "smallcopy_cache_" + key[:SCHEMA_KEY_LENGTH]
+		config = {
+			**{name: value for name, value in self._config.items() if name not in ("incremental", "variants", "schema_name", "schema_template")},
+			"include": include,
+			"maximum_rating": maximum_rating,
+			"schema_name": schema_name,
+		}
+		target_database = config.get("target", config["database"])
+		partial_directory = directory + ".partial"
+
+		try:
+			main(config)
+
+			if os.path.exists(partial_directory):
+				shutil.rmtree(partial_directory)
+
+			export(target_database, partial_directory, jobs=self._jobs, schema=schema_name)
+			os.rename(partial_directory, directory)
+		finally:
+			db = connect(target_database)
+
+			try:
+				with db, db.cursor() as cur:
+					cur.execute(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE")
+					cur.execute(f"DROP SCHEMA IF EXISTS {schema_name}_keys CASCADE")
+			finally:
+				db.close()
+
+	def _evict(self, *, keep):
+		with self._lock:
+			exports = []
+
+			for name in os.listdir(self._cache_directory):
+				path = os.path.join(self._cache_directory, name)
+
+				if name.endswith(".partial") or not os.path.isdir(path):
+					continue
+
+				exports.append((os.path.getmtime(os.path.join(path, "manifest.json")), name, _directory_size(path)))
+
+			total = sum(size for _, _, size in exports)
+
+			for _, name, size in sorted(exports):
+				if total <= self._budget:
+					break
+
+				if name == keep:
+					continue
+
+				print(f"evicting {name} ({size} bytes)", file=sys.stderr, flush=True)
+				shutil.rmtree(os.path.join(self._cache_directory, name))
+				total -= size
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+def _handler(cache):
+	class Handler(BaseHTTPRequestHandler):
+		def _respond(self, status, body):
+			data = json.dumps(body).encode("utf-8")
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def do_POST(self):
+			if self.path != "/copies":
+				self._respond(404, {"error": "not found"})
+				return
+
+			try:
+				request = _parse_request(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+			except ValueError as e:
+				self._respond(400, {"error": str(e)})
+				return
+
+			try:
+				key, directory, cached = cache.get(*request)
+			except Exception as e:
+				self._respond(500, {"error": f"{type(e).__name__}: {e}"})
+				return
+
+			self._respond(200, {"key": key, "directory": os.path.abspath(directory), "cached": cached})
+
+	return Handler
+
+
+# Serves exports of the copies requested with POST /copies.
+def serve(config, *, host, port, cache_directory, budget, jobs):
+	server = _Server((host, port), _handler(CopyCache(config, cache_directory=cache_directory, budget=budget, jobs=jobs)))
+	print(f"serving copies on {host}:{port}", file=sys.stderr, flush=True)
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
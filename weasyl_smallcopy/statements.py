@@ -0,0 +1,27 @@
+import re
+from collections import namedtuple
+
+InsertSelect = namedtuple("InsertSelect", ["schema", "table", "columns", "query"])
+
+_insert_select = re.compile(r"\s*INSERT INTO (\w+)\.(\w+) \(([^)]*)\)\s+(.*)", re.DOTALL)
+
+_copying_rows = re.compile(r"INSERT INTO smallcopy\.|COPY smallcopy\.\w+ \([^)]*\) FROM STDIN")
+
+# a table in a FROM clause and its alias, if it has one
+from_table = re.compile(r"\bFROM\s+(\w+)(?:\s+(?!(?:INNER|LEFT|RIGHT|FULL|CROSS|JOIN|WHERE|GROUP|ORDER|UNION)\b)(\w+))?")
+
+
+# Steps copy rows with `INSERT INTO schema.table (columns) query`; this picks those statements apart so that the rows can be written some other way.
+def parse_insert_select(sql):
+	match = _insert_select.match(sql)
+
+	if match is None:
+		return None
+
+	schema, table, columns, query = match.groups()
+	return InsertSelect(schema, table, [column.strip() for column in columns.split(",")], query.rstrip())
+
+
+# Whether a statement in a report copied rows: an INSERT, or the COPY it is streamed with from a separate source.
+def copies_rows(sql):
+	return _copying_rows.match(sql) is not None
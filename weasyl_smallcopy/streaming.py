@@ -0,0 +1,264 @@
+import queue
+import re
+import threading
+
+from .statements import parse_insert_select
+
+PIPE_CHUNKS = 64
+
+# the most keys of one selection sent to the source with a query
+KEY_BATCH_SIZE = 10000
+
+_selection_reference = re.compile(r"\bsmallcopy_keys\.(\w+)(?:\s+(\w+))?")
+
+# combines rows across batches of keys
+_not_batchable = re.compile(r"\b(?:DISTINCT|GROUP\s+BY|UNION|LIMIT|OFFSET|ORDER\s+BY|EXISTS|OVER)\b|\(\s*SELECT\b", re.IGNORECASE)
+
+_inner_join = re.compile(r"\b(?:FROM|INNER\s+JOIN)\s+$", re.IGNORECASE)
+
+_not_aliases = frozenset({
+	"CROSS",
+	"FULL",
+	"GROUP",
+	"INNER",
+	"JOIN",
+	"LEFT",
+	"ON",
+	"ORDER",
+	"RIGHT",
+	"UNION",
+	"USING",
+	"WHERE",
+})
+
+
+class _Pipe:
+	def __init__(self, max_chunks):
+		self._chunks = queue.Queue(max_chunks)
+		self._buffer = b""
+		self._finished = False
+		self.closed = False
+
+	def write(self, data):
+		if self.closed:
+			raise BrokenPipeError("COPY into the target was aborted")
+
+		self._chunks.put(bytes(data))
+
+	def finish(self, error=None):
+		self._chunks.put(error or b"")
+
+	def read(self, size=-1):
+		while not self._finished and (size < 0 or len(self._buffer) < size):
+			chunk = self._chunks.get()
+
+			if isinstance(chunk, BaseException):
+				raise chunk
+
+			if not chunk:
+				self._finished = True
+			else:
+				self._buffer += chunk
+
+		if size < 0:
+			data, self._buffer = self._buffer, b""
+		else:
+			data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+		return data
+
+	def close(self):
+		self.closed = True
+
+		# unblock a writer waiting for space
+		while True:
+			try:
+				self._chunks.get_nowait()
+			except queue.Empty:
+				break
+
+
+def _key_columns(cur, table):
+	cur.execute(
+		"SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+		"WHERE attrelid = ('smallcopy_keys.' || %(table)s)::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+		{"table": table})
+
+	return cur.fetchall()
+
+
+def _key_set(cur, table, columns):
+	cur.execute(f"SELECT {', '.join(column for column, _ in columns)} FROM smallcopy_keys.{table}")
+	rows = cur.fetchall()
+	return [(column, column_type, [row[i] for row in rows]) for i, (column, column_type) in enumerate(columns)]
+
+
+def _key_batches(cur, table, column, column_type):
+	last = None
+
+	while True:
+		if last is None:
+			cur.execute(f"SELECT {column} FROM smallcopy_keys.{table} ORDER BY {column} LIMIT %(limit)s", {"limit": KEY_BATCH_SIZE})
+		else:
+			cur.execute(f"SELECT {column} FROM smallcopy_keys.{table} WHERE {column} > %(last)s ORDER BY {column} LIMIT %(limit)s", {"last": last, "limit": KEY_BATCH_SIZE})
+
+		values = [value for value, in cur.fetchall()]
+
+		if values:
+			yield [(column, column_type, values)]
+
+		if len(values) < KEY_BATCH_SIZE:
+			return
+
+		last = values[-1]
+
+
+# The selection a query can be sent to the source in batches of, if any.
+def _batch_reference(statement, references, key_columns):
+	if _not_batchable.search(statement.query):
+		return None
+
+	for i, match in enumerate(references):
+		table = match.group(1)
+
+		# a selection that the query is still filling
+		if statement.schema == "smallcopy_keys" and statement.table == table:
+			continue
+
+		if len(key_columns[table]) == 1 and _inner_join.search(statement.query, 0, match.start()):
+			return i
+
+	return None
+
+
+# Rewrites a step's query to run on the source, with `key_sets` for its selections.
+def source_query(query, params, key_sets):
+	params = dict(params or {})
+	key_sets = iter(key_sets)
+	index = 0
+
+	def replace(match):
+		nonlocal index
+		table, following = match.groups()
+		key_set = next(key_sets)
+		arrays = []
+
+		for column, column_type, values in key_set:
+			parameter = f"smallcopy_keys_{index}_{column}"
+			params[parameter] = values
+			arrays.append(f"%({parameter})s::{column_type}[]")
+
+		index += 1
+		relation = f"(SELECT * FROM unnest({', '.join(arrays)}) AS k ({', '.join(column for column, _, _ in key_set)}))"
+
+		if following is None or following.upper() in _not_aliases:
+			relation += f" AS {table}"
+
+		return relation + ("" if following is None else " " + following)
+
+	return _selection_reference.sub(replace, query), params
+
+
+class StreamingCursor:
+	def __init__(self, cur, source_cur):
+		self._cur = cur
+		self._source_cur = source_cur
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def execute(self, query, vars=None):
+		statement = parse_insert_select(query)
+
+		if statement is None:
+			self._cur.execute(query, vars)
+			return
+
+		references = list(_selection_reference.finditer(statement.query))
+		key_columns = {table: _key_columns(self._cur, table) for table in {match.group(1) for match in references}}
+		batched = _batch_reference(statement, references, key_columns)
+		key_sets = [None if i == batched else _key_set(self._cur, match.group(1), key_columns[match.group(1)]) for i, match in enumerate(references)]
+
+		if batched is None:
+			self._copy(statement, *source_query(statement.query, vars, key_sets))
+			return
+
+		table = references[batched].group(1)
+		(column, column_type), = key_columns[table]
+
+		for key_set in _key_batches(self._cur, table, column, column_type):
+			key_sets[batched] = key_set
+			self._copy(statement, *source_query(statement.query, vars, key_sets))
+
+	def _copy(self, statement, query, params):
+		copy_from_source = "COPY (" + self._source_cur.mogrify(query, params).decode() + ") TO STDOUT"
+		pipe = _Pipe(PIPE_CHUNKS)
+
+		def produce():
+			try:
+				self._source_cur.copy_expert(copy_from_source, pipe)
+			except BaseException as e:
+				pipe.finish(e)
+			else:
+				pipe.finish()
+
+		producer = threading.Thread(target=produce, daemon=True)
+		producer.start()
+
+		try:
+			self._cur.copy_expert(f"COPY {statement.schema}.{statement.table} ({', '.join(statement.columns)}) FROM STDIN", pipe)
+		except BaseException:
+			pipe.close()
+			self._source_cur.connection.cancel()
+			raise
+		finally:
+			producer.join()
+
+
+class SourcePool:
+	def __init__(self, connect, size):
+		self._connections = queue.Queue()
+		self._opened = []
+		self._snapshot = None
+
+		try:
+			for _ in range(size):
+				db = connect()
+				self._opened.append(db)
+				db.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+				with db.cursor() as cur:
+					# every source connection reads from the first one's snapshot for the whole run
+					if self._snapshot is None:
+						cur.execute("SELECT pg_export_snapshot()")
+						self._snapshot, = cur.fetchone()
+					else:
+						cur.execute("SET TRANSACTION SNAPSHOT %(snapshot)s", {"snapshot": self._snapshot})
+
+				self._connections.put(db)
+		except BaseException:
+			self.close()
+			raise
+
+	def get(self):
+		return self._connections.get()
+
+	def put(self, db):
+		self._connections.put(db)
+
+	def close(self):
+		for db in self._opened:
+			db.close()
+
+
+def run_streaming(cur, *, func, sources, **config):
+	db = sources.get()
+
+	try:
+		with db.cursor() as source_cur:
+			return func(StreamingCursor(cur, source_cur), **config)
+	finally:
+		sources.put(db)
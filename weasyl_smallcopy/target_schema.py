@@ -0,0 +1,74 @@
+import re
+
+DEFAULT_SCHEMA = "smallcopy"
+
+# the schemas named after the target schema: the copy, its selections and its template
+SCHEMA_SUFFIXES = ("", "_keys", "_template")
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_schema_reference = re.compile(r"\bsmallcopy(_keys|_template)?\b")
+
+
+# the quoting of psycopg2's quote_ident, which needs a connection
+def _quote_name(name):
+	return '"' + name.replace('"', '""') + '"'
+
+
+# Runs statements written for the smallcopy schema against a differently named one.
+class SchemaCursor:
+	def __init__(self, cur, *, schema):
+		self._cur = cur
+		self._names = {suffix: schema + suffix for suffix in SCHEMA_SUFFIXES}
+		self._identifiers = {suffix: _quote_name(name) for suffix, name in self._names.items()}
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+	def _rewrite_identifiers(self, sql, escape):
+		return _schema_reference.sub(lambda match: escape(self._identifiers[match.group(1) or ""]), sql)
+
+	def _rewrite_literal(self, literal, escape):
+		value = literal[1:-1].replace("''", "'")
+		name_match = _schema_reference.fullmatch(value)
+		value = self._names[name_match.group(1) or ""] if name_match is not None else self._rewrite_identifiers(value, lambda name: name)
+		return "'" + escape(value.replace("'", "''")) + "'"
+
+	def rewrite(self, sql, *, parameters=False):
+		# with parameters, a `%` in a name would be taken for a placeholder
+		escape = (lambda text: text.replace("%", "%%")) if parameters else (lambda text: text)
+		parts = []
+		position = 0
+
+		for match in _string_literal.finditer(sql):
+			parts.append(self._rewrite_identifiers(sql[position:match.start()], escape))
+			parts.append(self._rewrite_literal(match.group(), escape))
+			position = match.end()
+
+		parts.append(self._rewrite_identifiers(sql[position:], escape))
+		return "".join(parts)
+
+	def execute(self, query, vars=None):
+		self._cur.execute(self.rewrite(query, parameters=vars is not None), vars)
+
+	def copy_expert(self, sql, file, *args, **kwargs):
+		self._cur.copy_expert(self.rewrite(sql), file, *args, **kwargs)
+
+
+def schema_cursor(cur, schema):
+	return cur if schema == DEFAULT_SCHEMA else SchemaCursor(cur, schema=schema)
+
+
+def run_in_schema(cur, *, func, target_schema, **config):
+	return func(schema_cursor(cur, target_schema), **config)
+
+
+# Fails at the start if another run is building any of the same schemas.
+def lock_schemas(cur, schemas):
+	for schema in schemas:
+		cur.execute("SELECT pg_try_advisory_lock(hashtext(%(lock)s))", {"lock": "weasyl_smallcopy " + schema})
+
+		if not cur.fetchone()[0]:
+			raise RuntimeError(f"Another run is building the {schema} schema")
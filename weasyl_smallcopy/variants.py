@@ -0,0 +1,33 @@
+from functools import partial
+
+from .target_schema import SchemaCursor
+
+
+def variant_name(name, rating):
+	return f"{name} ({rating})"
+
+
+def variant_schema(schema, rating):
+	return f"{schema}_{rating}"
+
+
+# Runs a step for a lower rating, with the first copy in place of public.
+def run_variant(cur, *, func, schema_name, variant_max_rating, variant_include, **config):
+	cur.execute("SET search_path = smallcopy, public")
+	result = func(SchemaCursor(cur, schema=schema_name), **{**config, "max_rating": variant_max_rating, "include": variant_include})
+	cur.execute("SET search_path = public")
+	return result
+
+
+# The steps of `run_steps` for another variant, after the steps filling its source.
+def variant_steps(run_steps, rating, variant_max_rating, *, target_schema, source_steps, include):
+	return [
+		step._replace(
+			name=variant_name(step.name, rating),
+			func=partial(run_variant, func=step.func, schema_name=variant_schema(target_schema, rating), variant_max_rating=variant_max_rating, variant_include=include),
+			dependencies=frozenset(variant_name(dependency, rating) for dependency in step.dependencies) | (frozenset() if step.setup else source_steps),
+			# the sizes of a step's tables are reported from the smallcopy schema
+			tables=frozenset(),
+		)
+		for step in run_steps
+	]
@@ -0,0 +1,153 @@
+import sys
+import time
+from collections import namedtuple
+from functools import partial
+
+import psycopg2
+
+from . import Step, connect, step_time_format
+from .scheduler import run_parallel
+from .target_schema import DEFAULT_SCHEMA, run_in_schema, schema_cursor
+
+Reference = namedtuple("Reference", ["table", "columns", "referenced_table", "referenced_columns", "condition", "constraint"])
+
+# References the schema doesn't declare as foreign keys; `condition` refers to `t`.
+IMPLICIT_REFERENCES = [
+	Reference("favorite", ["targetid"], "submission", ["submitid"], "t.type = 's'", None),
+	Reference("favorite", ["targetid"], "character", ["charid"], "t.type = 'f'", None),
+	Reference("favorite", ["targetid"], "journal", ["journalid"], "t.type = 'j'", None),
+	Reference("comments", ["parentid"], "comments", ["commentid"], None, None),
+	Reference("comments", ["target_sub"], "submission", ["submitid"], None, None),
+	Reference("comments", ["target_user"], "login", ["userid"], None, None),
+	Reference("charcomment", ["parentid"], "charcomment", ["commentid"], "t.parentid <> 0", None),
+	Reference("charcomment", ["targetid"], "character", ["charid"], None, None),
+	Reference("journalcomment", ["parentid"], "journalcomment", ["commentid"], "t.parentid <> 0", None),
+	Reference("journalcomment", ["targetid"], "journal", ["journalid"], None, None),
+	Reference("searchmapchar", ["targetid"], "character", ["charid"], None, None),
+	Reference("searchmapjournal", ["targetid"], "journal", ["journalid"], None, None),
+	Reference("searchmapsubmit", ["targetid"], "submission", ["submitid"], None, None),
+	Reference("disk_media", ["mediaid"], "media", ["mediaid"], None, None),
+	Reference("media_media_links", ["describee_id"], "media", ["mediaid"], None, None),
+	Reference("media_media_links", ["described_with_id"], "media", ["mediaid"], None, None),
+	Reference("submission_media_links", ["mediaid"], "media", ["mediaid"], None, None),
+	Reference("submission_media_links", ["submitid"], "submission", ["submitid"], None, None),
+	Reference("user_media_links", ["mediaid"], "media", ["mediaid"], None, None),
+	Reference("user_media_links", ["userid"], "login", ["userid"], None, None),
+]
+
+
+def _reference_name(reference):
+	name = f"{reference.table}.{', '.join(reference.columns)} → {reference.referenced_table}"
+	return name if reference.condition is None else f"{name} where {reference.condition}"
+
+
+# Unvalidated foreign keys, and the implicit references no validated one covers.
+def read_references(cur):
+	cur.execute("""
+		SELECT
+			quote_ident(c.relname),
+			array(SELECT quote_ident(a.attname) FROM unnest(f.conkey) WITH ORDINALITY AS k (attnum, i) INNER JOIN pg_attribute a ON a.attrelid = f.conrelid AND a.attnum = k.attnum ORDER BY k.i)::text[],
+			quote_ident(r.relname),
+			array(SELECT quote_ident(a.attname) FROM unnest(f.confkey) WITH ORDINALITY AS k (attnum, i) INNER JOIN pg_attribute a ON a.attrelid = f.confrelid AND a.attnum = k.attnum ORDER BY k.i)::text[],
+			quote_ident(f.conname),
+			f.convalidated
+		FROM pg_constraint f
+			INNER JOIN pg_class c ON f.conrelid = c.oid
+			INNER JOIN pg_namespace n ON c.relnamespace = n.oid
+			INNER JOIN pg_class r ON f.confrelid = r.oid
+		WHERE
+			n.nspname = 'smallcopy' AND
+			f.contype = 'f'
+		ORDER BY c.relname, f.conname
+	""")
+	references = []
+	validated = set()
+
+	for table, columns, referenced_table, referenced_columns, name, convalidated in cur.fetchall():
+		if convalidated:
+			validated.add((table, tuple(columns), referenced_table))
+		else:
+			references.append(Reference(table, columns, referenced_table, referenced_columns, None, name))
+
+	return references + [
+		reference
+		for reference in IMPLICIT_REFERENCES
+		if (reference.table, tuple(reference.columns), reference.referenced_table) not in validated
+	]
+
+
+def _count_orphans(cur, reference):
+	conditions = [f"t.{column} IS NOT NULL" for column in reference.columns]
+
+	if reference.condition is not None:
+		conditions.append(reference.condition)
+
+	matches = " AND ".join(f"r.{referenced_column} = t.{column}" for column, referenced_column in zip(reference.columns, reference.referenced_columns))
+	cur.execute(
+		f"SELECT count(*) FROM smallcopy.{reference.table} t "
+		f"WHERE {' AND '.join(conditions)} AND NOT EXISTS (SELECT FROM smallcopy.{reference.referenced_table} r WHERE {matches})")
+	return cur.fetchone()[0]
+
+
+def _check_reference(cur, *, reference, check_name, violations, **config):
+	if reference.constraint is not None:
+		# orphans are only counted if the constraint doesn't validate
+		cur.execute("SAVEPOINT validate")
+
+		try:
+			cur.execute(f"ALTER TABLE smallcopy.{reference.table} VALIDATE CONSTRAINT {reference.constraint}")
+		except psycopg2.IntegrityError:
+			cur.execute("ROLLBACK TO SAVEPOINT validate")
+		else:
+			return "validated"
+
+	orphans = _count_orphans(cur, reference)
+
+	if orphans:
+		violations[check_name] = orphans
+		return f"{orphans} orphans"
+
+	return None
+
+
+# Checks the references between each schema's copied rows, in parallel.
+def verify(database, *, jobs, schemas=(DEFAULT_SCHEMA,)):
+	start = time.perf_counter()
+	run_steps = []
+	db = connect(database)
+
+	try:
+		for schema in schemas:
+			with db, db.cursor() as cur:
+				references = read_references(schema_cursor(cur, schema))
+
+			for reference in references:
+				name = _reference_name(reference) if len(schemas) == 1 else f"{schema}: {_reference_name(reference)}"
+				run_steps.append(Step(
+					name,
+					partial(run_in_schema, func=_check_reference, target_schema=schema, reference=reference, check_name=name),
+					frozenset(),
+					frozenset(),
+					False,
+				))
+	finally:
+		db.close()
+
+	violations = {}
+	time_format_string = step_time_format(max(len(step.name) for step in run_steps))
+
+	def step_finished(name, step_time, result):
+		print(time_format_string.format(name, step_time) + ("" if result is None else "  " + result), file=sys.stderr, flush=True)
+
+	run_parallel(
+		lambda: connect(database),
+		run_steps,
+		{"violations": violations},
+		workers=jobs,
+		on_finish=step_finished,
+	)
+
+	print("{:6.2f}s".format(time.perf_counter() - start))
+
+	if violations:
+		raise RuntimeError(f"{len(violations)} references have orphans: " + ", ".join(f"{name} ({orphans})" for name, orphans in violations.items()))